@@ -0,0 +1,485 @@
+"""Benchmarks for the PyKBLib hot paths.
+
+The benchmarks run offline against the simulated service in `pykblib.fake`,
+and write their results as JSON, so that runs can be compared between
+commits::
+
+    python benchmarks/run.py --output before.json
+    git checkout other-branch
+    python benchmarks/run.py --output after.json --compare before.json
+
+A full run takes several minutes, mostly spent parsing the 100,000-member
+team; `--quick` runs only the smaller sizes, once each.
+
+When comparing, the exit status is 1 if any benchmark's fastest time grew by
+more than the threshold. The fastest time is compared rather than the median,
+since it is the least affected by other activity on the machine.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmark the working tree rather than any installed copy of PyKBLib.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pykblib import Keybase  # noqa: E402
+from pykblib.api import KeybaseAPI  # noqa: E402
+from pykblib.cassette import (  # noqa: E402
+    RecordingTransport,
+    ReplayTransport,
+)
+from pykblib.const import __version__  # noqa: E402
+from pykblib.fake import FakeKeybase  # noqa: E402
+
+BENCHMARKS = list()
+
+
+def benchmark(name, params, repeats=5, quick_params=None, memory=False):
+    """Register a benchmark function.
+
+    The function is called once per repetition with a `Timer` and one of the
+    parameters, and must time the measured section with the timer.
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark.
+    params : list
+        The parameters with which to run the benchmark.
+    repeats : int
+        The number of repetitions per parameter. *(Defaults to 5.)*
+    quick_params : list
+        The parameters to use with `--quick`. *(Defaults to the first
+        parameter.)*
+    memory : bool
+        Whether to measure the peak memory allocated in the timed section, in
+        an extra repetition. *(Defaults to False.)*
+
+    """
+
+    def register(function):
+        BENCHMARKS.append(
+            {
+                "name": name,
+                "function": function,
+                "params": params,
+                "quick_params": quick_params or params[:1],
+                "repeats": repeats,
+                "memory": memory,
+            }
+        )
+        return function
+
+    return register
+
+
+class Timer:
+    """Times a section of a benchmark, and optionally its memory use.
+
+    Attributes
+    ----------
+    elapsed : float
+        The duration of the timed section, in seconds.
+    items : int
+        The number of items processed in the section, used to report
+        throughput.
+    peak_memory : int
+        The peak memory allocated within the section, in bytes, if traced.
+
+    """
+
+    def __init__(self, trace_memory=False):
+        """Initialize the Timer class.
+
+        Parameters
+        ----------
+        trace_memory : bool
+            Whether to trace memory allocations. *(Defaults to False.)*
+
+        """
+        self._trace_memory = trace_memory
+        self._start = None
+        self.elapsed = None
+        self.items = None
+        self.peak_memory = None
+
+    def __enter__(self):
+        """Start timing."""
+        if self._trace_memory:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop timing."""
+        self.elapsed = time.perf_counter() - self._start
+        if self._trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+class FixedOutputTransport:
+    """Answers every command with the same output, so only parsing is timed."""
+
+    def __init__(self, output):
+        """Initialize the FixedOutputTransport class.
+
+        Parameters
+        ----------
+        output : str
+            The output returned for every command.
+
+        """
+        self.output = output
+
+    def run_command(self, command):
+        """Return the stored output."""
+        return self.output
+
+
+def fake_keybase(teams=0, members=0, **kwargs):
+    """Create a simulated service with teams and members.
+
+    Parameters
+    ----------
+    teams : int
+        The number of teams to create. *(Defaults to 0.)*
+    members : int
+        The number of members to add to the first team. *(Defaults to 0.)*
+    kwargs : dict
+        Extra arguments for `FakeKeybase`.
+
+    Returns
+    -------
+    fake : FakeKeybase
+        The simulated service.
+
+    """
+    usernames = ["user{}".format(number) for number in range(members)]
+    fake = FakeKeybase("bench_user", users=usernames, **kwargs)
+    for number in range(teams):
+        fake._team_create_team({"team": "team{}".format(number)})
+    if members:
+        fake._team_add_members(
+            {
+                "team": "team0",
+                "usernames": [
+                    {"username": username, "role": "reader"}
+                    for username in usernames
+                ],
+            }
+        )
+    return fake
+
+
+@benchmark("keybase_startup", [10, 1000], quick_params=[10], memory=True)
+def bench_keybase_startup(timer, teams):
+    """Time `Keybase()`, which loads the active user and their teams."""
+    fake = fake_keybase(teams=teams)
+    with timer:
+        Keybase(transport=fake)
+
+
+@benchmark("call_api", ["fake", "fake-client", "replay"], repeats=3)
+def bench_call_api(timer, transport):
+    """Time a `list-self-memberships` query on each transport."""
+    fake = fake_keybase(teams=10)
+    query = {"method": "list-self-memberships"}
+    cassette = None
+    if transport == "fake":
+        api = KeybaseAPI(fake)
+    elif transport == "fake-client":
+        api = KeybaseAPI(executable=fake.executable())
+    elif transport == "replay":
+        descriptor, cassette = tempfile.mkstemp(suffix=".jsonl")
+        os.close(descriptor)
+        with RecordingTransport(cassette, fake) as recorder:
+            KeybaseAPI(recorder).call_api("team", query)
+        api = KeybaseAPI(ReplayTransport(cassette, speed=None))
+    else:
+        api = KeybaseAPI()
+    try:
+        with timer:
+            api.call_api("team", query)
+    finally:
+        fake.close()
+        if cassette is not None:
+            os.remove(cassette)
+
+
+@benchmark(
+    "team_update",
+    [10, 1000, 100000],
+    repeats=3,
+    quick_params=[10, 1000],
+    memory=True,
+)
+def bench_team_update(timer, members):
+    """Time parsing a `list-team-memberships` result."""
+    fake = fake_keybase(teams=1, members=members)
+    keybase = Keybase(transport=fake)
+    team = keybase.team("team0")
+    output = fake.run_command(
+        "team api -m '{}'".format(
+            json.dumps(
+                {
+                    "method": "list-team-memberships",
+                    "params": {"options": {"team": "team0"}},
+                }
+            )
+        )
+    )
+    team._api = KeybaseAPI(FixedOutputTransport(output))
+    with timer:
+        team.update()
+
+
+@benchmark("add_members", [10, 1000], quick_params=[10])
+def bench_add_members(timer, members):
+    """Time adding members to a team in a single call."""
+    fake = fake_keybase(teams=1)
+    usernames = ["user{}".format(number) for number in range(members)]
+    for username in usernames:
+        fake.add_user(username)
+    team = Keybase(transport=fake).team("team0")
+    timer.items = members
+    with timer:
+        team.add_members(usernames)
+
+
+@benchmark("purge_deleted", [10, 1000], quick_params=[10])
+def bench_purge_deleted(timer, members):
+    """Time removing members whose accounts were deleted."""
+    fake = fake_keybase(teams=1, members=members)
+    for number in range(members):
+        fake.add_user("user{}".format(number), "deleted")
+    team = Keybase(transport=fake).team("team0")
+    timer.items = members
+    with timer:
+        team.purge_deleted()
+
+
+@benchmark("purge_reset", [10, 1000], quick_params=[10])
+def bench_purge_reset(timer, members):
+    """Time removing members whose accounts were reset."""
+    fake = fake_keybase(teams=1, members=members)
+    for number in range(members):
+        fake.add_user("user{}".format(number), "reset")
+    team = Keybase(transport=fake).team("team0")
+    timer.items = members
+    with timer:
+        team.purge_reset()
+
+
+@benchmark("update_team_name", [10, 1000, 10000], quick_params=[10, 1000])
+def bench_update_team_name(timer, teams):
+    """Time renaming a team in the local lists of teams."""
+    keybase = Keybase(transport=fake_keybase())
+    keybase.teams = ["team{}.sub".format(number) for number in range(teams)]
+    with timer:
+        keybase._update_team_name("team0.sub", "team0.renamed")
+
+
+@benchmark("delete_team", [10, 1000, 10000], quick_params=[10, 1000])
+def bench_delete_team(timer, teams):
+    """Time deleting a team with ten sub-teams among many others."""
+    fake = fake_keybase(teams=teams)
+    for number in range(10):
+        fake._team_create_team({"team": "team0.sub{}".format(number)})
+    keybase = Keybase(transport=fake)
+    with timer:
+        keybase.delete_team("team0")
+
+
+def git_commit():
+    """Return the current git commit, or None outside of a repository."""
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def run(quick=False, name_filter=None, keybase=False, memory=True):
+    """Run the registered benchmarks.
+
+    Parameters
+    ----------
+    quick : bool
+        Whether to run only the smaller parameters, once each. *(Defaults to
+        False.)*
+    name_filter : str
+        If specified, only benchmarks whose names contain this string are
+        run. *(Defaults to None.)*
+    keybase : bool
+        Whether to include the installed keybase client in the transport
+        benchmarks. *(Defaults to False.)*
+    memory : bool
+        Whether to measure memory use where the benchmark asks for it. This
+        is slow for the largest sizes. *(Defaults to True.)*
+
+    Returns
+    -------
+    results : dict
+        The run's metadata and a result for each benchmark and parameter.
+
+    """
+    results = dict()
+    for entry in BENCHMARKS:
+        if name_filter and name_filter not in entry["name"]:
+            continue
+        params = list(entry["quick_params"] if quick else entry["params"])
+        if keybase and entry["name"] == "call_api":
+            params.append("keybase")
+        repeats = 1 if quick else entry["repeats"]
+        for param in params:
+            key = "{}[{}]".format(entry["name"], param)
+            times = list()
+            timer = None
+            for _ in range(repeats):
+                timer = Timer()
+                entry["function"](timer, param)
+                times.append(timer.elapsed)
+            median = statistics.median(times)
+            result = {
+                "median": median,
+                "min": min(times),
+                "max": max(times),
+                "repeats": repeats,
+            }
+            if timer.items:
+                result["items_per_second"] = timer.items / median
+            if memory and entry["memory"]:
+                # Measure memory separately, since tracing slows everything
+                # down.
+                traced = Timer(trace_memory=True)
+                entry["function"](traced, param)
+                result["peak_memory"] = traced.peak_memory
+            results[key] = result
+            print(
+                "{:<32} {:>12.6f} s {:>12} bytes".format(
+                    key, median, result.get("peak_memory", "-")
+                ),
+                file=sys.stderr,
+            )
+    return {
+        "metadata": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pykblib": __version__,
+            "quick": quick,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Compare two runs' results.
+
+    Parameters
+    ----------
+    baseline : dict
+        The results of the earlier run.
+    current : dict
+        The results of the later run.
+    threshold : float
+        The fractional increase in fastest time counted as a regression.
+
+    Returns
+    -------
+    regressions : list
+        The names of the benchmarks that regressed.
+
+    """
+    regressions = list()
+    for key, result in sorted(current["results"].items()):
+        before = baseline["results"].get(key)
+        if before is None:
+            continue
+        change = result["min"] / before["min"] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(key)
+        print(
+            "{:<32} {:>+8.1%}{}".format(
+                key, change, "  REGRESSION" if regressed else ""
+            ),
+            file=sys.stderr,
+        )
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line.
+
+    Parameters
+    ----------
+    argv : list
+        The command-line arguments. *(Defaults to sys.argv[1:].)*
+
+    Returns
+    -------
+    status : int
+        The exit status.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with results in this file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="the slowdown counted as a regression (default: 0.2)",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="run small sizes only, once"
+    )
+    parser.add_argument("--filter", help="run only matching benchmarks")
+    parser.add_argument(
+        "--keybase",
+        action="store_true",
+        help="also time the installed keybase client (needs a login)",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip measuring memory use, which is slow for large sizes",
+    )
+    arguments = parser.parse_args(argv)
+    results = run(
+        arguments.quick,
+        arguments.filter,
+        arguments.keybase,
+        not arguments.no_memory,
+    )
+    if arguments.output:
+        with open(arguments.output, "w") as target:
+            json.dump(results, target, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if arguments.compare:
+        with open(arguments.compare) as source:
+            baseline = json.load(source)
+        if compare(baseline, results, arguments.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
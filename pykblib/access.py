@@ -0,0 +1,224 @@
+"""Defines the AccessRequestProcessor class."""
+
+import json
+import logging
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.api import bind_deadline
+from pykblib.exceptions import (
+    AccessException,
+    APIException,
+    KeybaseException,
+    TeamException,
+    TimeoutException,
+)
+
+IGNORE = "ignore"
+DEFER = None
+
+AccessRequest = namedtuple("AccessRequest", ["team", "username"])
+RequestOutcome = namedtuple("RequestOutcome", ["request", "action", "error"])
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AccessRequestProcessor:
+    """Applies a policy to the access requests for the active user's teams.
+
+    Each call to `AccessRequestProcessor.process` retrieves the pending
+    requests for every team, and passes only those that weren't pending at
+    the previous poll to the policy. The policy is a callable that receives an
+    `AccessRequest` namedtuple, and returns one of the following:
+
+    * **A role**, i.e. reader, writer, admin or owner, to accept the request
+      with that role.
+    * **IGNORE**, to ignore the request.
+    * **DEFER** (None), to leave the request pending. Deferred requests
+      aren't passed to the policy again unless they are withdrawn and made
+      anew.
+
+    Accepted requests are added to their teams in one `Team.add_members` call
+    per team and role, and the resulting batches are run concurrently. Any
+    request whose action fails is passed to the policy again at the next
+    poll.
+
+    """
+
+    def __init__(self, keybase_instance, policy, max_workers=4):
+        """Initialize the AccessRequestProcessor class.
+
+        Parameters
+        ----------
+        keybase_instance : Keybase
+            The Keybase object whose teams' requests should be processed.
+        policy : callable
+            The function deciding what to do with each new request.
+        max_workers : int
+            The maximum number of batches of actions run at once. *(Defaults
+            to 4.)*
+
+        """
+        self._keybase = keybase_instance
+        self._lock = threading.Lock()
+        self._max_workers = max_workers
+        self._running = False
+        self._seen = set()
+        self._stopped = threading.Event()
+        self.policy = policy
+
+    def pending(self):
+        """Retrieve every pending access request.
+
+        The requests are read from the JSON output of `keybase team
+        list-requests` where the client supports it, and otherwise from the
+        `Keybase.list_requests` function.
+
+        Returns
+        -------
+        requests : set
+            A set of `AccessRequest` namedtuples.
+
+        Raises
+        ------
+        AccessException
+            If the requests could not be retrieved, an AccessException is
+            raised.
+
+        """
+        try:
+            output = self._keybase._api.run_command(
+                "team list-requests --json"
+            )
+            return {
+                AccessRequest(entry["name"], entry["username"])
+                for entry in json.loads(output) or []
+            }
+        except (APIException, ValueError, KeyError, TypeError):
+            pass
+        try:
+            requests = self._keybase.list_requests()
+        except KeybaseException as exception:
+            raise AccessException(exception.message)
+        return {
+            AccessRequest(team_name, username)
+            for team_name, usernames in requests.items()
+            for username in usernames
+        }
+
+    def process(self):
+        """Apply the policy to any new requests, and carry out its decisions.
+
+        Returns
+        -------
+        outcomes : list
+            A `RequestOutcome` namedtuple for each new request, containing the
+            `request`, the `action` taken (a role, IGNORE or DEFER), and the
+            `error` message if the action failed.
+
+        Raises
+        ------
+        AccessException
+            If the requests could not be retrieved, an AccessException is
+            raised.
+
+        """
+        current = self.pending()
+        with self._lock:
+            # Forget the requests that are no longer pending.
+            self._seen &= current
+            new = sorted(current - self._seen)
+        decisions = [(request, self.policy(request)) for request in new]
+        with self._lock:
+            self._seen.update(new)
+        accepted = defaultdict(list)
+        ignored = list()
+        for request, action in decisions:
+            if action == IGNORE:
+                ignored.append(request)
+            elif action is not DEFER:
+                accepted[(request.team, action)].append(request.username)
+
+        errors = dict()
+
+        def accept(item):
+            (team_name, role), usernames = item
+            try:
+                self._keybase.team(team_name).add_members(usernames, role)
+            except (KeybaseException, TeamException) as exception:
+                for username in usernames:
+                    errors[AccessRequest(team_name, username)] = (
+                        exception.message
+                    )
+
+        def ignore(request):
+            try:
+                self._keybase.ignore_request(request.team, request.username)
+            except KeybaseException as exception:
+                errors[request] = exception.message
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            accept, ignore = bind_deadline(accept), bind_deadline(ignore)
+            futures = [
+                (
+                    pool.submit(accept, item),
+                    [AccessRequest(item[0][0], user) for user in item[1]],
+                )
+                for item in accepted.items()
+            ]
+            futures.extend(
+                (pool.submit(ignore, request), [request])
+                for request in ignored
+            )
+        for future, requests in futures:
+            # Other failures, such as timeouts, are reported the same way.
+            exception = future.exception()
+            if exception is not None:
+                message = getattr(exception, "message", None) or str(exception)
+                for request in requests:
+                    errors.setdefault(request, message)
+        with self._lock:
+            # Failed requests are treated as new at the next poll.
+            self._seen.difference_update(errors)
+        return [
+            RequestOutcome(request, action, errors.get(request))
+            for request, action in decisions
+        ]
+
+    def run(self, interval=60):
+        """Process new requests periodically until stopped.
+
+        Errors while retrieving the requests are logged, and the next poll
+        proceeds as normal.
+
+        Parameters
+        ----------
+        interval : float
+            The number of seconds between polls. *(Defaults to 60.)*
+
+        Raises
+        ------
+        AccessException
+            If the processor is already running, an AccessException is
+            raised.
+
+        """
+        with self._lock:
+            if self._running:
+                raise AccessException("The processor is already running.")
+            self._running = True
+            self._stopped.clear()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.process()
+                except (AccessException, TimeoutException):
+                    _LOGGER.exception("Could not process access requests.")
+                self._stopped.wait(interval)
+        finally:
+            self._running = False
+
+    def stop(self):
+        """Ask a running processor to stop after its current poll."""
+        self._stopped.set()
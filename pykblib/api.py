@@ -1,18 +1,263 @@
 """Defines the KeybaseAPI class."""
 
+import contextlib
 import json
 import shlex
+import subprocess
+import threading
+import time
 
 import pexpect
 from steffentools import dict_to_ntuple
 
-from pykblib.exceptions import APIException
+from pykblib.exceptions import (
+    APIException,
+    ServiceUnavailableException,
+    TimeoutException,
+)
+from pykblib.metrics import CallHooks, command_name
+from pykblib.retry import is_transient
+
+# The absolute deadline of the current thread's calls, if any.
+_DEADLINE = threading.local()
+
+# The priority lane of the current thread's calls, if any.
+_PRIORITY = threading.local()
+
+# Whether the current thread is making an attempt of a call that retries,
+# and whether the attempt has been passed to the client or transport.
+_RETRYING = threading.local()
+
+
+def bind_deadline(function):
+    """Make a function observe the current thread's deadline in any thread.
+
+    Deadlines and priorities are kept per thread, so work submitted to a
+    thread pool should be wrapped with this function to stay within the
+    submitter's deadline, and keep its priority.
+
+    Parameters
+    ----------
+    function : callable
+        The function to wrap.
+
+    Returns
+    -------
+    function : callable
+        The wrapped function, or the original if there is no deadline.
+
+    """
+    expiry = getattr(_DEADLINE, "expiry", None)
+    lane = getattr(_PRIORITY, "lane", None)
+    if expiry is None and lane is None:
+        return function
+
+    def bound(*args, **kwargs):
+        previous = getattr(_DEADLINE, "expiry", None)
+        previous_lane = getattr(_PRIORITY, "lane", None)
+        if expiry is not None:
+            _DEADLINE.expiry = (
+                expiry if previous is None else min(expiry, previous)
+            )
+        if lane is not None:
+            _PRIORITY.lane = lane
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _DEADLINE.expiry = previous
+            _PRIORITY.lane = previous_lane
+
+    return bound
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Limit the time taken by every call to Keybase made within the block.
+
+    The limit covers the whole block, so multi-step operations, such as
+    deleting a team with sub-teams, share what remains of it. A call still
+    running when the deadline expires has its process killed, and raises a
+    TimeoutException, as does any call started afterwards. Nested deadlines
+    can only shorten the limit.
+
+    A TimeoutException isn't an APIException, since the call may have taken
+    effect. Operations made of many independent calls, such as
+    `Chat.broadcast` and `Wallet.batch`, report a timeout as the failure of
+    the affected items, and keep the results of the others.
+
+    Parameters
+    ----------
+    seconds : float
+        The number of seconds allowed.
+
+    """
+    previous = getattr(_DEADLINE, "expiry", None)
+    expiry = time.monotonic() + seconds
+    _DEADLINE.expiry = expiry if previous is None else min(expiry, previous)
+    try:
+        yield
+    finally:
+        _DEADLINE.expiry = previous
+
+
+@contextlib.contextmanager
+def priority(lane):
+    """Assign the calls to Keybase made within the block to a priority lane.
+
+    Priorities only take effect for KeybaseAPI instances with a scheduler
+    that has a capacity; see `pykblib.limits.Scheduler`.
+
+    Parameters
+    ----------
+    lane : str
+        The name of the lane, such as `pykblib.limits.INTERACTIVE` or
+        `pykblib.limits.BULK`.
+
+    """
+    previous = getattr(_PRIORITY, "lane", None)
+    _PRIORITY.lane = lane
+    try:
+        yield
+    finally:
+        _PRIORITY.lane = previous
+
+
+def remaining():
+    """Return the number of seconds left before the current deadline.
+
+    Returns
+    -------
+    seconds : float
+        The time left, which is negative once the deadline has passed, or
+        None if there is no deadline.
+
+    """
+    expiry = getattr(_DEADLINE, "expiry", None)
+    return None if expiry is None else expiry - time.monotonic()
 
 
 class KeybaseAPI:
-    """Provides an interface to the Keybase service."""
+    """Provides an interface to the Keybase service.
+
+    By default, commands are run by the keybase client found on the PATH. A
+    different client can be specified with `executable`, such as the fake
+    client provided by `pykblib.fake`. Alternatively, a transport object can
+    handle commands in-process. A transport must provide the `run_command`,
+    `delete_team`, `open_process` and `stream_lines` functions, with the same
+    signatures and behaviour as those of this class.
+
+    Every call can be instrumented with hooks registered through
+    `KeybaseAPI.add_hook`; see `pykblib.metrics.CallHooks` for the
+    measurements they receive.
+
+    The time allowed for each call is limited by the instance's `timeout`, and
+    by any `deadline` in effect in the calling thread, whichever is sooner.
+    Processes started with `KeybaseAPI.open_process` and streams can run for
+    a long time, so they are only limited by a deadline.
+
+    Calls that change teams can be throttled by the Keybase server when many
+    are made at once. A `pykblib.limits.Scheduler` limits their rate, and
+    adapts the number run at once to what the server sustains. It can also
+    limit the total number of calls run at once, and let calls made within
+    `priority` run ahead of others.
+
+    Calls that fail because the keybase client or service failed can be
+    retried according to a `pykblib.retry.RetryPolicy`, while a
+    `pykblib.retry.CircuitBreaker` refuses calls for a while once the service
+    appears to be down, so that queued calls fail fast instead of each
+    waiting to time out.
+
+    Team membership and team lists can be shared with other processes
+    through a `pykblib.cache.SharedTeamCache`.
+
+    Attributes
+    ----------
+    breaker : CircuitBreaker
+        The circuit breaker guarding calls, or None.
+    executable : str
+        The command used to start the keybase client.
+    hooks : CallHooks
+        The instrumentation hooks called before and after each call.
+    retry : RetryPolicy
+        The policy for retrying failed calls, or None.
+    scheduler : Scheduler
+        The scheduler limiting the rate and concurrency of calls, or None.
+    team_cache : SharedTeamCache
+        The cache of team data shared with other processes, or None.
+    timeout : float
+        The maximum number of seconds allowed for each call, or None.
+    transport : object
+        The transport handling commands, or None to use the keybase client.
+
+    """
+
+    def __init__(
+        self,
+        transport=None,
+        executable="keybase",
+        hooks=None,
+        timeout=None,
+        scheduler=None,
+        retry=None,
+        breaker=None,
+        team_cache=None,
+    ):
+        """Initialize the KeybaseAPI class.
+
+        Parameters
+        ----------
+        transport : object
+            The transport handling commands. *(Defaults to None.)*
+        executable : str
+            The command used to start the keybase client. *(Defaults to
+            keybase.)*
+        hooks : CallHooks
+            The instrumentation hooks to use, which may be shared with other
+            KeybaseAPI instances. *(Defaults to a new, empty CallHooks.)*
+        timeout : float
+            The maximum number of seconds allowed for each call. *(Defaults to
+            None, for no limit.)*
+        scheduler : Scheduler
+            The scheduler to use, which may be shared with other KeybaseAPI
+            instances. *(Defaults to None, in which case calls are made as
+            soon as they're requested.)*
+        retry : RetryPolicy
+            The policy for retrying failed calls. *(Defaults to None, in
+            which case calls are never retried.)*
+        breaker : CircuitBreaker
+            The circuit breaker to use, which may be shared with other
+            KeybaseAPI instances. *(Defaults to None.)*
+        team_cache : SharedTeamCache
+            The cache in which to share team membership and team lists with
+            other processes. *(Defaults to None.)*
 
-    def call_api(self, service, query):
+        """
+        self.breaker = breaker
+        self.executable = executable
+        self.hooks = CallHooks() if hooks is None else hooks
+        self.retry = retry
+        self.scheduler = scheduler
+        self.team_cache = team_cache
+        self.timeout = timeout
+        self.transport = transport
+
+    def add_hook(self, pre=None, post=None):
+        """Register instrumentation hooks.
+
+        Parameters
+        ----------
+        pre : callable
+            A function called with the service and method names before each
+            call. *(Defaults to None.)*
+        post : callable
+            A function called with a `pykblib.metrics.CallInfo` namedtuple
+            after each call, such as a `pykblib.metrics.MetricsCollector`.
+            *(Defaults to None.)*
+
+        """
+        self.hooks.add(pre, post)
+
+    def call_api(self, service, query, timeout=None):
         """Execute the specified query on the specified API service.
 
         Parameters
@@ -21,6 +266,9 @@ class KeybaseAPI:
             The name of the API service, i.e. 'chat', 'team', or 'wallet'.
         query : dict
             The query to be sent to the API.
+        timeout : float
+            The maximum number of seconds allowed for this call. *(Defaults to
+            None.)*
 
         Returns
         -------
@@ -32,18 +280,49 @@ class KeybaseAPI:
         APIException
             If there is an error defined in the return value, this will raise
             an exception containing the error message.
+        ServiceUnavailableException
+            If the circuit breaker is open, this APIException is raised
+            without making the call.
+        TimeoutException
+            If the call doesn't finish in time, a TimeoutException is raised.
 
         """
+        if timeout is not None:
+            with deadline(timeout):
+                return self.call_api(service, query)
+        method = query.get("method")
+        if self._resilient():
+            return self._attempt(
+                service, method, self.call_api, service, query
+            )
         json_query = json.dumps(query)
         command = "{} api -m {}".format(service, shlex.quote(json_query))
-        json_result = self.run_command(command)
-        result = json.loads(json_result)
-        if "error" in result.keys():
-            raise APIException(result["error"]["message"])
-        return dict_to_ntuple(result)
+        with self._schedule(service, method), self._measure(
+            service, method, len(json_query)
+        ) as call:
+            cache = self.team_cache if service == "team" else None
+            key = None if cache is None else cache.key_for(query)
+            try:
+                if key is None:
+                    json_result = self.run_command(command)
+                else:
+                    json_result = cache.fetch(
+                        key, lambda: self._fetch_result(command)
+                    )
+            finally:
+                if cache is not None and key is None:
+                    # The query may have changed a team.
+                    cache.invalidate_for(query)
+            started = time.perf_counter()
+            result = json.loads(json_result)
+            if "error" in result.keys():
+                raise APIException(result["error"]["message"])
+            result = dict_to_ntuple(result)
+            if call is not None:
+                call.parse_time = time.perf_counter() - started
+        return result
 
-    @staticmethod
-    def delete_team(team_name):
+    def delete_team(self, team_name):
         """Delete the specified team.
 
         Parameters
@@ -55,17 +334,386 @@ class KeybaseAPI:
         ------
         APIException
             If the team cannot be deleted, the APIException will be raised.
+        TimeoutException
+            If the deletion doesn't finish in time, a TimeoutException is
+            raised.
 
         """
         # This is a special function. Where most actions are able to be
         # executed via the _run_command function, keybase team deletion is a
         # bit more complicated.
 
+        if self._resilient():
+            return self._attempt("team", "delete", self.delete_team, team_name)
+        try:
+            with self._schedule("team", "delete"), self._measure(
+                "team", "delete"
+            ) as call:
+                time_left = self._time_left()
+                _RETRYING.dispatched = True
+                if self.transport is not None:
+                    with deadline(time_left) if time_left else _no_deadline():
+                        return self.transport.delete_team(team_name)
+                self._delete_team(team_name, call, time_left)
+        finally:
+            if self.team_cache is not None:
+                self.team_cache.invalidate_team(team_name)
+                self.team_cache.invalidate("teams/")
+
+    def open_process(self, arguments, stdin=None, stdout=None):
+        """Start the keybase client with pipes for streaming its input/output.
+
+        Unlike `KeybaseAPI.run_command`, the process is not attached to a
+        pseudo-terminal, so binary data passes through unaltered, and nothing
+        is buffered on the caller's behalf.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the keybase client.
+        stdin : int or file
+            The process's standard input, such as `subprocess.PIPE`. *(Defaults
+            to None.)*
+        stdout : int or file
+            The process's standard output, such as `subprocess.PIPE`.
+            *(Defaults to None.)*
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process. Its standard error is always piped, so that
+            error messages can be retrieved.
+
+        Raises
+        ------
+        APIException
+            If the keybase client could not be started, an APIException is
+            raised.
+        TimeoutException
+            If the current deadline has passed, a TimeoutException is raised.
+            If it expires while the process is running, the process is
+            killed.
+
+        """
+        names = command_name(arguments)
+        self._check_breaker(*names)
+        with self._measure(*names) as call:
+            time_left = self._time_left(limit=False)
+            if self.transport is not None:
+                process = self.transport.open_process(
+                    arguments, stdin=stdin, stdout=stdout
+                )
+                return _kill_at_deadline(process, time_left)
+            started = time.perf_counter()
+            try:
+                process = subprocess.Popen(
+                    shlex.split(self.executable) + list(arguments),
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=subprocess.PIPE,
+                )
+            except OSError as error:
+                raise APIException(
+                    "Could not start keybase: {}".format(error.strerror)
+                )
+            if call is not None:
+                call.spawned(time.perf_counter() - started)
+            return _kill_at_deadline(process, time_left)
+
+    def stream_lines(self, command):
+        """Execute the specified command, yielding its output line by line.
+
+        The command is left running for as long as the generator is being
+        consumed, and is terminated when the generator is closed.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Yields
+        ------
+        line : str
+            Each line of the command's output, without the line ending.
+
+        Raises
+        ------
+        TimeoutException
+            If the deadline in effect when the stream started expires, the
+            command is terminated and a TimeoutException is raised.
+
+        """
+        # The stream is measured from start to finish, but other calls made
+        # while it is open are measured separately.
+        with self._measure(
+            *command_name(command.split()), len(command), track=False
+        ) as call:
+            time_left = self._time_left(limit=False)
+            expiry = (
+                None if time_left is None else time.monotonic() + time_left
+            )
+            if self.transport is not None:
+                for line in self.transport.stream_lines(command):
+                    if expiry is not None and time.monotonic() >= expiry:
+                        raise TimeoutException("Timed out: {}".format(command))
+                    if call is not None:
+                        call.received(len(line) + 1)
+                    yield line
+                return
+            started = time.perf_counter()
+            proc = pexpect.spawn(
+                "{} {}".format(self.executable, command), timeout=None
+            )
+            if call is not None:
+                call.spawned(time.perf_counter() - started)
+            try:
+                while 1:
+                    if expiry is not None:
+                        proc.timeout = max(0, expiry - time.monotonic())
+                    try:
+                        line = proc.readline()
+                    except pexpect.exceptions.EOF:
+                        break
+                    except pexpect.exceptions.TIMEOUT:
+                        raise TimeoutException("Timed out: {}".format(command))
+                    if not line:
+                        break
+                    if call is not None:
+                        call.received(len(line))
+                    yield line.decode().rstrip("\r\n")
+            finally:
+                proc.close(force=True)
+
+    def run_command(self, command, timeout=None):
+        """Execute the specified command, then return the result.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+        timeout : float
+            The maximum number of seconds allowed for this call. *(Defaults to
+            None.)*
+
+        Returns
+        -------
+        output : str
+            The output of the command being run.
+
+        Raises
+        ------
+        APIException
+            If there was an error returned by the Keybase application, this
+            will raise an exception containing the error message.
+        TimeoutException
+            If the command doesn't finish in time, it is killed, and a
+            TimeoutException is raised.
+
+        """
+        if timeout is not None:
+            with deadline(timeout):
+                return self.run_command(command)
+        names = command_name(command.split())
+        if self._resilient():
+            return self._attempt(*names, self.run_command, command)
+        try:
+            with self._schedule(*names), self._measure(
+                *names, len(command)
+            ) as call:
+                time_left = self._time_left()
+                _RETRYING.dispatched = True
+                if self.transport is not None:
+                    # Let the transport observe the time limit as a deadline.
+                    with deadline(time_left) if time_left else _no_deadline():
+                        output = self.transport.run_command(command)
+                    if call is not None:
+                        call.received(len(output))
+                    return output
+                full_command = "{} {}".format(self.executable, command)
+                if time_left is None:
+                    result = pexpect.run(full_command)
+                else:
+                    expired = list()
+
+                    def expire(values):
+                        # Kill the process, and stop waiting for its output.
+                        values["child"].terminate(force=True)
+                        expired.append(True)
+                        return True
+
+                    result = pexpect.run(
+                        full_command,
+                        timeout=time_left,
+                        events={pexpect.TIMEOUT: expire},
+                    )
+                    if expired:
+                        raise TimeoutException(
+                            "Timed out after {:.1f} seconds: {}".format(
+                                time_left, command
+                            )
+                        )
+                if call is not None:
+                    # pexpect.run waits for the process, so the time spent
+                    # starting it can't be told apart.
+                    call.spawned()
+                    call.received(len(result))
+                if b"\x1b[31m" in result and b"ERROR" in result:
+                    # An error was reported. Exctract the message and raise it.
+                    result = b" ".join(result.split()[2:]).replace(
+                        b"\x1b[0m", b""
+                    )
+                    raise APIException(result.decode())
+                return result.decode()
+        finally:
+            if self.team_cache is not None:
+                # The command may have changed a team.
+                self.team_cache.invalidate_command(command)
+
+    def remove_hook(self, hook):
+        """Unregister an instrumentation hook.
+
+        Parameters
+        ----------
+        hook : callable
+            The pre-call or post-call hook to remove.
+
+        """
+        self.hooks.remove(hook)
+
+    def _attempt(self, service, method, function, *args):
+        """Make a call, retrying it according to the retry policy.
+
+        The outcome of each attempt is passed to the circuit breaker, except
+        for attempts whose time ran out before Keybase was called. Calls made
+        from within an attempt are neither retried nor checked again.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+        function : callable
+            The function making the call.
+        *args
+            The arguments passed to the function.
+
+        Returns
+        -------
+        result : object
+            The function's return value.
+
+        Raises
+        ------
+        APIException
+            If the last attempt fails, its APIException is raised.
+        ServiceUnavailableException
+            If the circuit breaker is open, this APIException is raised.
+
+        """
+        attempt = 0
+        while 1:
+            self._check_breaker(service, method)
+            attempt += 1
+            _RETRYING.active = True
+            _RETRYING.dispatched = False
+            try:
+                result = function(*args)
+            except APIException as exception:
+                message = exception.message
+                self._record(is_transient(message))
+                if self.retry is None or not self.retry.should_retry(
+                    service, method, message, attempt
+                ):
+                    raise
+                delay = self.retry.delay(attempt)
+                time_left = remaining()
+                if time_left is not None and delay >= time_left:
+                    raise
+            except TimeoutException:
+                # Running out of time before Keybase was called, e.g. while
+                # waiting for the scheduler, says nothing about its health.
+                if getattr(_RETRYING, "dispatched", False):
+                    self._record(True)
+                raise
+            else:
+                self._record(False)
+                return result
+            finally:
+                _RETRYING.active = False
+            time.sleep(delay)
+
+    def _check_breaker(self, service, method):
+        """Refuse a call if the circuit breaker is open.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+
+        Raises
+        ------
+        ServiceUnavailableException
+            If the breaker is open, this APIException is raised.
+
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise ServiceUnavailableException(
+                "Keybase is unavailable; not calling {} {}.".format(
+                    service, method
+                )
+            )
+
+    def _delete_team(self, team_name, call, time_left):
+        """Delete the specified team with the keybase client.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team to be deleted.
+        call : object
+            The measurements of the call, or None.
+        time_left : float
+            The number of seconds allowed, or None.
+
+        Raises
+        ------
+        APIException
+            If the team cannot be deleted, the APIException will be raised.
+        TimeoutException
+            If the time allowed runs out, a TimeoutException is raised.
+
+        """
+        expiry = None if time_left is None else time.monotonic() + time_left
+
+        def wait(seconds):
+            # Wait no longer than the time allowed.
+            if expiry is None:
+                return seconds
+            return max(0, min(seconds, expiry - time.monotonic()))
+
+        def expired():
+            if expiry is None or time.monotonic() < expiry:
+                return False
+            proc.close(force=True)
+            return True
+
         # Open a new pexpect process for deletion.
-        proc = pexpect.spawn("keybase team delete {}".format(team_name))
+        started = time.perf_counter()
+        proc = pexpect.spawn(
+            "{} team delete {}".format(self.executable, team_name)
+        )
+        if call is not None:
+            call.spawned(time.perf_counter() - started)
         try:
-            proc.expect("WARNING", timeout=10)
+            proc.expect("WARNING", timeout=wait(10))
         except (pexpect.exceptions.TIMEOUT, pexpect.exceptions.EOF):
+            if expired():
+                raise TimeoutException(
+                    "Timed out deleting team {}.".format(team_name)
+                )
             # If it didn't give us a warning, then we can't delete this team.
             raise APIException("Failed to delete team {}.".format(team_name))
         proc.sendline("nuke {}\r\n".format(team_name))
@@ -73,15 +721,66 @@ class KeybaseAPI:
         # Read output until EOF.
         while 1:
             try:
-                output += proc.read_nonblocking(timeout=3)
+                output += proc.read_nonblocking(timeout=wait(3))
             except (pexpect.exceptions.TIMEOUT, pexpect.exceptions.EOF):
+                if expired():
+                    raise TimeoutException(
+                        "Timed out deleting team {}.".format(team_name)
+                    )
                 break
+        if call is not None:
+            call.received(len(output))
         if "Success!" not in output.decode():
             raise APIException("Failed to delete team {}.".format(team_name))
 
-    @staticmethod
-    def run_command(command):
-        """Execute the specified command, then return the result.
+    @contextlib.contextmanager
+    def _measure(self, service, method, bytes_out=None, track=True):
+        """Measure a call for the instrumentation hooks.
+
+        If no hooks are registered, nothing is measured. If the call is made
+        from within another call being measured, it is measured as part of
+        that call.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+        bytes_out : int
+            The number of bytes sent. *(Defaults to None.)*
+        track : bool
+            Whether calls made within this one are part of it. *(Defaults to
+            True.)*
+
+        Yields
+        ------
+        call : object
+            The measurements of the call, or None if nothing is measured.
+
+        """
+        hooks = self.hooks
+        if not hooks:
+            yield None
+            return
+        outer = hooks.current()
+        if outer is not None:
+            yield outer
+            return
+        call = hooks.start(service, method, bytes_out, track)
+        try:
+            yield call
+        except GeneratorExit:
+            # A stream was closed by its consumer.
+            hooks.finish(call)
+            raise
+        except Exception as exception:
+            hooks.finish(call, getattr(exception, "message", str(exception)))
+            raise
+        hooks.finish(call)
+
+    def _fetch_result(self, command):
+        """Run an API command, returning its output only if it succeeded.
 
         Parameters
         ----------
@@ -91,18 +790,137 @@ class KeybaseAPI:
         Returns
         -------
         output : str
-            The output of the command being run.
+            The JSON output of the command.
 
         Raises
         ------
         APIException
-            If there was an error returned by the Keybase application, this
-            will raise an exception containing the error message.
+            If the output holds an error, an APIException is raised, so that
+            the error isn't cached.
+
+        """
+        output = self.run_command(command)
+        result = json.loads(output)
+        if "error" in result.keys():
+            raise APIException(result["error"]["message"])
+        return output
+
+    def _record(self, failed):
+        """Pass the outcome of a call to the circuit breaker, if any.
+
+        Parameters
+        ----------
+        failed : bool
+            Whether the call failed with a transient error.
+
+        """
+        if self.breaker is not None:
+            if failed:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    def _resilient(self):
+        """Return True if a call should be made through `_attempt`."""
+        return (
+            self.retry is not None or self.breaker is not None
+        ) and not getattr(_RETRYING, "active", False)
+
+    @contextlib.contextmanager
+    def _schedule(self, service, method):
+        """Wait for the scheduler to allow a call, if there is a scheduler.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+
+        Raises
+        ------
+        TimeoutException
+            If the call's time runs out while it waits, a TimeoutException is
+            raised.
+
+        """
+        if self.scheduler is None:
+            yield
+            return
+        with self.scheduler.slot(
+            service,
+            method,
+            self._time_left(),
+            getattr(_PRIORITY, "lane", None),
+        ) as acquired:
+            if not acquired:
+                raise TimeoutException(
+                    "Timed out waiting to call {} {}.".format(service, method)
+                )
+            yield
+
+    def _time_left(self, limit=True):
+        """Return the number of seconds allowed for a call.
+
+        Parameters
+        ----------
+        limit : bool
+            Whether the instance's timeout applies, in addition to the
+            current deadline. *(Defaults to True.)*
+
+        Returns
+        -------
+        seconds : float
+            The time allowed, or None if there is no limit.
+
+        Raises
+        ------
+        TimeoutException
+            If the current deadline has already passed, a TimeoutException is
+            raised.
 
         """
-        result = pexpect.run("keybase {}".format(command))
-        if b"\x1b[31m" in result and b"ERROR" in result:
-            # An error was reported. Exctract the message and raise it.
-            result = b" ".join(result.split()[2:]).replace(b"\x1b[0m", b"")
-            raise APIException(result.decode())
-        return result.decode()
+        limits = [remaining()]
+        if limit:
+            limits.append(self.timeout)
+        limits = [seconds for seconds in limits if seconds is not None]
+        if not limits:
+            return None
+        seconds = min(limits)
+        if seconds <= 0:
+            raise TimeoutException("The deadline has passed.")
+        return seconds
+
+
+def _kill_at_deadline(process, seconds):
+    """Kill a process if it is still running after the specified time.
+
+    Parameters
+    ----------
+    process : subprocess.Popen
+        The process.
+    seconds : float
+        The number of seconds it may run for, or None for no limit.
+
+    Returns
+    -------
+    process : subprocess.Popen
+        The same process.
+
+    """
+    if seconds is not None:
+
+        def kill():
+            if process.poll() is None:
+                process.kill()
+
+        timer = threading.Timer(seconds, kill)
+        timer.daemon = True
+        timer.start()
+    return process
+
+
+@contextlib.contextmanager
+def _no_deadline():
+    """Do nothing, in place of `deadline` when there's no time limit."""
+    yield
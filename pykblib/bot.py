@@ -0,0 +1,392 @@
+"""Defines the Bot class."""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.exceptions import BotException
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Bot:
+    """Dispatches incoming chat messages to registered command handlers.
+
+    A message whose body starts with the command prefix followed by a
+    registered command name, such as `!ping`, is passed to that command's
+    handler. Handlers run concurrently across conversations, but the messages
+    within any one conversation are always handled in the order they arrived.
+
+    Handlers are called with the message and the list of words following the
+    command, i.e. `handler(message, args)`. When the bot is run with
+    `Bot.run_async`, handlers may also be coroutine functions.
+
+    """
+
+    def __init__(self, keybase_instance, workers=4, prefix="!"):
+        """Initialize the Bot class.
+
+        Parameters
+        ----------
+        keybase_instance : Keybase
+            The Keybase object whose chat the bot should serve.
+        workers : int
+            The maximum number of handlers run at once. *(Defaults to 4.)*
+        prefix : str
+            The prefix that marks a message as a command. *(Defaults to !.)*
+
+        """
+        self._keybase = keybase_instance
+        self._chat = keybase_instance.chat
+        self._handlers = dict()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._workers = workers
+        self._queues = dict()
+        self._queue_depth = 0
+        self._running = False
+        self._tasks = set()
+        self._stats = defaultdict(
+            lambda: {
+                "calls": 0,
+                "errors": 0,
+                "total_time": 0.0,
+                "max_time": 0.0,
+                "total_wait": 0.0,
+            }
+        )
+        self.prefix = prefix
+
+    def add_command(self, name, handler):
+        """Register a handler for the specified command.
+
+        Parameters
+        ----------
+        name : str
+            The name of the command, without the prefix.
+        handler : callable
+            The function to be called with each matching message.
+
+        """
+        self._handlers[name] = handler
+
+    def command(self, name):
+        """Return a decorator that registers a handler for a command.
+
+        Parameters
+        ----------
+        name : str
+            The name of the command, without the prefix.
+
+        Returns
+        -------
+        decorator : callable
+            A decorator which registers the decorated function as a handler.
+
+        """
+
+        def decorator(handler):
+            self.add_command(name, handler)
+            return handler
+
+        return decorator
+
+    def dispatch(self, message):
+        """Queue the specified message for its command's handler.
+
+        Parameters
+        ----------
+        message : namedtuple
+            A chat message, as returned by `Chat.listen`.
+
+        Returns
+        -------
+        queued : bool
+            True if the message matched a registered command.
+
+        """
+        route = self._route(message)
+        if route is None:
+            return False
+        key = message.conversation_id
+        with self._lock:
+            queue = self._queues.get(key)
+            idle = queue is None
+            if idle:
+                queue = self._queues[key] = deque()
+            queue.append(route + (message, time.monotonic()))
+            self._queue_depth += 1
+        if idle:
+            # Each conversation is drained by at most one worker at a time.
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._spawn, key)
+            else:
+                self._executor.submit(self._drain, key)
+        return True
+
+    def metrics(self):
+        """Return the bot's queue and handler statistics.
+
+        Returns
+        -------
+        metrics : dict
+            A dict containing the number of queued messages (`queue_depth`),
+            the number of conversations with queued messages
+            (`active_conversations`), and a dict of statistics for each
+            command (`handlers`), including the number of calls and errors,
+            the total and maximum handler latency, and the total time spent
+            queued, all in seconds.
+
+        """
+        with self._lock:
+            return {
+                "queue_depth": self._queue_depth,
+                "active_conversations": len(self._queues),
+                "handlers": {
+                    name: dict(stats) for name, stats in self._stats.items()
+                },
+            }
+
+    def reply(self, message, text):
+        """Send a reply to the conversation in which a message was received.
+
+        Parameters
+        ----------
+        message : namedtuple
+            The message being replied to.
+        text : str
+            The body of the reply.
+
+        Returns
+        -------
+        message_id : int
+            The ID of the reply.
+
+        """
+        return self._chat.send(message.channel._asdict(), text)
+
+    def run(self):
+        """Listen for chat messages and dispatch them until stopped.
+
+        Handlers are run on the bot's thread pool. This function blocks until
+        `Bot.stop` is called and the next message arrives, then waits for any
+        queued handlers to finish.
+
+        Raises
+        ------
+        BotException
+            If the bot is already running, a BotException is raised.
+
+        """
+        self._start()
+        messages = self._chat.listen()
+        try:
+            for message in messages:
+                if not self._running:
+                    break
+                self.dispatch(message)
+        finally:
+            messages.close()
+            self._running = False
+            self._executor.shutdown(wait=True)
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+
+    async def run_async(self):
+        """Listen for chat messages and dispatch them as asyncio tasks.
+
+        Coroutine handlers are awaited on the running event loop, while
+        regular handlers are run on the bot's thread pool. The coroutine
+        returns once `Bot.stop` is called and the next message arrives, and
+        any queued handlers have finished.
+
+        Raises
+        ------
+        BotException
+            If the bot is already running, a BotException is raised.
+
+        """
+        self._start()
+        self._loop = asyncio.get_event_loop()
+        messages = self._chat.listen()
+        try:
+            while self._running:
+                message = await self._loop.run_in_executor(
+                    None, next, messages, None
+                )
+                if message is None or not self._running:
+                    break
+                self.dispatch(message)
+        finally:
+            messages.close()
+            self._running = False
+            # Let scheduled workers start, then wait for them to finish.
+            await asyncio.sleep(0)
+            while self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._loop = None
+
+    def stop(self):
+        """Ask a running bot to stop listening for messages."""
+        self._running = False
+
+    def _spawn(self, key):
+        """Start a task draining a conversation's queue on the event loop.
+
+        Parameters
+        ----------
+        key : str
+            The ID of the conversation.
+
+        """
+        task = self._loop.create_task(self._drain_async(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _start(self):
+        """Mark the bot as running.
+
+        Raises
+        ------
+        BotException
+            If the bot is already running, a BotException is raised.
+
+        """
+        with self._lock:
+            if self._running:
+                raise BotException("The bot is already running.")
+            self._running = True
+
+    def _drain(self, key):
+        """Handle a conversation's queued messages on the thread pool.
+
+        Parameters
+        ----------
+        key : str
+            The ID of the conversation.
+
+        """
+        while 1:
+            item = self._next_item(key)
+            if item is None:
+                return
+            name, handler, args, message, queued_at = item
+            start = time.monotonic()
+            failed = False
+            try:
+                handler(message, args)
+            except Exception:
+                failed = True
+                _LOGGER.exception("Handler for %s failed.", name)
+            self._record(name, queued_at, start, failed)
+
+    async def _drain_async(self, key):
+        """Handle a conversation's queued messages on the event loop.
+
+        Parameters
+        ----------
+        key : str
+            The ID of the conversation.
+
+        """
+        loop = asyncio.get_event_loop()
+        while 1:
+            item = self._next_item(key)
+            if item is None:
+                return
+            name, handler, args, message, queued_at = item
+            start = time.monotonic()
+            failed = False
+            try:
+                if asyncio.iscoroutinefunction(handler):
+                    await handler(message, args)
+                else:
+                    await loop.run_in_executor(
+                        self._executor, handler, message, args
+                    )
+            except Exception:
+                failed = True
+                _LOGGER.exception("Handler for %s failed.", name)
+            self._record(name, queued_at, start, failed)
+
+    def _next_item(self, key):
+        """Pop the next queued message of a conversation.
+
+        If the conversation's queue is empty, it is removed, so the next
+        message to arrive will schedule a new worker.
+
+        Parameters
+        ----------
+        key : str
+            The ID of the conversation.
+
+        Returns
+        -------
+        item : tuple
+            The command name, handler, arguments, message and queue time, or
+            None if the queue is empty.
+
+        """
+        with self._lock:
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return None
+            self._queue_depth -= 1
+            return queue.popleft()
+
+    def _record(self, name, queued_at, start, failed):
+        """Record the outcome of a handler call.
+
+        Parameters
+        ----------
+        name : str
+            The name of the command.
+        queued_at : float
+            The monotonic time at which the message was queued.
+        start : float
+            The monotonic time at which the handler was called.
+        failed : bool
+            Whether the handler raised an exception.
+
+        """
+        elapsed = time.monotonic() - start
+        with self._lock:
+            stats = self._stats[name]
+            stats["calls"] += 1
+            stats["errors"] += int(failed)
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            stats["total_wait"] += start - queued_at
+
+    def _route(self, message):
+        """Find the handler for the specified message.
+
+        Parameters
+        ----------
+        message : namedtuple
+            A chat message.
+
+        Returns
+        -------
+        route : tuple
+            The command name, handler and arguments, or None if the message
+            isn't a command, or was sent by the active user.
+
+        """
+        content = getattr(message, "content", None)
+        if getattr(content, "type", None) != "text":
+            return None
+        sender = getattr(message, "sender", None)
+        if getattr(sender, "username", None) == self._keybase.username:
+            return None
+        words = content.text.body.split()
+        if not words or not words[0].startswith(self.prefix):
+            return None
+        name = words[0][len(self.prefix) :]
+        if name not in self._handlers:
+            return None
+        return (name, self._handlers[name], words[1:])
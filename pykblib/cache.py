@@ -0,0 +1,441 @@
+"""Defines the caches used by PyKBLib."""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from pykblib.api import remaining
+from pykblib.exceptions import CacheException, TimeoutException
+
+_MISSING = object()
+
+_LOGGER = logging.getLogger(__name__)
+
+_TEAM_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS team_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    fetched_at REAL,
+    lease_owner TEXT,
+    lease_until REAL
+);
+"""
+
+# The team API methods whose results change the cached team lists.
+_TEAM_LIST_METHODS = ("create-team", "leave-team", "rename-subteam")
+
+# The `keybase team` commands that don't change any team. Team API queries
+# are invalidated by `invalidate_for` instead.
+_TEAM_READ_COMMANDS = (
+    "api",
+    "list-members",
+    "list-memberships",
+    "list-requests",
+    "show-tree",
+)
+
+
+class TTLCache:
+    """A thread-safe least-recently-used cache whose entries expire.
+
+    Once the cache is full, adding an entry evicts the one that was used
+    least recently. Expired entries are dropped when they are next read.
+
+    Attributes
+    ----------
+    maxsize : int
+        The maximum number of entries held.
+    ttl : float
+        The default number of seconds for which an entry is kept.
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        """Initialize the TTLCache class.
+
+        Parameters
+        ----------
+        maxsize : int
+            The maximum number of entries held. *(Defaults to 1024.)*
+        ttl : float
+            The default number of seconds for which an entry is kept.
+            *(Defaults to 300.)*
+
+        """
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        """Return True if the key has an entry that hasn't expired."""
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        """Return the number of entries, including any that have expired."""
+        return len(self._entries)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key, default=None):
+        """Retrieve the value of an entry.
+
+        Parameters
+        ----------
+        key : object
+            The entry's key.
+        default : object
+            The value to return if there is no current entry. *(Defaults to
+            None.)*
+
+        Returns
+        -------
+        value : object
+            The entry's value, or the default.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expiry, value = entry
+            if time.monotonic() >= expiry:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def pop(self, key, default=None):
+        """Remove an entry, returning its value.
+
+        Parameters
+        ----------
+        key : object
+            The entry's key.
+        default : object
+            The value to return if there is no entry. *(Defaults to None.)*
+
+        Returns
+        -------
+        value : object
+            The entry's value, or the default.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Add or replace an entry.
+
+        Parameters
+        ----------
+        key : object
+            The entry's key.
+        value : object
+            The entry's value.
+        ttl : float
+            The number of seconds for which the entry is kept. *(Defaults to
+            the cache's TTL.)*
+
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SharedTeamCache:
+    """A cache of team membership and team lists shared between processes.
+
+    The cache is an SQLite database in WAL mode, so any number of processes
+    can read it without blocking each other, or the process writing to it.
+    Each entry records when it was fetched. An entry younger than `max_age`
+    is fresh, and is served as is. Once it's older, the first process to
+    need it takes a lease on it and fetches it again, while the others keep
+    receiving the previous value, as long as it's younger than `max_stale`,
+    or otherwise wait for the new one. A process that dies while refreshing
+    an entry loses its lease after `lease` seconds.
+
+    The cache is used by passing it to Keybase::
+
+        keybase = Keybase(team_cache=SharedTeamCache("/run/pykblib/teams.db"))
+
+    Entries are removed when any process using the cache changes a team, so
+    only changes made elsewhere can go unnoticed, for up to `max_age`
+    seconds.
+
+    Attributes
+    ----------
+    lease : float
+        The number of seconds a process may take to refresh an entry.
+    max_age : float
+        The number of seconds for which an entry is fresh.
+    max_stale : float
+        The number of seconds for which an entry may be served while another
+        process refreshes it.
+    path : str
+        The path of the SQLite database.
+    stats : dict
+        The number of fresh `hits`, `stale_hits` served during a refresh,
+        `misses` fetched by this process, and `waits` for another process.
+
+    """
+
+    def __init__(self, path, max_age=60, max_stale=300, lease=30):
+        """Open the cache, creating it if necessary.
+
+        Parameters
+        ----------
+        path : str
+            The path of the SQLite database, which must be on a local file
+            system.
+        max_age : float
+            The number of seconds for which an entry is fresh. *(Defaults to
+            60.)*
+        max_stale : float
+            The number of seconds for which an entry may be served while
+            another process refreshes it. *(Defaults to 300.)*
+        lease : float
+            The number of seconds a process may take to refresh an entry.
+            *(Defaults to 30.)*
+
+        Raises
+        ------
+        CacheException
+            If the database could not be opened, a CacheException is raised.
+
+        """
+        self._lock = threading.Lock()
+        self._owner = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+        try:
+            self._db = sqlite3.connect(
+                path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_TEAM_CACHE_SCHEMA)
+        except sqlite3.Error as error:
+            raise CacheException(
+                "Could not open team cache {}: {}".format(path, error)
+            )
+        self.lease = lease
+        self.max_age = max_age
+        self.max_stale = max_stale
+        self.path = path
+        self.stats = dict.fromkeys(
+            ["hits", "stale_hits", "misses", "waits"], 0
+        )
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def fetch(self, key, function):
+        """Return the value of an entry, refreshing it if necessary.
+
+        If the database can't be used, the error is logged, and the value is
+        fetched without the cache.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        function : callable
+            A function returning the entry's current value, as a string.
+
+        Returns
+        -------
+        value : str
+            The entry's value.
+
+        Raises
+        ------
+        TimeoutException
+            If the current deadline expires while waiting for another process
+            to refresh the entry, a TimeoutException is raised.
+
+        """
+        try:
+            return self._fetch(key, function)
+        except sqlite3.Error:
+            _LOGGER.exception("Could not use team cache %s.", self.path)
+            return function()
+
+    def invalidate(self, prefix):
+        """Remove every entry whose key starts with the specified prefix.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix, or a whole key.
+
+        """
+        try:
+            with self._lock:
+                self._db.execute(
+                    "DELETE FROM team_cache WHERE substr(key, 1, ?) = ?",
+                    (len(prefix), prefix),
+                )
+        except sqlite3.Error:
+            _LOGGER.exception("Could not use team cache %s.", self.path)
+
+    def invalidate_command(self, command):
+        """Remove the entries that a `keybase team` command may have changed.
+
+        Parameters
+        ----------
+        command : str
+            The command, without the leading `keybase`.
+
+        """
+        arguments = command.split()
+        if arguments[:1] != ["team"] or len(arguments) < 2:
+            return
+        if arguments[1] in _TEAM_READ_COMMANDS:
+            return
+        if len(arguments) > 2 and not arguments[2].startswith("-"):
+            self.invalidate_team(arguments[2])
+        self.invalidate("teams/")
+
+    def invalidate_for(self, query):
+        """Remove the entries that a team API query may have changed.
+
+        Parameters
+        ----------
+        query : dict
+            The query sent to the team API.
+
+        """
+        if self.key_for(query) is not None:
+            return
+        options = query.get("params", {}).get("options", {})
+        team = options.get("team")
+        if team:
+            self.invalidate_team(team)
+        if not team or query.get("method") in _TEAM_LIST_METHODS:
+            self.invalidate("teams/")
+
+    def invalidate_team(self, team_name):
+        """Remove the entries of the specified team and its sub-teams.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team.
+
+        """
+        key = "team/{}".format(team_name)
+        try:
+            with self._lock:
+                self._db.execute(
+                    "DELETE FROM team_cache WHERE key = ? "
+                    "OR substr(key, 1, ?) = ?",
+                    (key, len(key) + 1, key + "."),
+                )
+        except sqlite3.Error:
+            _LOGGER.exception("Could not use team cache %s.", self.path)
+
+    def key_for(self, query):
+        """Return the key of the entry holding a team API query's result.
+
+        Parameters
+        ----------
+        query : dict
+            The query sent to the team API.
+
+        Returns
+        -------
+        key : str
+            The key, or None if the query's result isn't cached.
+
+        """
+        options = query.get("params", {}).get("options", {})
+        method = query.get("method")
+        if method == "list-team-memberships" and options.get("team"):
+            return "team/{}".format(options["team"])
+        if method == "list-user-memberships" and options.get("username"):
+            return "teams/{}".format(options["username"])
+        return None
+
+    def _claim(self, key, now):
+        """Take the lease on a stale entry, returning True if successful."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO team_cache (key) VALUES (?)", (key,)
+            )
+            claimed = self._db.execute(
+                "UPDATE team_cache SET lease_owner = ?, lease_until = ? "
+                "WHERE key = ? "
+                "AND (lease_until IS NULL OR lease_until < ?) "
+                "AND (fetched_at IS NULL OR fetched_at < ?)",
+                (self._owner, now + self.lease, key, now, now - self.max_age),
+            ).rowcount
+        return claimed == 1
+
+    def _count(self, name):
+        """Increment one of the statistics."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def _fetch(self, key, function):
+        """Return the value of an entry, refreshing it if necessary."""
+        while 1:
+            now = time.time()
+            with self._lock:
+                entry = self._db.execute(
+                    "SELECT value, fetched_at FROM team_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+            value, fetched_at = entry if entry else (None, None)
+            age = None if fetched_at is None else now - fetched_at
+            if value is not None and age <= self.max_age:
+                self._count("hits")
+                return value
+            if self._claim(key, now):
+                self._count("misses")
+                return self._refresh(key, function)
+            # Another process is refreshing the entry.
+            if value is not None and age <= self.max_stale:
+                self._count("stale_hits")
+                return value
+            self._count("waits")
+            time_left = remaining()
+            if time_left is not None and time_left <= 0:
+                raise TimeoutException(
+                    "Timed out waiting for team cache entry {}.".format(key)
+                )
+            time.sleep(0.05 if time_left is None else min(0.05, time_left))
+
+    def _refresh(self, key, function):
+        """Fetch an entry's value while holding its lease, and store it."""
+        try:
+            value = function()
+        except BaseException:
+            with self._lock:
+                self._db.execute(
+                    "UPDATE team_cache SET lease_owner = NULL, "
+                    "lease_until = NULL WHERE key = ? AND lease_owner = ?",
+                    (key, self._owner),
+                )
+            raise
+        # If the entry was removed in the meantime, the value may predate a
+        # change to the team, so it isn't stored.
+        with self._lock:
+            self._db.execute(
+                "UPDATE team_cache SET value = ?, fetched_at = ?, "
+                "lease_owner = NULL, lease_until = NULL "
+                "WHERE key = ? AND lease_owner = ?",
+                (value, time.time(), key, self._owner),
+            )
+        return value
@@ -0,0 +1,460 @@
+"""Defines the RecordingTransport and ReplayTransport classes.
+
+A RecordingTransport wraps another backend, and writes each request made
+through it, along with the response and its timing, to a cassette file. A
+ReplayTransport then serves those responses back without contacting Keybase,
+so that `Keybase` and `Team` behaviour can be reproduced and profiled
+offline::
+
+    recorder = RecordingTransport("traffic.jsonl.gz")
+    keybase = Keybase(transport=recorder)
+    ...
+    recorder.close()
+
+    keybase = Keybase(transport=ReplayTransport("traffic.jsonl.gz", speed=10))
+
+Cassettes are JSON Lines files, compressed with gzip if their names end with
+`.gz`. Processes started with `open_process` stream arbitrary binary data,
+and are passed through to the backend without being recorded.
+
+"""
+
+import gzip
+import json
+import threading
+import time
+from collections import defaultdict, deque
+
+from pykblib.api import KeybaseAPI
+from pykblib.exceptions import APIException
+
+CASSETTE_VERSION = 1
+
+
+def _open(path, mode):
+    """Open a cassette file for reading or writing text.
+
+    Parameters
+    ----------
+    path : str
+        The path of the cassette file.
+    mode : str
+        Either "r" or "w".
+
+    Returns
+    -------
+    file : file
+        The opened text file.
+
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class RecordingTransport:
+    """Records the requests made to a backend, and its responses.
+
+    Attributes
+    ----------
+    backend : object
+        The transport or KeybaseAPI instance handling the requests.
+    path : str
+        The path of the cassette file.
+
+    """
+
+    def __init__(self, path, backend=None):
+        """Initialize the RecordingTransport class.
+
+        Parameters
+        ----------
+        path : str
+            The path of the cassette file, which is overwritten.
+        backend : object
+            The transport or KeybaseAPI instance that handles the requests.
+            *(Defaults to a KeybaseAPI using the keybase client.)*
+
+        """
+        self._file = _open(path, "w")
+        self._lock = threading.Lock()
+        self._next_stream = 1
+        self._start = time.monotonic()
+        self.backend = KeybaseAPI() if backend is None else backend
+        self.path = path
+        self._write({"version": CASSETTE_VERSION, "created": time.time()})
+
+    def __enter__(self):
+        """Allow the recorder to be used as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the cassette file."""
+        self.close()
+
+    def close(self):
+        """Finish writing the cassette file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def delete_team(self, team_name):
+        """Delete the specified team with the backend, recording the result.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team to be deleted.
+
+        Raises
+        ------
+        APIException
+            If the team cannot be deleted, an APIException is raised.
+
+        """
+        self._record("delete", team_name, self.backend.delete_team)
+
+    def open_process(self, arguments, stdin=None, stdout=None):
+        """Start a process with the backend, without recording it.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the keybase client.
+        stdin : int or file
+            The process's standard input. *(Defaults to None.)*
+        stdout : int or file
+            The process's standard output. *(Defaults to None.)*
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process.
+
+        """
+        return self.backend.open_process(arguments, stdin=stdin, stdout=stdout)
+
+    def run_command(self, command):
+        """Run a command with the backend, recording its output.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Returns
+        -------
+        output : str
+            The output of the command.
+
+        Raises
+        ------
+        APIException
+            If the command fails, an APIException is raised.
+
+        """
+        return self._record("run", command, self.backend.run_command)
+
+    def stream_lines(self, command):
+        """Stream a command's output from the backend, recording each line.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Yields
+        ------
+        line : str
+            Each line of the command's output.
+
+        """
+        with self._lock:
+            stream_id = self._next_stream
+            self._next_stream += 1
+        self._write(
+            {
+                "op": "stream",
+                "id": stream_id,
+                "command": command,
+                "at": self._now(),
+            }
+        )
+        try:
+            for line in self.backend.stream_lines(command):
+                self._write(
+                    {
+                        "op": "line",
+                        "id": stream_id,
+                        "at": self._now(),
+                        "line": line,
+                    }
+                )
+                yield line
+        finally:
+            self._write({"op": "end", "id": stream_id, "at": self._now()})
+
+    def _now(self):
+        """Return the number of seconds since recording started."""
+        return round(time.monotonic() - self._start, 6)
+
+    def _record(self, operation, argument, function):
+        """Call the backend, and record the request and its outcome.
+
+        Parameters
+        ----------
+        operation : str
+            The name of the operation, i.e. run or delete.
+        argument : str
+            The command or team name passed to the backend.
+        function : callable
+            The backend function to call.
+
+        Returns
+        -------
+        output : object
+            The backend's return value.
+
+        Raises
+        ------
+        APIException
+            If the backend raises an APIException, it is recorded and
+            re-raised.
+
+        """
+        started = self._now()
+        entry = {"op": operation, "command": argument, "at": started}
+        try:
+            output = function(argument)
+        except APIException as exception:
+            entry["error"] = exception.message
+            raise
+        else:
+            entry["output"] = output
+        finally:
+            entry["duration"] = round(self._now() - started, 6)
+            self._write(entry)
+        return output
+
+    def _write(self, entry):
+        """Append an entry to the cassette file.
+
+        Parameters
+        ----------
+        entry : dict
+            The entry to be written.
+
+        """
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+
+class ReplayTransport:
+    """Serves the responses recorded in a cassette.
+
+    Requests are matched by their operation and command. Repeated requests
+    receive the recorded responses in the order they were recorded, and
+    streams yield their recorded lines.
+
+    Attributes
+    ----------
+    path : str
+        The path of the cassette file.
+    repeat : bool
+        Whether to start over from the first recorded response once a
+        request's responses have been used up.
+    speed : float
+        The factor by which replay is faster than the recording, or None to
+        respond without delay.
+
+    """
+
+    def __init__(self, path, speed=1.0, repeat=False):
+        """Initialize the ReplayTransport class.
+
+        Parameters
+        ----------
+        path : str
+            The path of the cassette file.
+        speed : float
+            The factor by which replay is faster than the recording, e.g. 10
+            to respond ten times as fast, or None to respond without delay.
+            *(Defaults to 1.0, i.e. recorded speed.)*
+        repeat : bool
+            Whether to start over from the first recorded response once a
+            request's responses have been used up, rather than raise an
+            APIException. *(Defaults to False.)*
+
+        """
+        self._lock = threading.Lock()
+        self._recorded = defaultdict(list)
+        self._remaining = dict()
+        self.path = path
+        self.repeat = repeat
+        self.speed = speed
+        streams = dict()
+        with _open(path, "r") as cassette:
+            header = json.loads(cassette.readline() or "{}")
+            if header.get("version") != CASSETTE_VERSION:
+                raise APIException(
+                    "{} is not a version {} cassette.".format(
+                        path, CASSETTE_VERSION
+                    )
+                )
+            for line in cassette:
+                entry = json.loads(line)
+                operation = entry.get("op")
+                if operation in ("run", "delete"):
+                    self._recorded[(operation, entry["command"])].append(entry)
+                elif operation == "stream":
+                    entry["lines"] = list()
+                    streams[entry["id"]] = entry
+                    self._recorded[("stream", entry["command"])].append(entry)
+                elif operation == "line" and entry["id"] in streams:
+                    stream = streams[entry["id"]]
+                    stream["lines"].append(
+                        (entry["at"] - stream["at"], entry["line"])
+                    )
+        for key, entries in self._recorded.items():
+            self._remaining[key] = deque(entries)
+
+    def delete_team(self, team_name):
+        """Replay the deletion of a team.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team to be deleted.
+
+        Raises
+        ------
+        APIException
+            If the deletion failed when recorded, or wasn't recorded, an
+            APIException is raised.
+
+        """
+        self._respond(self._next("delete", team_name))
+
+    def open_process(self, arguments, stdin=None, stdout=None):
+        """Refuse to start a process, since processes aren't recorded.
+
+        Raises
+        ------
+        APIException
+            An APIException is always raised.
+
+        """
+        raise APIException(
+            "Processes are not recorded: {}".format(" ".join(arguments))
+        )
+
+    @property
+    def remaining(self):
+        """Return the number of recorded responses not yet served."""
+        with self._lock:
+            return sum(len(entries) for entries in self._remaining.values())
+
+    def run_command(self, command):
+        """Replay the output of a command.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Returns
+        -------
+        output : str
+            The recorded output.
+
+        Raises
+        ------
+        APIException
+            If the command failed when recorded, or wasn't recorded, an
+            APIException is raised.
+
+        """
+        return self._respond(self._next("run", command))
+
+    def stream_lines(self, command):
+        """Replay the lines of a stream, at their recorded times.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Yields
+        ------
+        line : str
+            Each recorded line of the command's output.
+
+        """
+        stream = self._next("stream", command)
+        started = time.monotonic()
+        for offset, line in stream["lines"]:
+            if self.speed:
+                delay = started + offset / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield line
+
+    def _next(self, operation, command):
+        """Retrieve the next recorded entry for a request.
+
+        Parameters
+        ----------
+        operation : str
+            The name of the operation, i.e. run, delete or stream.
+        command : str
+            The command or team name.
+
+        Returns
+        -------
+        entry : dict
+            The recorded entry.
+
+        Raises
+        ------
+        APIException
+            If there is no recorded entry left for the request, an
+            APIException is raised.
+
+        """
+        key = (operation, command)
+        with self._lock:
+            remaining = self._remaining.get(key)
+            if not remaining and self.repeat and self._recorded.get(key):
+                remaining = self._remaining[key] = deque(self._recorded[key])
+            if not remaining:
+                raise APIException(
+                    "No recorded response for {} {}".format(operation, command)
+                )
+            return remaining.popleft()
+
+    def _respond(self, entry):
+        """Wait for the recorded duration, then return the recorded output.
+
+        Parameters
+        ----------
+        entry : dict
+            The recorded entry.
+
+        Returns
+        -------
+        output : object
+            The recorded output.
+
+        Raises
+        ------
+        APIException
+            If the recorded request failed, an APIException is raised.
+
+        """
+        if self.speed:
+            time.sleep(entry.get("duration", 0) / self.speed)
+        if "error" in entry:
+            raise APIException(entry["error"])
+        return entry.get("output")
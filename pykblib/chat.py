@@ -0,0 +1,848 @@
+"""Defines the Chat class."""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from steffentools import dict_to_ntuple
+
+from pykblib.api import bind_deadline
+from pykblib.exceptions import (
+    APIException,
+    ChatException,
+    TimeoutException,
+)
+from pykblib.limits import TokenBucket
+
+_CHUNK_SIZE = 64 * 1024
+
+DeliveryResult = namedtuple(
+    "DeliveryResult", ["delivered", "message_id", "error"]
+)
+
+
+def _channel_options(channel):
+    """Convert a channel reference into options for the chat API.
+
+    Parameters
+    ----------
+    channel : str or dict
+        Either a channel name in the form `team_name#topic_name`, a team name
+        (which refers to the team's general channel), a comma-separated list
+        of usernames for a private conversation, or a raw Keybase channel
+        dict.
+
+    Returns
+    -------
+    options : dict
+        The options identifying the conversation in a chat API query.
+
+    """
+    if isinstance(channel, dict):
+        return {"channel": channel}
+    name, _, topic_name = channel.partition("#")
+    if "," in name:
+        return {"channel": {"name": name, "members_type": "impteamnative"}}
+    return {
+        "channel": {
+            "name": name,
+            "members_type": "team",
+            "topic_name": topic_name or "general",
+        }
+    }
+
+
+def _directory_key(spec):
+    """Return the key under which a channel is kept in the directory.
+
+    Parameters
+    ----------
+    spec : dict
+        A Keybase channel dict.
+
+    Returns
+    -------
+    key : tuple
+        The channel's name and topic name. The topic name of a team channel
+        defaults to `general`, and is None for private conversations.
+
+    """
+    topic_name = spec.get("topic_name") or None
+    if spec.get("members_type") == "team":
+        topic_name = topic_name or "general"
+    return (spec["name"], topic_name)
+
+
+class Chat:
+    """Provides an interface to the Keybase chat service.
+
+    Channels may be referred to as `team_name#topic_name`, as a bare team name
+    (which refers to the team's general channel), or as a comma-separated list
+    of usernames for private conversations.
+
+    Conversation IDs are resolved through a directory that is loaded from
+    Keybase on first use and kept up to date by `Chat.listen`, so that chat
+    queries can address conversations by ID instead of by name.
+
+    Attributes
+    ----------
+    max_transfers : int
+        The maximum number of attachment uploads and downloads that may run at
+        once. Changing it only takes effect before the first transfer.
+
+    """
+
+    def __init__(self, keybase_instance):
+        """Initialize the Chat class.
+
+        Parameters
+        ----------
+        keybase_instance : Keybase
+            The Keybase object that spawned this Chat.
+
+        """
+        self._api = keybase_instance._api
+        self._keybase = keybase_instance
+        self._conversations = dict()
+        self._directory_loaded = False
+        self._directory_lock = threading.Lock()
+        self._listed_teams = set()
+        self._transfer_lock = threading.Lock()
+        self._transfer_pool = None
+        self.max_transfers = 4
+
+    def broadcast(
+        self, message, targets=None, max_workers=8, rate=None, results=None
+    ):
+        """Send a message to many channels concurrently.
+
+        Parameters
+        ----------
+        message : str
+            The body of the message.
+        targets : list
+            The names of the channels to which the message should be sent.
+            *(Defaults to the general channel of every team in
+            `Keybase.teams`.)*
+        max_workers : int
+            The maximum number of messages sent at once. *(Defaults to 8.)*
+        rate : float
+            If specified, the maximum number of messages sent per second.
+            *(Defaults to None.)*
+        results : dict
+            The results of an earlier, partially completed broadcast of the
+            same message. Targets to which it was already delivered are
+            skipped. The dict is updated in place as each delivery finishes,
+            so it remains usable for resuming even if this broadcast is
+            interrupted. *(Defaults to None.)*
+
+        Returns
+        -------
+        results : dict
+            A dict with the targets for keys and `DeliveryResult` namedtuples
+            as values, in the order the targets were given. A message that
+            timed out is reported as undelivered, although it may have been
+            sent, so resuming the broadcast may send it twice.
+
+        """
+        if targets is None:
+            targets = list(self._keybase.teams)
+        if results is None:
+            results = dict()
+        pending = [
+            target
+            for target in targets
+            if not getattr(results.get(target), "delivered", False)
+        ]
+        bucket = TokenBucket(rate) if rate else None
+
+        def deliver(target):
+            try:
+                if bucket is not None:
+                    bucket.acquire()
+                return DeliveryResult(True, self.send(target, message), None)
+            except (ChatException, TimeoutException) as exception:
+                return DeliveryResult(False, None, exception.message)
+
+        deliver = bind_deadline(deliver)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(deliver, target): target for target in pending
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return {target: results[target] for target in targets}
+
+    def conversation_id(self, channel):
+        """Return the conversation ID of the specified channel.
+
+        The first lookup loads the active user's conversations, and the first
+        lookup of a team channel that isn't among them loads all of that
+        team's channels. All other lookups are answered from memory.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel whose conversation ID should be returned.
+
+        Returns
+        -------
+        conversation_id : str
+            The ID of the conversation, or None if it could not be found.
+
+        Raises
+        ------
+        ChatException
+            If the conversations could not be retrieved from Keybase, a
+            ChatException is raised.
+
+        """
+        spec = _channel_options(channel)["channel"]
+        key = _directory_key(spec)
+        with self._directory_lock:
+            if not self._directory_loaded:
+                self._load_conversations({"method": "list"})
+                self._directory_loaded = True
+            if (
+                key not in self._conversations
+                and spec.get("members_type") == "team"
+                and spec["name"] not in self._listed_teams
+            ):
+                self._load_conversations(
+                    {
+                        "method": "listconvsonname",
+                        "params": {
+                            "options": {
+                                "name": spec["name"],
+                                "members_type": "team",
+                                "topic_type": "CHAT",
+                            }
+                        },
+                    }
+                )
+                self._listed_teams.add(spec["name"])
+            return self._conversations.get(key)
+
+    def download(self, message, dest, progress=None, wait=True):
+        """Download the attachment of the specified message.
+
+        When `dest` is a path, the keybase client writes the attachment
+        straight to disk. When it is a writable binary stream, such as a pipe,
+        the attachment is copied into it in fixed-size chunks. In neither case
+        is the whole attachment held in memory.
+
+        Parameters
+        ----------
+        message : namedtuple
+            The attachment message, as returned by `Chat.iter_history` or
+            `Chat.listen`.
+        dest : str or file
+            The path of the file to write, or a writable binary stream.
+        progress : callable
+            If specified, this is called as `progress(transferred, total)` as
+            the download proceeds. The total is None if the attachment's size
+            is unknown. *(Defaults to None.)*
+        wait : bool
+            If False, the download is queued and a `concurrent.futures.Future`
+            is returned instead of waiting for it to finish. *(Defaults to
+            True.)*
+
+        Raises
+        ------
+        ChatException
+            If the attachment could not be downloaded, a ChatException is
+            raised.
+
+        """
+        future = self._transfers().submit(
+            bind_deadline(self._download), message, dest, progress
+        )
+        return future if not wait else future.result()
+
+    def iter_history(self, channel, page_size=100, since=None, cursor=None):
+        """Lazily iterate over the history of the specified channel.
+
+        Messages are returned newest first. Pages are only requested from
+        Keybase as they are needed, and the next page is fetched in the
+        background while the current page is being consumed.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel whose history should be read.
+        page_size : int
+            The number of messages to request per page. *(Defaults to 100.)*
+        since : float
+            If specified, iteration stops at the first message sent before
+            this Unix timestamp. *(Defaults to None.)*
+        cursor : tuple
+            A value previously read from `ChatHistory.cursor`, used to resume
+            iteration where it left off. *(Defaults to None.)*
+
+        Returns
+        -------
+        ChatHistory
+            An iterator over the channel's messages.
+
+        """
+        return ChatHistory(
+            self._api,
+            self._conversation_options(channel),
+            page_size,
+            since,
+            cursor,
+        )
+
+    def listen(self, store=None):
+        """Yield chat messages as they are received by the active user.
+
+        The underlying `keybase chat api-listen` process keeps running until
+        the generator is closed.
+
+        Parameters
+        ----------
+        store : MessageStore
+            If specified, each message is added to this store as it arrives.
+            *(Defaults to None.)*
+
+        Yields
+        ------
+        message : namedtuple
+            Each chat message, in the same form as returned by
+            `Chat.iter_history`.
+
+        """
+        for line in self._api.stream_lines("chat api-listen"):
+            try:
+                notification = json.loads(line)
+            except ValueError:
+                # Status lines are interleaved with the notifications.
+                continue
+            if notification.get("type") != "chat" or "msg" not in notification:
+                continue
+            message = dict_to_ntuple(notification["msg"])
+            self._remember(message.conversation_id, message.channel)
+            if store is not None:
+                store.add([message])
+            yield message
+
+    def refresh_conversations(self):
+        """Reload the conversation directory from Keybase.
+
+        Raises
+        ------
+        ChatException
+            If the conversations could not be retrieved from Keybase, a
+            ChatException is raised.
+
+        """
+        with self._directory_lock:
+            self._conversations.clear()
+            self._listed_teams.clear()
+            self._load_conversations({"method": "list"})
+            self._directory_loaded = True
+
+    def send(self, channel, message):
+        """Send a text message to the specified channel.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel to which the message should be sent.
+        message : str
+            The body of the message.
+
+        Returns
+        -------
+        message_id : int
+            The ID of the message that was sent.
+
+        Raises
+        ------
+        ChatException
+            If the message could not be sent, a ChatException is raised.
+
+        """
+        options = self._conversation_options(channel)
+        options["message"] = {"body": message}
+        query = {"method": "send", "params": {"options": options}}
+        try:
+            response = self._api.call_api("chat", query)
+        except APIException:
+            raise ChatException(
+                "Could not send message to {}.".format(channel)
+            )
+        return getattr(response.result, "id", None)
+
+    def sync(self, channel, store, page_size=100):
+        """Copy any new messages in the specified channel into a store.
+
+        The channel's history is read newest first, stopping at the store's
+        high-water mark for the conversation, so only messages that have not
+        yet been synced are fetched.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel to be synced.
+        store : MessageStore
+            The store into which the messages are copied.
+        page_size : int
+            The number of messages to request per page. *(Defaults to 100.)*
+
+        Returns
+        -------
+        count : int
+            The number of messages newly added to the store.
+
+        Raises
+        ------
+        ChatException
+            If the channel's history could not be read, a ChatException is
+            raised. Any messages stored before the failure are kept, and the
+            next sync will pick up where this one stopped.
+
+        """
+        count = 0
+        newest = None
+        high_water = 0
+        batch = list()
+        with self.iter_history(channel, page_size=page_size) as history:
+            for message in history:
+                if newest is None:
+                    newest = message
+                    high_water = store.high_water(message.conversation_id)
+                if message.id <= high_water:
+                    break
+                batch.append(message)
+                if len(batch) >= page_size:
+                    count += store.add(batch)
+                    batch = list()
+        count += store.add(batch)
+        if newest is not None:
+            store.mark_synced(newest.conversation_id, newest.id)
+        return count
+
+    def upload(self, channel, source, title=None, progress=None, wait=True):
+        """Upload a file to the specified channel as an attachment.
+
+        When `source` is a path, the keybase client reads the file straight
+        from disk. When it is a readable binary stream, such as a pipe, it is
+        spooled to a temporary file in fixed-size chunks first, as the keybase
+        client can only attach seekable files.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel to which the attachment should be sent.
+        source : str or file
+            The path of the file to upload, or a readable binary stream.
+        title : str
+            The title of the attachment. *(Defaults to None.)*
+        progress : callable
+            If specified, this is called as `progress(transferred, total)` as
+            the upload proceeds. *(Defaults to None.)*
+        wait : bool
+            If False, the upload is queued and a `concurrent.futures.Future`
+            is returned instead of waiting for it to finish. *(Defaults to
+            True.)*
+
+        Returns
+        -------
+        message_id : int
+            The ID of the attachment message.
+
+        Raises
+        ------
+        ChatException
+            If the attachment could not be uploaded, a ChatException is
+            raised.
+
+        """
+        future = self._transfers().submit(
+            bind_deadline(self._upload), channel, source, title, progress
+        )
+        return future if not wait else future.result()
+
+    def _conversation_options(self, channel):
+        """Return the chat API options addressing a channel.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel to be addressed.
+
+        Returns
+        -------
+        options : dict
+            The options, using the conversation ID if it is known, or the
+            channel's name otherwise.
+
+        """
+        try:
+            conversation_id = self.conversation_id(channel)
+        except ChatException:
+            conversation_id = None
+        if conversation_id is None:
+            return _channel_options(channel)
+        return {"conversation_id": conversation_id}
+
+    def _download(self, message, dest, progress):
+        """Download an attachment on the calling thread.
+
+        Parameters
+        ----------
+        message : namedtuple
+            The attachment message.
+        dest : str or file
+            The path of the file to write, or a writable binary stream.
+        progress : callable
+            The progress callback, or None.
+
+        """
+        attachment = getattr(message.content, "attachment", None)
+        total = getattr(getattr(attachment, "object", None), "size", None)
+        if isinstance(dest, (str, bytes, os.PathLike)):
+            query = {
+                "method": "download",
+                "params": {
+                    "options": {
+                        "conversation_id": message.conversation_id,
+                        "message_id": message.id,
+                        "output": os.fsdecode(dest),
+                    }
+                },
+            }
+            finished = threading.Event()
+            if progress is not None:
+                threading.Thread(
+                    target=_watch_file,
+                    args=(dest, total, progress, finished),
+                    daemon=True,
+                ).start()
+            try:
+                self._api.call_api("chat", query)
+            except APIException:
+                raise ChatException(
+                    "Could not download attachment {}.".format(message.id)
+                )
+            finally:
+                finished.set()
+            if progress is not None:
+                size = os.path.getsize(dest)
+                progress(size, size)
+            return
+        arguments = ["chat", "download"]
+        channel = message.channel
+        if getattr(channel, "members_type", None) == "team":
+            arguments += ["--channel", channel.topic_name]
+        arguments += [channel.name, str(message.id)]
+        try:
+            process = self._api.open_process(arguments, stdout=subprocess.PIPE)
+        except APIException:
+            raise ChatException(
+                "Could not download attachment {}.".format(message.id)
+            )
+        transferred = 0
+        with process:
+            for chunk in iter(lambda: process.stdout.read(_CHUNK_SIZE), b""):
+                dest.write(chunk)
+                transferred += len(chunk)
+                if progress is not None:
+                    progress(transferred, total)
+            error = process.stderr.read()
+        if process.returncode:
+            raise ChatException(
+                "Could not download attachment {}: {}".format(
+                    message.id, error.decode().strip()
+                )
+            )
+
+    def _load_conversations(self, query):
+        """Add the conversations returned by a chat API query to the directory.
+
+        Parameters
+        ----------
+        query : dict
+            A `list` or `listconvsonname` query.
+
+        Raises
+        ------
+        ChatException
+            If the query fails, a ChatException is raised.
+
+        """
+        try:
+            response = self._api.call_api("chat", query)
+        except APIException:
+            raise ChatException("Could not retrieve the conversation list.")
+        for conversation in response.result.conversations or list():
+            self._remember(conversation.id, conversation.channel)
+
+    def _remember(self, conversation_id, channel):
+        """Record the conversation ID of a channel in the directory.
+
+        Parameters
+        ----------
+        conversation_id : str
+            The ID of the conversation.
+        channel : namedtuple
+            The channel information returned by Keybase.
+
+        """
+        self._conversations[_directory_key(channel._asdict())] = (
+            conversation_id
+        )
+
+    def _transfers(self):
+        """Return the thread pool that limits concurrent transfers."""
+        with self._transfer_lock:
+            if self._transfer_pool is None:
+                self._transfer_pool = ThreadPoolExecutor(
+                    max_workers=self.max_transfers
+                )
+            return self._transfer_pool
+
+    def _upload(self, channel, source, title, progress):
+        """Upload an attachment on the calling thread.
+
+        Parameters
+        ----------
+        channel : str or dict
+            The channel to which the attachment should be sent.
+        source : str or file
+            The path of the file to upload, or a readable binary stream.
+        title : str
+            The title of the attachment, or None.
+        progress : callable
+            The progress callback, or None.
+
+        Returns
+        -------
+        message_id : int
+            The ID of the attachment message.
+
+        """
+        spool_dir = None
+        try:
+            if not isinstance(source, (str, bytes, os.PathLike)):
+                spool_dir = tempfile.mkdtemp(prefix="pykblib-")
+                # Pipes are named by their file descriptor.
+                name = getattr(source, "name", None)
+                if not isinstance(name, (str, bytes)):
+                    name = ""
+                name = os.path.basename(os.fsdecode(name))
+                path = os.path.join(spool_dir, name or "attachment")
+                transferred = 0
+                with open(path, "wb") as spool:
+                    for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+                        spool.write(chunk)
+                        transferred += len(chunk)
+                        if progress is not None:
+                            progress(transferred, None)
+            else:
+                path = os.fsdecode(source)
+            total = os.path.getsize(path)
+            options = self._conversation_options(channel)
+            options["filename"] = path
+            if title is not None:
+                options["title"] = title
+            query = {"method": "attach", "params": {"options": options}}
+            try:
+                response = self._api.call_api("chat", query)
+            except APIException:
+                raise ChatException(
+                    "Could not upload {} to {}.".format(path, channel)
+                )
+            if progress is not None:
+                progress(total, total)
+            return getattr(response.result, "id", None)
+        finally:
+            if spool_dir is not None:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def _watch_file(path, total, progress, finished, interval=0.5):
+    """Report the growth of a file being written by another process.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file being written.
+    total : int
+        The expected final size of the file, or None.
+    progress : callable
+        The callback to be called as `progress(transferred, total)`.
+    finished : threading.Event
+        The event that is set once the file is complete.
+    interval : float
+        The number of seconds between checks. *(Defaults to 0.5.)*
+
+    """
+    last_size = 0
+    while not finished.wait(interval):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if size != last_size:
+            last_size = size
+            progress(size, total)
+
+
+class ChatHistory:
+    """A lazy, prefetching iterator over a channel's message history.
+
+    Attributes
+    ----------
+    cursor : tuple
+        A `(page_token, offset)` pair identifying the next unread message. It
+        can be saved and passed to `Chat.iter_history` to resume iteration.
+
+    """
+
+    def __init__(self, api, options, page_size, since=None, cursor=None):
+        """Initialize the ChatHistory iterator.
+
+        Parameters
+        ----------
+        api : KeybaseAPI
+            The API instance used to read the messages.
+        options : dict
+            The chat API options identifying the conversation.
+        page_size : int
+            The number of messages to request per page.
+        since : float
+            The Unix timestamp at which to stop iterating. *(Defaults to
+            None.)*
+        cursor : tuple
+            The `(page_token, offset)` pair at which to resume iteration.
+            *(Defaults to None.)*
+
+        """
+        self._api = api
+        self._options = options
+        self._page_size = page_size
+        self._since = since
+        if cursor is None or isinstance(cursor, str):
+            cursor = (cursor, 0)
+        self._token, self._index = cursor[0], cursor[1]
+        self._next_token = self._token
+        self._page = None
+        self._done = False
+        self._error = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Prefetches stay within the deadline of the code iterating.
+        self._pending = self._executor.submit(
+            bind_deadline(self._fetch), self._next_token
+        )
+
+    def __enter__(self):
+        """Allow the iterator to be used as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stop iterating and release the prefetching thread."""
+        self.close()
+
+    def __iter__(self):
+        """Return this iterator."""
+        return self
+
+    def __next__(self):
+        """Return the next message in the channel's history.
+
+        Raises
+        ------
+        ChatException
+            If a page of messages could not be read from Keybase. Once that
+            happens, every later call raises the same exception, so that an
+            incomplete history can't be mistaken for a complete one.
+
+        """
+        if self._error is not None:
+            raise self._error
+        while not self._done:
+            if self._index >= len(self._page or []):
+                self._advance()
+                continue
+            entry = self._page[self._index]
+            self._index += 1
+            message = getattr(entry, "msg", None)
+            if message is None:
+                # Messages that Keybase failed to unbox carry an error instead.
+                continue
+            if self._since is not None and message.sent_at < self._since:
+                self.close()
+                break
+            return message
+        raise StopIteration
+
+    @property
+    def cursor(self):
+        """Return the position of the next unread message."""
+        return (self._token, self._index)
+
+    def close(self):
+        """Stop iterating and discard any prefetched page."""
+        self._done = True
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._executor.shutdown(wait=False)
+
+    def _advance(self):
+        """Move on to the next page, then start prefetching the one after."""
+        if self._pending is None:
+            self.close()
+            return
+        try:
+            messages, pagination = self._pending.result()
+        except Exception as exception:
+            self._error = exception
+            raise
+        finally:
+            self._pending = None
+        if self._page is not None:
+            self._token, self._index = self._next_token, 0
+        self._page = messages or list()
+        next_token = getattr(pagination, "next", None)
+        if self._page and next_token and not getattr(pagination, "last", 0):
+            self._next_token = next_token
+            self._pending = self._executor.submit(
+                bind_deadline(self._fetch), next_token
+            )
+
+    def _fetch(self, token):
+        """Retrieve a single page of messages.
+
+        Parameters
+        ----------
+        token : str
+            The pagination token of the page to retrieve, or None to retrieve
+            the most recent page.
+
+        Returns
+        -------
+        page : tuple
+            The list of message entries and the pagination information.
+
+        """
+        pagination = {"num": self._page_size}
+        if token:
+            pagination["next"] = token
+        options = dict(self._options, pagination=pagination, peek=True)
+        query = {"method": "read", "params": {"options": options}}
+        try:
+            response = self._api.call_api("chat", query)
+        except APIException:
+            raise ChatException("Could not read channel history.")
+        return (
+            response.result.messages,
+            getattr(response.result, "pagination", None),
+        )
@@ -0,0 +1,707 @@
+"""Defines the Crypto class."""
+
+import functools
+import io
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.api import bind_deadline, remaining
+from pykblib.exceptions import (
+    APIException,
+    CryptoException,
+    TimeoutException,
+)
+
+CHUNK_SIZE = 64 * 1024
+CHUNK_MAGIC = b"PYKBLIB-CHUNKED-SALTPACK-1\n"
+_FRAME_HEADER = struct.Struct(">Q")
+
+VerifyResult = namedtuple("VerifyResult", ["valid", "message", "error"])
+
+
+def _iter_blocks(source, block_size):
+    """Yield the data from a source in blocks of a fixed size.
+
+    Parameters
+    ----------
+    source : bytes, file or iterable
+        A bytes object, a readable binary stream, or an iterable of bytes
+        objects.
+    block_size : int
+        The size of each block. Only the last block may be shorter.
+
+    Yields
+    ------
+    block : bytes
+        Each successive block of data.
+
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), block_size):
+            yield bytes(view[start : start + block_size])
+        return
+    if hasattr(source, "read"):
+        for block in iter(lambda: source.read(block_size), b""):
+            yield block
+        return
+    pending = bytearray()
+    for data in source:
+        pending += data
+        while len(pending) >= block_size:
+            yield bytes(pending[:block_size])
+            del pending[:block_size]
+    if pending:
+        yield bytes(pending)
+
+
+def _read_exactly(stream, size):
+    """Read exactly the specified number of bytes from a stream.
+
+    Parameters
+    ----------
+    stream : file
+        A readable binary stream.
+    size : int
+        The number of bytes to read.
+
+    Returns
+    -------
+    data : bytes
+        The data read, or an empty bytes object at the end of the stream.
+
+    Raises
+    ------
+    CryptoException
+        If the stream ends partway through, a CryptoException is raised.
+
+    """
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    if data and len(data) < size:
+        raise CryptoException("The chunked stream is truncated.")
+    return bytes(data)
+
+
+class Crypto:
+    """Streams data through the Keybase encryption and signing tools.
+
+    Every function accepts its input as a bytes object, a readable binary
+    stream, or an iterable of bytes objects, and returns a `CryptoReader`
+    from which the output can be read as it is produced. Inputs are fed to
+    the keybase client in fixed-size chunks, so neither the input nor the
+    output is ever held in memory in its entirety.
+
+    Very large inputs can be split into independent saltpack messages of
+    `chunk_size` bytes, which are then processed by several keybase client
+    processes at once. The resulting stream is framed, and must be read back
+    with `chunked=True`.
+
+    """
+
+    def __init__(self, keybase_instance):
+        """Initialize the Crypto class.
+
+        Parameters
+        ----------
+        keybase_instance : Keybase
+            The Keybase object that spawned this Crypto.
+
+        """
+        self._api = keybase_instance._api
+        self._keybase = keybase_instance
+
+    def decrypt(self, source, chunked=False, workers=4):
+        """Decrypt a saltpack message.
+
+        Parameters
+        ----------
+        source : bytes, file or iterable
+            The encrypted message, either binary or armored.
+        chunked : bool
+            Whether the message was produced by `Crypto.encrypt` with a
+            `chunk_size`. *(Defaults to False.)*
+        workers : int
+            The number of chunks decrypted at once, when chunked. *(Defaults
+            to 4.)*
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the decrypted data.
+
+        """
+        if chunked:
+            return self._unchunked(["decrypt"], source, workers)
+        return self._pipe(["decrypt"], source)
+
+    def encrypt(
+        self, source, recipients=(), team=None, chunk_size=None, workers=4
+    ):
+        """Encrypt data for the specified users or team.
+
+        Parameters
+        ----------
+        source : bytes, file or iterable
+            The data to encrypt.
+        recipients : list
+            The usernames of the recipients. *(Defaults to none, in which case
+            the data is only encrypted for the active user.)*
+        team : str
+            The name of a team to encrypt for. *(Defaults to None.)*
+        chunk_size : int
+            If specified, the data is split into independently encrypted
+            messages of this many bytes, which are encrypted in parallel.
+            *(Defaults to None.)*
+        workers : int
+            The number of chunks encrypted at once, when chunked. *(Defaults
+            to 4.)*
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the binary saltpack output.
+
+        """
+        arguments = ["encrypt", "--binary"]
+        if team is not None:
+            arguments += ["--team", team]
+        arguments += list(recipients)
+        if chunk_size:
+            return self._chunked(arguments, source, chunk_size, workers)
+        return self._pipe(arguments, source)
+
+    def sign(self, source, detached=False, chunk_size=None, workers=4):
+        """Sign data as the active user.
+
+        Parameters
+        ----------
+        source : bytes, file or iterable
+            The data to sign.
+        detached : bool
+            Whether to produce only a detached signature. *(Defaults to
+            False.)*
+        chunk_size : int
+            If specified, the data is split into independently signed messages
+            of this many bytes, which are signed in parallel. This cannot be
+            combined with detached signatures. *(Defaults to None.)*
+        workers : int
+            The number of chunks signed at once, when chunked. *(Defaults to
+            4.)*
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the binary saltpack output.
+
+        Raises
+        ------
+        CryptoException
+            If both `detached` and `chunk_size` are specified, a
+            CryptoException is raised.
+
+        """
+        arguments = ["sign", "--binary"]
+        if detached:
+            if chunk_size:
+                raise CryptoException("Detached signatures can't be chunked.")
+            arguments.append("--detached")
+        if chunk_size:
+            return self._chunked(arguments, source, chunk_size, workers)
+        return self._pipe(arguments, source)
+
+    def sign_many(self, messages, detached=False, workers=8):
+        """Sign each of many small messages.
+
+        The keybase client has no long-running signing mode, so each message
+        still needs its own process. The processes run on a pool of workers
+        so that their start-up overlaps, and the signatures are produced in
+        the order of the messages.
+
+        Parameters
+        ----------
+        messages : iterable
+            The messages to sign, as bytes objects. The iterable is consumed
+            lazily, so it may be a generator of unbounded length.
+        detached : bool
+            Whether to produce only detached signatures. *(Defaults to
+            False.)*
+        workers : int
+            The number of messages signed at once. *(Defaults to 8.)*
+
+        Yields
+        ------
+        signature : bytes
+            The binary saltpack output for each message.
+
+        Raises
+        ------
+        CryptoException
+            If a message could not be signed, a CryptoException is raised.
+
+        """
+        arguments = ["sign", "--binary"]
+        if detached:
+            arguments.append("--detached")
+        run = functools.partial(self._run, arguments)
+        for signature in self._map_ordered(run, messages, workers):
+            yield signature
+
+    def verify(self, source, signature=None, chunked=False, workers=4):
+        """Verify a signed message.
+
+        Parameters
+        ----------
+        source : bytes, file or iterable
+            The signed message or, if a detached signature is given, the
+            signed data.
+        signature : bytes
+            A detached signature. *(Defaults to None.)*
+        chunked : bool
+            Whether the message was produced by `Crypto.sign` with a
+            `chunk_size`. *(Defaults to False.)*
+        workers : int
+            The number of chunks verified at once, when chunked. *(Defaults
+            to 4.)*
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the verified message. With a detached
+            signature it produces no data. Either way, verification failures
+            are raised as a CryptoException once the reader is exhausted or
+            closed, so the output must not be trusted until then.
+
+        """
+        if signature is None:
+            if chunked:
+                return self._unchunked(["verify"], source, workers)
+            return self._pipe(["verify"], source)
+        descriptor, path = tempfile.mkstemp(prefix="pykblib-")
+        with os.fdopen(descriptor, "wb") as target:
+            target.write(signature)
+        reader = self._pipe(["verify", "--detached", path], source)
+        reader._cleanup.append(lambda: os.remove(path))
+        return reader
+
+    def verify_many(self, messages, workers=8):
+        """Verify each of many small signed messages.
+
+        Like `Crypto.sign_many`, the messages are verified on a pool of
+        workers, and the results are produced in order. A failed verification
+        doesn't stop the batch.
+
+        Parameters
+        ----------
+        messages : iterable
+            The signed messages, as bytes objects, or as (data, signature)
+            tuples for detached signatures.
+        workers : int
+            The number of messages verified at once. *(Defaults to 8.)*
+
+        Yields
+        ------
+        result : VerifyResult
+            A named tuple for each message, containing `valid`, the verified
+            `message` (or the signed data, for detached signatures), and the
+            `error` reported by the keybase client, if any.
+
+        """
+        for result in self._map_ordered(self._verify_one, messages, workers):
+            yield result
+
+    def _chunked(self, arguments, source, chunk_size, workers):
+        """Process a source as independent, framed chunks.
+
+        Parameters
+        ----------
+        arguments : list
+            The keybase client arguments used for each chunk.
+        source : bytes, file or iterable
+            The data to process.
+        chunk_size : int
+            The size of each chunk of input.
+        workers : int
+            The number of chunks processed at once.
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the framed output.
+
+        """
+
+        def frames():
+            yield CHUNK_MAGIC
+            blocks = _iter_blocks(source, chunk_size)
+            run = functools.partial(self._run, arguments)
+            for output in self._map_ordered(run, blocks, workers):
+                yield _FRAME_HEADER.pack(len(output))
+                yield output
+
+        return CryptoReader(frames())
+
+    def _map_ordered(self, function, inputs, workers):
+        """Apply a function to each input on a pool, yielding results in order.
+
+        At most twice as many inputs as there are workers are held in memory
+        at any one time.
+
+        Parameters
+        ----------
+        function : callable
+            The function to apply, which typically runs a keybase command.
+        inputs : iterable
+            The data for each call to the function.
+        workers : int
+            The number of calls run at once.
+
+        Yields
+        ------
+        output : object
+            The result of each call, in the order of the inputs.
+
+        """
+        function = bind_deadline(function)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for data in inputs:
+                    pending.append(pool.submit(function, data))
+                    if len(pending) >= workers * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _pipe(self, arguments, source):
+        """Stream a source through a single keybase client process.
+
+        Parameters
+        ----------
+        arguments : list
+            The keybase client arguments.
+        source : bytes, file or iterable
+            The data to be written to the process's standard input.
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the process's standard output.
+
+        """
+        process = self._spawn(arguments)
+
+        def feed():
+            try:
+                for block in _iter_blocks(source, CHUNK_SIZE):
+                    process.stdin.write(block)
+            except (BrokenPipeError, ValueError):
+                # The process exited, or the reader was closed early.
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        def finish(complete):
+            if not complete:
+                process.kill()
+            feeder.join()
+            error = process.stderr.read()
+            process.stdout.close()
+            process.stderr.close()
+            if process.wait() and complete:
+                raise CryptoException(
+                    "keybase {} failed: {}".format(
+                        arguments[0], error.decode().strip()
+                    )
+                )
+
+        return CryptoReader(
+            iter(lambda: process.stdout.read(CHUNK_SIZE), b""), finish
+        )
+
+    def _run(self, arguments, data):
+        """Run a keybase client process on a single chunk of data.
+
+        Parameters
+        ----------
+        arguments : list
+            The keybase client arguments.
+        data : bytes
+            The data to be written to the process's standard input.
+
+        Returns
+        -------
+        output : bytes
+            The process's standard output.
+
+        Raises
+        ------
+        CryptoException
+            If the process fails, a CryptoException is raised.
+        TimeoutException
+            If the current deadline expires, the process is killed, and a
+            TimeoutException is raised.
+
+        """
+        process = self._spawn(arguments)
+        try:
+            output, error = process.communicate(data, timeout=remaining())
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise TimeoutException(
+                "keybase {} timed out.".format(arguments[0])
+            )
+        if process.returncode:
+            raise CryptoException(
+                "keybase {} failed: {}".format(
+                    arguments[0], error.decode().strip()
+                )
+            )
+        return output
+
+    def _spawn(self, arguments):
+        """Start a keybase client process with piped input and output.
+
+        Parameters
+        ----------
+        arguments : list
+            The keybase client arguments.
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process.
+
+        Raises
+        ------
+        CryptoException
+            If the keybase client could not be started, a CryptoException is
+            raised.
+
+        """
+        try:
+            return self._api.open_process(
+                arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+        except APIException as exception:
+            raise CryptoException(exception.message)
+
+    def _verify_one(self, message):
+        """Verify a single signed message for `Crypto.verify_many`.
+
+        Parameters
+        ----------
+        message : bytes or tuple
+            The signed message, or a (data, signature) tuple.
+
+        Returns
+        -------
+        result : VerifyResult
+            The result of the verification.
+
+        """
+        path = None
+        try:
+            if isinstance(message, tuple):
+                data, signature = message
+                descriptor, path = tempfile.mkstemp(prefix="pykblib-")
+                with os.fdopen(descriptor, "wb") as target:
+                    target.write(signature)
+                self._run(["verify", "--detached", path], data)
+                return VerifyResult(True, data, None)
+            return VerifyResult(True, self._run(["verify"], message), None)
+        except CryptoException as exception:
+            return VerifyResult(False, None, exception.message)
+        finally:
+            if path is not None:
+                os.remove(path)
+
+    def _unchunked(self, arguments, source, workers):
+        """Process a framed stream produced by `Crypto._chunked`.
+
+        Parameters
+        ----------
+        arguments : list
+            The keybase client arguments used for each chunk.
+        source : bytes, file or iterable
+            The framed data.
+        workers : int
+            The number of chunks processed at once.
+
+        Returns
+        -------
+        CryptoReader
+            A reader producing the concatenated output of every chunk.
+
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            stream = io.BytesIO(source)
+        elif hasattr(source, "read"):
+            stream = source
+        else:
+            stream = CryptoReader(iter(source))
+
+        def frames():
+            if _read_exactly(stream, len(CHUNK_MAGIC)) != CHUNK_MAGIC:
+                raise CryptoException("The input is not a chunked stream.")
+            while 1:
+                header = _read_exactly(stream, _FRAME_HEADER.size)
+                if not header:
+                    return
+                (size,) = _FRAME_HEADER.unpack(header)
+                frame = _read_exactly(stream, size)
+                if len(frame) < size:
+                    raise CryptoException("The chunked stream is truncated.")
+                yield frame
+
+        run = functools.partial(self._run, arguments)
+        return CryptoReader(self._map_ordered(run, frames(), workers))
+
+
+class CryptoReader(io.RawIOBase):
+    """A read-only binary stream over the output of a Crypto operation.
+
+    The reader can be read with `read()`, or iterated over to retrieve the
+    output in chunks as they are produced. Any error reported by the keybase
+    client is raised as a CryptoException once the output is exhausted or the
+    reader is closed.
+
+    """
+
+    def __init__(self, chunks, finish=None):
+        """Initialize the CryptoReader class.
+
+        Parameters
+        ----------
+        chunks : iterator
+            An iterator producing the output in chunks.
+        finish : callable
+            A function to call when the reader is exhausted or closed. It
+            receives True if the output was read to the end. *(Defaults to
+            None.)*
+
+        """
+        super().__init__()
+        self._buffer = b""
+        self._chunks = chunks
+        self._cleanup = list()
+        self._complete = False
+        self._finish = finish
+
+    def __iter__(self):
+        """Yield the remaining output in chunks."""
+        if self._buffer:
+            buffered, self._buffer = self._buffer, b""
+            yield buffered
+        while 1:
+            chunk = self._next_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        """Close the reader, stopping any processing that is still running.
+
+        Raises
+        ------
+        CryptoException
+            If the keybase client reported an error, a CryptoException is
+            raised.
+
+        """
+        if self.closed:
+            return
+        super().close()
+        try:
+            if not self._complete and hasattr(self._chunks, "close"):
+                self._chunks.close()
+            if self._finish is not None:
+                self._finish(self._complete)
+        finally:
+            for cleanup in self._cleanup:
+                cleanup()
+
+    def readable(self):
+        """Return True, as the reader is readable."""
+        return True
+
+    def read(self, size=-1):
+        """Read up to the specified number of bytes.
+
+        Parameters
+        ----------
+        size : int
+            The maximum number of bytes to read, or -1 to read everything.
+            *(Defaults to -1.)*
+
+        Returns
+        -------
+        data : bytes
+            The data read, or an empty bytes object at the end of the output.
+
+        """
+        if size is None or size < 0:
+            return b"".join(self)
+        while len(self._buffer) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readinto(self, buffer):
+        """Read data into a pre-allocated buffer.
+
+        Parameters
+        ----------
+        buffer : bytearray
+            The buffer to fill.
+
+        Returns
+        -------
+        size : int
+            The number of bytes read.
+
+        """
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def _next_chunk(self):
+        """Retrieve the next chunk of output.
+
+        Returns
+        -------
+        chunk : bytes
+            The next non-empty chunk, or an empty bytes object once the
+            output is exhausted, at which point the reader is closed.
+
+        """
+        if self._complete or self.closed:
+            return b""
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        self._complete = True
+        self.close()
+        return b""
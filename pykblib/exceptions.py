@@ -28,9 +28,61 @@ class APIException(KBLibException):
     """Raised when there's an error with the Keybase API."""
 
 
+class ServiceUnavailableException(APIException):
+    """Raised when calls are refused because Keybase appears to be down."""
+
+
+class TimeoutException(KBLibException):
+    """Raised when a call to Keybase doesn't finish before its deadline."""
+
+
 class KeybaseException(KBLibException):
     """Raised when there's an error with the Keybase class."""
 
 
 class TeamException(KBLibException):
     """Raised when there's an error with the Team class."""
+
+
+class ChatException(KBLibException):
+    """Raised when there's an error with the Chat class."""
+
+
+class StoreException(KBLibException):
+    """Raised when there's an error with the MessageStore class."""
+
+
+class BotException(KBLibException):
+    """Raised when there's an error with the Bot class."""
+
+
+class KBFSException(KBLibException):
+    """Raised when there's an error with the KBFS class."""
+
+
+class CryptoException(KBLibException):
+    """Raised when there's an error with the Crypto class."""
+
+
+class KVStoreException(KBLibException):
+    """Raised when there's an error with the KVStore class."""
+
+
+class KVConflictException(KVStoreException):
+    """Raised when a key-value entry was changed by another writer."""
+
+
+class WalletException(KBLibException):
+    """Raised when there's an error with the Wallet class."""
+
+
+class AccessException(KBLibException):
+    """Raised when there's an error with the AccessRequestProcessor class."""
+
+
+class SidecarException(KBLibException):
+    """Raised when there's an error with the Sidecar class."""
+
+
+class CacheException(KBLibException):
+    """Raised when there's an error with the SharedTeamCache class."""
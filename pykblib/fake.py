@@ -0,0 +1,1185 @@
+"""Defines the FakeKeybase class, a simulated Keybase service.
+
+The FakeKeybase class can be used as a `KeybaseAPI` transport, handling
+commands in-process, or this module can be run as a stand-in for the keybase
+client itself::
+
+    python -m pykblib.fake [--state PATH] [--latency SECONDS] COMMAND...
+
+When run as a client, the simulated service's state is loaded from and saved
+to the state file, so that consecutive commands see each other's effects.
+Besides the team, chat and status commands, the client simulates the
+streaming `encrypt`, `decrypt`, `sign`, `verify` and `fs` commands, and
+answers a stream of queries on its standard input when run as `SERVICE api`,
+so that code paths which spawn processes can be exercised offline as well.
+
+"""
+
+import hashlib
+import json
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pykblib.api import remaining
+from pykblib.exceptions import APIException, TimeoutException
+
+ROLES = ("reader", "writer", "admin", "owner")
+STATUSES = ("active", "reset", "deleted")
+CRYPTO_MAGIC = b"FAKE-SALTPACK-ENCRYPTED\n"
+SIGNATURE_MAGIC = b"FAKE-SALTPACK-SIGNED\n"
+
+
+def _channel_key(channel):
+    """Return a normalized key identifying a chat channel.
+
+    Parameters
+    ----------
+    channel : dict
+        A Keybase channel dict.
+
+    Returns
+    -------
+    key : tuple
+        The members type, name and topic name of the channel.
+
+    """
+    members_type = channel.get("members_type") or "impteamnative"
+    name = channel.get("name", "")
+    if members_type == "team":
+        return (members_type, name, channel.get("topic_name") or "general")
+    return (members_type, ",".join(sorted(name.split(","))), None)
+
+
+class FakeKeybase:
+    """Simulates the Keybase team, chat and status services in-process.
+
+    Teams, their members and access requests, and chat conversations are all
+    kept in memory, and queries return the same JSON structures as the real
+    service. To use it, pass an instance to `Keybase` as its transport::
+
+        fake = FakeKeybase("test_user", users=["alice", "bob"])
+        keybase = Keybase(transport=fake)
+
+    Processes spawned through `FakeKeybase.open_process` run this module as
+    the keybase client, with a copy of the current state.
+
+    Attributes
+    ----------
+    latency : float
+        The number of seconds each command takes to complete.
+    username : str
+        The username of the simulated active user.
+
+    """
+
+    def __init__(self, username="fake_user", users=(), latency=0):
+        """Initialize the FakeKeybase class.
+
+        Parameters
+        ----------
+        username : str
+            The username of the simulated active user. *(Defaults to
+            fake_user.)*
+        users : iterable
+            The usernames of the other users known to the service. *(Defaults
+            to none.)*
+        latency : float
+            The number of seconds each command takes to complete. *(Defaults
+            to 0.)*
+
+        """
+        self._errors = dict()
+        self._listeners = list()
+        self._lock = threading.RLock()
+        self._state = {
+            "conversations": dict(),
+            "kbfs_root": None,
+            "next_id": 1,
+            "teams": dict(),
+            "users": dict.fromkeys(set(users) | {username}, 0),
+        }
+        self._kbfs_root = None
+        self._state_path = None
+        self.latency = latency
+        self.username = username
+
+    def add_user(self, username, status="active"):
+        """Make a user known to the service, or change their account status.
+
+        Team members whose accounts were reset or deleted are reported as
+        such by `list-team-memberships`, and deleted users can no longer be
+        identified or added to teams.
+
+        Parameters
+        ----------
+        username : str
+            The username of the user.
+        status : str
+            The status of the user's account, i.e. active, reset or deleted.
+            *(Defaults to active.)*
+
+        """
+        with self._lock:
+            self._state["users"][username] = STATUSES.index(status)
+
+    def close(self):
+        """End any `chat api-listen` streams, and remove temporary files.
+
+        The state file and KBFS folder created by `FakeKeybase.executable`
+        are removed.
+
+        """
+        with self._lock:
+            listeners, self._listeners = self._listeners, list()
+            path, self._state_path = self._state_path, None
+            kbfs_root, self._kbfs_root = self._kbfs_root, None
+        for listener in listeners:
+            listener.put(None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+        if kbfs_root is not None:
+            shutil.rmtree(kbfs_root, ignore_errors=True)
+
+    def delete_team(self, team_name):
+        """Delete the specified team.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team to be deleted.
+
+        Raises
+        ------
+        APIException
+            If the team doesn't exist, has sub-teams, or isn't owned by the
+            active user, an APIException is raised.
+
+        """
+        self._delay()
+        self._raise_injected("team delete")
+        with self._lock:
+            teams = self._state["teams"]
+            team = teams.get(team_name)
+            if (
+                team is None
+                or team["members"].get(self.username) != "owner"
+                or any(name.startswith(team_name + ".") for name in teams)
+            ):
+                raise APIException(
+                    "Failed to delete team {}.".format(team_name)
+                )
+            del teams[team_name]
+            conversations = self._state["conversations"]
+            for conversation_id in list(conversations):
+                channel = conversations[conversation_id]["channel"]
+                if channel["members_type"] == "team" and (
+                    channel["name"] == team_name
+                ):
+                    del conversations[conversation_id]
+
+    def executable(self):
+        """Save the state, and return a command that runs this module on it.
+
+        The command can be passed to `Keybase` or `KeybaseAPI` as the
+        executable, so that commands are run in separate processes. Changes
+        those processes make are not reflected in this instance; use
+        `FakeKeybase.load` on the state file to inspect them.
+
+        Returns
+        -------
+        command : str
+            The command used to start the fake keybase client.
+
+        """
+        with self._lock:
+            if self._state_path is None:
+                descriptor, self._state_path = tempfile.mkstemp(
+                    prefix="pykblib-fake-", suffix=".json"
+                )
+                os.close(descriptor)
+            if self._state["kbfs_root"] is None:
+                # Share a KBFS folder between all of the spawned clients.
+                self._kbfs_root = tempfile.mkdtemp(prefix="pykblib-fake-kbfs-")
+                self._state["kbfs_root"] = self._kbfs_root
+            self.save(self._state_path)
+            path = self._state_path
+        arguments = [sys.executable, "-m", "pykblib.fake", "--state", path]
+        if self.latency:
+            arguments += ["--latency", str(self.latency)]
+        return " ".join(shlex.quote(argument) for argument in arguments)
+
+    def inject_error(self, operation, message="Injected error.", times=1):
+        """Make an operation fail.
+
+        Parameters
+        ----------
+        operation : str
+            The operation that should fail. API methods are named as
+            `service/method`, e.g. `team/add-members` or `chat/send`. Other
+            commands are named by their command words, e.g. `status`, `id`,
+            `team list-requests` or `team delete`.
+        message : str
+            The error message to report. *(Defaults to Injected error.)*
+        times : int
+            The number of times the operation should fail, or None to make it
+            fail until `FakeKeybase.clear_errors` is called. *(Defaults to
+            1.)*
+
+        """
+        with self._lock:
+            self._errors[operation] = [message, times]
+
+    def clear_errors(self):
+        """Remove all injected errors."""
+        with self._lock:
+            self._errors.clear()
+
+    @classmethod
+    def load(cls, path, latency=0):
+        """Create a FakeKeybase from a saved state file.
+
+        Parameters
+        ----------
+        path : str
+            The path of the state file.
+        latency : float
+            The number of seconds each command takes to complete. *(Defaults
+            to 0.)*
+
+        Returns
+        -------
+        fake : FakeKeybase
+            The simulated service.
+
+        """
+        with open(path) as source:
+            state = json.load(source)
+        fake = cls(state["username"], latency=latency)
+        fake._state = state["state"]
+        return fake
+
+    def open_process(self, arguments, stdin=None, stdout=None):
+        """Start the fake keybase client on a copy of the current state.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the client.
+        stdin : int or file
+            The process's standard input. *(Defaults to None.)*
+        stdout : int or file
+            The process's standard output. *(Defaults to None.)*
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process, with its standard error piped.
+
+        """
+        command = shlex.split(self.executable()) + list(arguments)
+        return subprocess.Popen(
+            command, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE
+        )
+
+    def run_command(self, command):
+        """Execute the specified command, then return the result.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run, without the leading `keybase`.
+
+        Returns
+        -------
+        output : str
+            The output of the command.
+
+        Raises
+        ------
+        APIException
+            If the command fails, an APIException is raised.
+
+        """
+        self._delay()
+        arguments = shlex.split(command)
+        if len(arguments) == 4 and arguments[1:3] == ["api", "-m"]:
+            return json.dumps(self._call(arguments[0], arguments[3]))
+        if arguments[:1] == ["status"]:
+            self._raise_injected("status")
+            return "Username:      {}\nLogged in:     yes\n".format(
+                self.username
+            )
+        if arguments[:1] == ["id"] and len(arguments) == 2:
+            self._raise_injected("id")
+            return self._identify(arguments[1])
+        if arguments[:1] == ["team"] and len(arguments) > 1:
+            operation = "team {}".format(arguments[1])
+            handler = {
+                "list-requests": self._list_requests,
+                "ignore-request": self._ignore_request,
+                "request-access": self._request_access,
+            }.get(arguments[1])
+            if handler is not None:
+                self._raise_injected(operation)
+                return handler(arguments[2:])
+        raise APIException("Unknown command: {}".format(command))
+
+    def save(self, path):
+        """Save the state of the simulated service to a file.
+
+        Parameters
+        ----------
+        path : str
+            The path of the state file.
+
+        """
+        with self._lock:
+            data = json.dumps(
+                {"username": self.username, "state": self._state}
+            )
+        with open(path, "w") as target:
+            target.write(data)
+
+    def stream_lines(self, command):
+        """Execute the specified command, yielding its output line by line.
+
+        `chat api-listen` yields a notification for every message sent until
+        `FakeKeybase.close` is called. Other commands yield the lines of their
+        output.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Yields
+        ------
+        line : str
+            Each line of the command's output.
+
+        """
+        if shlex.split(command) != ["chat", "api-listen"]:
+            for line in self.run_command(command).splitlines():
+                yield line
+            return
+        listener = queue.Queue()
+        with self._lock:
+            self._listeners.append(listener)
+        try:
+            while 1:
+                notification = listener.get()
+                if notification is None:
+                    return
+                yield json.dumps(notification)
+        finally:
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+
+    def _call(self, service, json_query):
+        """Handle an API query.
+
+        Parameters
+        ----------
+        service : str
+            The name of the API service.
+        json_query : str
+            The query, encoded as JSON.
+
+        Returns
+        -------
+        response : dict
+            The response, containing either a result or an error.
+
+        """
+        try:
+            query = json.loads(json_query)
+            method = query["method"]
+        except (ValueError, KeyError, TypeError):
+            return {"error": {"code": 0, "message": "invalid JSON query"}}
+        options = query.get("params", dict()).get("options", dict())
+        handler = getattr(
+            self, "_{}_{}".format(service, method.replace("-", "_")), None
+        )
+        if handler is None:
+            return {
+                "error": {
+                    "code": 0,
+                    "message": "unknown method {}".format(method),
+                }
+            }
+        try:
+            self._raise_injected("{}/{}".format(service, method))
+            with self._lock:
+                return {"result": handler(options)}
+        except APIException as exception:
+            return {"error": {"code": 0, "message": exception.message}}
+
+    def _chat_list(self, options):
+        """List the active user's conversations."""
+        conversations = [
+            self._conversation_summary(conversation_id)
+            for conversation_id, conversation in sorted(
+                self._state["conversations"].items()
+            )
+            if self._can_access(conversation["channel"])
+        ]
+        return {"conversations": conversations or None, "offline": False}
+
+    def _chat_listconvsonname(self, options):
+        """List the conversations of a team."""
+        if options.get("members_type") != "team":
+            return self._chat_list(options)
+        self._team(options.get("name"), member=True)
+        conversations = [
+            self._conversation_summary(conversation_id)
+            for conversation_id, conversation in sorted(
+                self._state["conversations"].items()
+            )
+            if conversation["channel"]["members_type"] == "team"
+            and conversation["channel"]["name"] == options.get("name")
+        ]
+        return {"conversations": conversations or None, "offline": False}
+
+    def _chat_read(self, options):
+        """Read a page of a conversation's messages, newest first."""
+        conversation_id = self._find_conversation(options)
+        messages = self._state["conversations"][conversation_id]["messages"]
+        pagination = options.get("pagination") or dict()
+        num = pagination.get("num") or 100
+        start = int(pagination.get("next") or 0)
+        newest_first = messages[::-1]
+        page = newest_first[start : start + num]
+        last = start + num >= len(newest_first)
+        return {
+            "messages": [{"msg": message} for message in page] or None,
+            "pagination": {
+                "next": "" if last else str(start + num),
+                "previous": str(start),
+                "num": len(page),
+                "last": last,
+            },
+        }
+
+    def _chat_send(self, options):
+        """Send a message to a conversation."""
+        body = (options.get("message") or dict()).get("body")
+        if body is None:
+            raise APIException("no message body")
+        conversation_id = self._find_conversation(options, create=True)
+        conversation = self._state["conversations"][conversation_id]
+        message = {
+            "id": len(conversation["messages"]) + 1,
+            "conversation_id": conversation_id,
+            "channel": conversation["channel"],
+            "sender": {
+                "uid": self._uid(self.username),
+                "username": self.username,
+                "device_id": "fake_device",
+                "device_name": "pykblib-fake",
+            },
+            "sent_at": int(time.time()),
+            "sent_at_ms": int(time.time() * 1000),
+            "content": {"type": "text", "text": {"body": body}},
+            "prev": None,
+            "unread": False,
+        }
+        conversation["messages"].append(message)
+        for listener in self._listeners:
+            listener.put({"type": "chat", "source": "remote", "msg": message})
+        return {"message": "message sent", "id": message["id"]}
+
+    def _can_access(self, channel):
+        """Return True if the active user may access a channel.
+
+        Parameters
+        ----------
+        channel : dict
+            The channel dict.
+
+        Returns
+        -------
+        accessible : bool
+            Whether the active user is a member of the channel.
+
+        """
+        if channel["members_type"] == "team":
+            team = self._state["teams"].get(channel["name"])
+            return team is not None and self.username in team["members"]
+        return self.username in channel["name"].split(",")
+
+    def _conversation_summary(self, conversation_id):
+        """Return the summary of a conversation included in listings.
+
+        Parameters
+        ----------
+        conversation_id : str
+            The ID of the conversation.
+
+        Returns
+        -------
+        summary : dict
+            The conversation's ID, channel and activity information.
+
+        """
+        conversation = self._state["conversations"][conversation_id]
+        messages = conversation["messages"]
+        active_at = messages[-1]["sent_at"] if messages else 0
+        return {
+            "id": conversation_id,
+            "channel": conversation["channel"],
+            "unread": False,
+            "active_at": active_at,
+            "active_at_ms": active_at * 1000,
+            "member_status": "active",
+        }
+
+    def _create_conversation(self, channel):
+        """Create a conversation for a channel.
+
+        Parameters
+        ----------
+        channel : dict
+            The normalized channel dict.
+
+        Returns
+        -------
+        conversation_id : str
+            The ID of the new conversation.
+
+        """
+        conversation_id = "{:064x}".format(self._next_id())
+        self._state["conversations"][conversation_id] = {
+            "channel": channel,
+            "messages": list(),
+        }
+        return conversation_id
+
+    def _delay(self):
+        """Wait for the configured latency, within the current deadline.
+
+        Raises
+        ------
+        TimeoutException
+            If the deadline expires first, a TimeoutException is raised.
+
+        """
+        if self.latency:
+            time_left = remaining()
+            if time_left is not None and time_left < self.latency:
+                time.sleep(max(0, time_left))
+                raise TimeoutException("Timed out waiting for FakeKeybase.")
+            time.sleep(self.latency)
+
+    def _find_conversation(self, options, create=False):
+        """Find the conversation identified by chat API options.
+
+        Parameters
+        ----------
+        options : dict
+            Options containing either a `conversation_id` or a `channel`.
+        create : bool
+            Whether to create a missing private conversation. *(Defaults to
+            False.)*
+
+        Returns
+        -------
+        conversation_id : str
+            The ID of the conversation.
+
+        Raises
+        ------
+        APIException
+            If the conversation doesn't exist or the active user isn't a
+            member, an APIException is raised.
+
+        """
+        conversations = self._state["conversations"]
+        conversation_id = options.get("conversation_id")
+        if conversation_id:
+            conversation = conversations.get(conversation_id)
+            if conversation is None or not self._can_access(
+                conversation["channel"]
+            ):
+                raise APIException("conversation not found")
+            return conversation_id
+        members_type, name, topic_name = _channel_key(
+            options.get("channel") or dict()
+        )
+        for conversation_id, conversation in conversations.items():
+            if _channel_key(conversation["channel"]) == (
+                members_type,
+                name,
+                topic_name,
+            ):
+                if not self._can_access(conversation["channel"]):
+                    break
+                return conversation_id
+        channel = {"name": name, "members_type": members_type}
+        if topic_name is not None:
+            channel["topic_name"] = topic_name
+        if (
+            create
+            and members_type != "team"
+            and self._can_access(channel)
+            and all(user in self._state["users"] for user in name.split(","))
+        ):
+            return self._create_conversation(channel)
+        raise APIException("conversation not found")
+
+    def _identify(self, assertion):
+        """Simulate the output of `keybase id`.
+
+        Parameters
+        ----------
+        assertion : str
+            The username or social assertion to identify.
+
+        Returns
+        -------
+        output : str
+            The identification output.
+
+        Raises
+        ------
+        APIException
+            If the user doesn't exist, an APIException is raised.
+
+        """
+        username = assertion.split("@")[0]
+        with self._lock:
+            known = self._state["users"].get(username) in (0, 1)
+        if not known:
+            raise APIException("user not found: {}".format(assertion))
+        return "▶ INFO Identifying {}\n".format(username)
+
+    def _ignore_request(self, arguments):
+        """Simulate `keybase team ignore-request TEAM -u USER`."""
+        if len(arguments) != 3 or arguments[1] != "-u":
+            raise APIException("usage: team ignore-request TEAM -u USER")
+        team_name, username = arguments[0], arguments[2]
+        with self._lock:
+            team = self._state["teams"].get(team_name)
+            if team is None or username not in team["requests"]:
+                raise APIException("Not found")
+            team["requests"].remove(username)
+        return ""
+
+    def _list_requests(self, arguments):
+        """Simulate `keybase team list-requests [-t TEAM] [--json]`."""
+        team_filter = None
+        if "-t" in arguments:
+            team_filter = arguments[arguments.index("-t") + 1]
+        with self._lock:
+            requests = [
+                (team_name, username)
+                for team_name, team in sorted(self._state["teams"].items())
+                if team_filter in (None, team_name)
+                and team["members"].get(self.username) in ("admin", "owner")
+                for username in team["requests"]
+            ]
+        if "--json" in arguments or "-j" in arguments:
+            return json.dumps(
+                [
+                    {
+                        "name": team_name,
+                        "username": username,
+                        "fullName": "",
+                        "ctime": 0,
+                    }
+                    for team_name, username in requests
+                ]
+            )
+        if not requests:
+            return "No requests at this time.\n"
+        lines = [
+            "{} {} wants to join".format(team_name, username)
+            for team_name, username in requests
+        ]
+        lines.append(
+            "To handle requests, use `keybase team add-member` or "
+            "`keybase team ignore-request`."
+        )
+        return "\n".join(lines) + "\n"
+
+    def _next_id(self):
+        """Return a new unique number."""
+        value = self._state["next_id"]
+        self._state["next_id"] = value + 1
+        return value
+
+    def _raise_injected(self, operation):
+        """Raise an injected error for an operation, if there is one.
+
+        Parameters
+        ----------
+        operation : str
+            The name of the operation.
+
+        Raises
+        ------
+        APIException
+            If an error was injected for the operation, an APIException is
+            raised.
+
+        """
+        with self._lock:
+            error = self._errors.get(operation)
+            if error is None:
+                return
+            message, times = error
+            if times is not None:
+                if times <= 1:
+                    del self._errors[operation]
+                else:
+                    error[1] = times - 1
+        raise APIException(message)
+
+    def _request_access(self, arguments):
+        """Simulate `keybase team request-access TEAM`."""
+        if len(arguments) != 1:
+            raise APIException("usage: team request-access TEAM")
+        with self._lock:
+            team = self._state["teams"].get(arguments[0])
+            if team is None:
+                raise APIException("team not found")
+            if self.username in team["members"]:
+                return "You have joined {}.\n".format(arguments[0])
+            if self.username in team["requests"]:
+                raise APIException("access already requested")
+            team["requests"].append(self.username)
+        return "Success! An email has been sent to the team's admins.\n"
+
+    def _team(self, team_name, member=False, admin=False):
+        """Retrieve a team's state.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team.
+        member : bool
+            Whether the active user must be a member. *(Defaults to False.)*
+        admin : bool
+            Whether the active user must be an admin or owner. *(Defaults to
+            False.)*
+
+        Returns
+        -------
+        team : dict
+            The team's state.
+
+        Raises
+        ------
+        APIException
+            If the team doesn't exist or the active user lacks the required
+            role, an APIException is raised.
+
+        """
+        team = self._state["teams"].get(team_name)
+        if team is None:
+            raise APIException("Team {} does not exist".format(team_name))
+        role = team["members"].get(self.username)
+        if (member or admin) and role is None:
+            raise APIException(
+                "You are not a member of team {}".format(team_name)
+            )
+        if admin and role not in ("admin", "owner"):
+            raise APIException(
+                "You must be an admin of team {}".format(team_name)
+            )
+        return team
+
+    def _team_add_members(self, options):
+        """Add members to a team, one at a time."""
+        team = self._team(options.get("team"), admin=True)
+        added = list()
+        for entry in options.get("usernames") or list():
+            username, role = entry.get("username"), entry.get("role")
+            if role not in ROLES:
+                raise APIException("invalid team role {}".format(role))
+            if self._state["users"].get(username) not in (0, 1):
+                raise APIException("user not found: {}".format(username))
+            if username in team["members"]:
+                raise APIException(
+                    "{} is already a member of team {}".format(
+                        username, options["team"]
+                    )
+                )
+            team["members"][username] = role
+            if username in team["requests"]:
+                team["requests"].remove(username)
+            added.append({"invited": False, "username": username})
+        return added
+
+    def _team_create_team(self, options):
+        """Create a team or sub-team."""
+        team_name = options.get("team") or ""
+        if team_name in self._state["teams"]:
+            raise APIException("team {} already exists".format(team_name))
+        if "." in team_name:
+            self._team(team_name.rpartition(".")[0], admin=True)
+        self._state["teams"][team_name] = {
+            "members": {self.username: "owner"},
+            "requests": list(),
+        }
+        self._create_conversation(
+            {
+                "name": team_name,
+                "members_type": "team",
+                "topic_name": "general",
+            }
+        )
+        return {"chatSent": True, "creatorAdded": True}
+
+    def _team_edit_member(self, options):
+        """Change a member's role."""
+        team = self._team(options.get("team"), admin=True)
+        if options.get("role") not in ROLES:
+            raise APIException(
+                "invalid team role {}".format(options.get("role"))
+            )
+        if options.get("username") not in team["members"]:
+            raise APIException("user is not a member")
+        team["members"][options["username"]] = options["role"]
+        return dict()
+
+    def _team_leave_team(self, options):
+        """Leave a team."""
+        team = self._team(options.get("team"))
+        if self.username not in team["members"]:
+            raise APIException("You are not a member of this team")
+        del team["members"][self.username]
+        return dict()
+
+    def _team_list_team_memberships(self, options):
+        """List a team's members by role."""
+        team = self._team(options.get("team"), member=True)
+        members = dict()
+        for role in ROLES:
+            entries = [
+                {
+                    "uv": {"uid": self._uid(username), "eldestSeqno": 1},
+                    "username": username,
+                    "fullName": "",
+                    "needsPUK": False,
+                    "status": self._state["users"].get(username, 0),
+                }
+                for username, member_role in sorted(team["members"].items())
+                if member_role == role
+            ]
+            members[role + "s"] = entries or None
+        return {
+            "members": members,
+            "settings": {"open": False, "joinAs": 1},
+            "annotatedActiveInvites": dict(),
+        }
+
+    def _team_list_self_memberships(self, options):
+        """List the active user's teams."""
+        return self._team_list_user_memberships({"username": self.username})
+
+    def _team_list_user_memberships(self, options):
+        """List the teams to which a user belongs."""
+        username = options.get("username") or self.username
+        teams = [
+            {
+                "uid": self._uid(username),
+                "team_id": self._uid(team_name),
+                "username": username,
+                "full_name": "",
+                "fq_name": team_name,
+                "is_implicit_team": False,
+                "implicit_team_display_name": "",
+                "is_open_team": False,
+                "role": ROLES.index(team["members"][username]) + 1,
+                "needsPUK": False,
+                "member_count": len(team["members"]),
+                "member_eldest_seqno": 1,
+                "allow_profile_promote": False,
+                "is_member_showcased": False,
+                "status": 0,
+            }
+            for team_name, team in sorted(self._state["teams"].items())
+            if username in team["members"]
+        ]
+        return {"teams": teams or None, "annotatedActiveInvites": dict()}
+
+    def _team_remove_member(self, options):
+        """Remove a member from a team."""
+        team = self._team(options.get("team"), admin=True)
+        if options.get("username") not in team["members"]:
+            raise APIException("user is not a member")
+        del team["members"][options["username"]]
+        return dict()
+
+    def _team_rename_subteam(self, options):
+        """Rename a sub-team, along with its own sub-teams."""
+        old_name = options.get("team") or ""
+        new_name = options.get("new-team-name") or ""
+        self._team(old_name, admin=True)
+        if "." not in old_name or (
+            old_name.rpartition(".")[0] != new_name.rpartition(".")[0]
+        ):
+            raise APIException("only sub-teams can be renamed")
+        if new_name in self._state["teams"]:
+            raise APIException("team {} already exists".format(new_name))
+        teams = self._state["teams"]
+        for team_name in list(teams):
+            if team_name == old_name or team_name.startswith(old_name + "."):
+                renamed = new_name + team_name[len(old_name) :]
+                teams[renamed] = teams.pop(team_name)
+        for conversation in self._state["conversations"].values():
+            channel = conversation["channel"]
+            if channel["members_type"] == "team" and (
+                channel["name"] == old_name
+                or channel["name"].startswith(old_name + ".")
+            ):
+                channel["name"] = new_name + channel["name"][len(old_name) :]
+        return dict()
+
+    @staticmethod
+    def _uid(username):
+        """Return a stable, fake UID for a user."""
+        return hashlib.sha256(username.encode()).hexdigest()[:32]
+
+    def _kbfs_path(self, path):
+        """Map a KBFS path onto the simulated folder on disk.
+
+        Parameters
+        ----------
+        path : str
+            The KBFS path, beginning with /keybase/.
+
+        Returns
+        -------
+        local_path : str
+            The corresponding local path.
+
+        Raises
+        ------
+        APIException
+            If the path isn't a KBFS path, an APIException is raised.
+
+        """
+        parts = [part for part in path.split("/") if part]
+        if not parts or parts[0] != "keybase" or ".." in parts:
+            raise APIException("{} is not a KBFS path".format(path))
+        with self._lock:
+            if self._state["kbfs_root"] is None:
+                self._state["kbfs_root"] = tempfile.mkdtemp(
+                    prefix="pykblib-fake-kbfs-"
+                )
+            root = self._state["kbfs_root"]
+        return os.path.join(root, *parts[1:])
+
+    def _pipe(self, arguments, stdin, stdout):
+        """Run a streaming command on the fake client's standard streams.
+
+        Parameters
+        ----------
+        arguments : list
+            The command's arguments.
+        stdin : file
+            The binary standard input.
+        stdout : file
+            The binary standard output.
+
+        Raises
+        ------
+        APIException
+            If the command fails, an APIException is raised.
+
+        """
+        command = arguments[0]
+        self._raise_injected(
+            " ".join(arguments[:2] if command == "fs" else [command])
+        )
+        flags = [
+            argument for argument in arguments if argument.startswith("-")
+        ]
+        if command == "encrypt":
+            stdout.write(CRYPTO_MAGIC)
+            _copy(stdin, stdout)
+        elif command == "decrypt":
+            _strip_magic(stdin, stdout, CRYPTO_MAGIC)
+        elif command == "sign" and "--detached" in flags:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: stdin.read(65536), b""):
+                digest.update(chunk)
+            stdout.write(SIGNATURE_MAGIC + digest.hexdigest().encode())
+        elif command == "sign":
+            stdout.write(SIGNATURE_MAGIC)
+            _copy(stdin, stdout)
+        elif command == "verify" and "--detached" in flags:
+            with open(arguments[arguments.index("--detached") + 1], "rb") as f:
+                signature = f.read()
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: stdin.read(65536), b""):
+                digest.update(chunk)
+            if signature != SIGNATURE_MAGIC + digest.hexdigest().encode():
+                raise APIException("bad signature")
+        elif command == "verify":
+            _strip_magic(stdin, stdout, SIGNATURE_MAGIC)
+        elif command == "fs" and len(arguments) > 2:
+            self._pipe_fs(arguments[1], arguments[2:], stdin, stdout)
+        else:
+            raise APIException("unknown command {}".format(command))
+
+    def _pipe_fs(self, action, arguments, stdin, stdout):
+        """Run a simulated `keybase fs` command.
+
+        Parameters
+        ----------
+        action : str
+            The fs sub-command, i.e. read, write, ls, mkdir or rm.
+        arguments : list
+            The sub-command's arguments, ending with the path.
+        stdin : file
+            The binary standard input.
+        stdout : file
+            The binary standard output.
+
+        Raises
+        ------
+        APIException
+            If the command fails, an APIException is raised.
+
+        """
+        path = self._kbfs_path(arguments[-1])
+        try:
+            if action == "read":
+                offset, size = 0, None
+                if "--offset" in arguments:
+                    offset = int(arguments[arguments.index("--offset") + 1])
+                if "--size" in arguments:
+                    size = int(arguments[arguments.index("--size") + 1])
+                with open(path, "rb") as source:
+                    source.seek(offset)
+                    if size is None:
+                        _copy(source, stdout)
+                    else:
+                        stdout.write(source.read(size))
+            elif action == "write":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                mode = "ab" if "--append" in arguments else "wb"
+                with open(path, mode) as target:
+                    _copy(stdin, target)
+            elif action == "ls":
+                for name in sorted(os.listdir(path)):
+                    suffix = (
+                        "/" if os.path.isdir(os.path.join(path, name)) else ""
+                    )
+                    stdout.write("{}{}\n".format(name, suffix).encode())
+            elif action == "mkdir":
+                os.makedirs(path, exist_ok="-p" in arguments)
+            elif action == "rm":
+                os.remove(path)
+            else:
+                raise APIException("unknown command fs {}".format(action))
+        except OSError as error:
+            raise APIException("{}: {}".format(arguments[-1], error.strerror))
+
+
+def _copy(source, target):
+    """Copy a binary stream to another in chunks."""
+    for chunk in iter(lambda: source.read(65536), b""):
+        target.write(chunk)
+
+
+def _strip_magic(source, target, magic):
+    """Copy a simulated saltpack message's payload, checking its header.
+
+    Raises
+    ------
+    APIException
+        If the header is missing, an APIException is raised.
+
+    """
+    if source.read(len(magic)) != magic:
+        raise APIException("not a valid saltpack message")
+    _copy(source, target)
+
+
+def main(argv=None):
+    """Run the fake keybase client.
+
+    Parameters
+    ----------
+    argv : list
+        The command-line arguments. *(Defaults to sys.argv[1:].)*
+
+    Returns
+    -------
+    status : int
+        The exit status.
+
+    """
+    arguments = list(sys.argv[1:] if argv is None else argv)
+    state_path, latency = None, 0
+    while arguments[:1] in (["--state"], ["--latency"]):
+        option, value = arguments[:2]
+        arguments = arguments[2:]
+        if option == "--state":
+            state_path = value
+        else:
+            latency = float(value)
+    if state_path is not None and os.path.getsize(state_path):
+        fake = FakeKeybase.load(state_path, latency=latency)
+    else:
+        fake = FakeKeybase(latency=latency)
+    status = 0
+    try:
+        if arguments[:1] in (
+            ["encrypt"],
+            ["decrypt"],
+            ["sign"],
+            ["verify"],
+        ) or (arguments[:1] == ["fs"]):
+            fake._delay()
+            fake._pipe(arguments, sys.stdin.buffer, sys.stdout.buffer)
+        elif len(arguments) == 2 and arguments[1] == "api":
+            # Answer a stream of queries, one per line, as the client does.
+            for line in sys.stdin:
+                if line.strip():
+                    fake._delay()
+                    response = fake._call(arguments[0], line)
+                    sys.stdout.write(json.dumps(response) + "\n")
+                    sys.stdout.flush()
+        elif arguments[:2] == ["team", "delete"] and len(arguments) == 3:
+            sys.stdout.write(
+                "WARNING: This will permanently delete {}.\n".format(
+                    arguments[2]
+                )
+            )
+            sys.stdout.flush()
+            answer = sys.stdin.readline().strip()
+            if answer != "nuke {}".format(arguments[2]):
+                raise APIException("team deletion not confirmed")
+            fake.delete_team(arguments[2])
+            sys.stdout.write(
+                "Success! Team {} deleted.\n".format(arguments[2])
+            )
+        else:
+            command = " ".join(shlex.quote(argument) for argument in arguments)
+            sys.stdout.write(fake.run_command(command))
+    except APIException as exception:
+        # Match the format in which the keybase client reports errors.
+        sys.stderr.write(
+            "\x1b[31m▶ ERROR {}\x1b[0m\n".format(exception.message)
+        )
+        status = 1
+    sys.stdout.flush()
+    if state_path is not None:
+        fake.save(state_path)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,890 @@
+"""Defines the KBFS class."""
+
+import hashlib
+import json
+import mmap
+import os
+import posixpath
+import subprocess
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+
+from pykblib.api import bind_deadline
+from pykblib.exceptions import APIException, KBFSException
+
+CHUNK_SIZE = 64 * 1024
+MANIFEST_NAME = ".pykblib-mirror.json"
+
+MirrorResult = namedtuple(
+    "MirrorResult", ["uploaded", "deleted", "unchanged", "failed"]
+)
+
+
+def _hash_file(path, chunk_size=CHUNK_SIZE):
+    """Return the SHA-256 digest of a local file.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+    chunk_size : int
+        The size of the chunks in which the file is read. *(Defaults to 64
+        KiB.)*
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal SHA-256 digest of the file's contents.
+
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class KBFS:
+    """Provides streaming access to a team's Keybase filesystem folder.
+
+    When KBFS is mounted locally, files are accessed directly through the
+    mount. Otherwise, data is streamed through `keybase fs` processes. Either
+    way, files are transferred in fixed-size chunks and never held in memory
+    in their entirety.
+
+    All paths are relative to the team's folder, i.e.
+    `/keybase/team/<team name>/`.
+
+    Attributes
+    ----------
+    mount_root : str
+        The directory at which KBFS is expected to be mounted.
+
+    """
+
+    def __init__(self, team, mount_root="/keybase"):
+        """Initialize the KBFS class.
+
+        Parameters
+        ----------
+        team : Team
+            The Team whose folder this KBFS instance accesses.
+        mount_root : str
+            The directory at which KBFS is expected to be mounted. *(Defaults
+            to /keybase.)*
+
+        """
+        self._team = team
+        self._mounted = None
+        self.mount_root = mount_root
+
+    @property
+    def mounted(self):
+        """Return whether the team's folder is reachable through the mount."""
+        if self._mounted is None:
+            self._mounted = os.path.isdir(self.local_path(""))
+        return self._mounted
+
+    def kbfs_path(self, path):
+        """Return the full KBFS path of a file in the team's folder.
+
+        Parameters
+        ----------
+        path : str
+            The path relative to the team's folder.
+
+        Returns
+        -------
+        kbfs_path : str
+            The path as understood by `keybase fs`.
+
+        """
+        root = "/keybase/team/{}".format(self._team.name)
+        return posixpath.join(root, path.lstrip("/")).rstrip("/")
+
+    def listdir(self, path=""):
+        """Yield the names of the entries in the specified directory.
+
+        Parameters
+        ----------
+        path : str
+            The directory, relative to the team's folder. *(Defaults to the
+            team's folder itself.)*
+
+        Yields
+        ------
+        name : str
+            The name of each entry in the directory.
+
+        Raises
+        ------
+        KBFSException
+            If the directory could not be listed, a KBFSException is raised.
+
+        """
+        if self.mounted:
+            try:
+                with os.scandir(self.local_path(path)) as entries:
+                    for entry in entries:
+                        yield entry.name
+            except OSError as error:
+                raise KBFSException(
+                    "Could not list {}: {}".format(path, error.strerror)
+                )
+            return
+        process = self._spawn(
+            ["fs", "ls", "-1", "--nocolor", self.kbfs_path(path)],
+            stdout=subprocess.PIPE,
+        )
+        with KBFSFile(process, process.stdout, path) as listing:
+            for line in listing:
+                name = line.decode().rstrip("\r\n").rstrip("/")
+                if name:
+                    yield name
+
+    def local_path(self, path):
+        """Return the path of a file in the team's folder within the mount.
+
+        Parameters
+        ----------
+        path : str
+            The path relative to the team's folder.
+
+        Returns
+        -------
+        local_path : str
+            The path of the file within the local KBFS mount.
+
+        """
+        relative = self.kbfs_path(path)[len("/keybase/") :]
+        return os.path.join(self.mount_root, *relative.split("/"))
+
+    def makedirs(self, path):
+        """Create a directory in the team's folder, including its parents.
+
+        Parameters
+        ----------
+        path : str
+            The directory, relative to the team's folder.
+
+        Raises
+        ------
+        KBFSException
+            If the directory could not be created, a KBFSException is raised.
+
+        """
+        if self.mounted:
+            try:
+                os.makedirs(self.local_path(path), exist_ok=True)
+            except OSError as error:
+                raise KBFSException(
+                    "Could not create {}: {}".format(path, error.strerror)
+                )
+            return
+        self._run(["fs", "mkdir", "-p", self.kbfs_path(path)], path)
+
+    def map(self, path):
+        """Memory-map a file in the team's folder for reading.
+
+        This requires the KBFS mount. The returned `mmap.mmap` object can be
+        sliced directly, or wrapped in a `memoryview` to take slices without
+        copying, and should be closed once it is no longer needed.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+
+        Returns
+        -------
+        mapping : mmap.mmap
+            A read-only memory map of the file.
+
+        Raises
+        ------
+        KBFSException
+            If KBFS isn't mounted, or the file is empty or cannot be opened,
+            a KBFSException is raised.
+
+        """
+        if not self.mounted:
+            raise KBFSException(
+                "Memory-mapping {} requires the KBFS mount.".format(path)
+            )
+        try:
+            with open(self.local_path(path), "rb") as source:
+                return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as error:
+            raise KBFSException("Could not map {}: {}".format(path, error))
+
+    def mirror(
+        self,
+        local_dir,
+        remote_dir="",
+        delete=False,
+        workers=4,
+        hash_workers=None,
+        hash_threshold=8 * 1024 * 1024,
+        manifest=None,
+    ):
+        """Mirror a local directory tree into the team's folder.
+
+        A manifest of the size, modification time and SHA-256 digest of each
+        mirrored file is kept locally. Files whose size and modification time
+        match the manifest are skipped without being read; the rest are
+        hashed, and only those whose contents changed are uploaded. Files of
+        at least `hash_threshold` bytes are hashed in a process pool, and
+        uploads run in a thread pool.
+
+        Parameters
+        ----------
+        local_dir : str
+            The local directory to be mirrored.
+        remote_dir : str
+            The destination directory, relative to the team's folder.
+            *(Defaults to the team's folder itself.)*
+        delete : bool
+            Whether to delete previously mirrored remote files that no longer
+            exist locally. *(Defaults to False.)*
+        workers : int
+            The maximum number of concurrent uploads. *(Defaults to 4.)*
+        hash_workers : int
+            The number of processes used to hash large files. *(Defaults to
+            the number of CPUs.)*
+        hash_threshold : int
+            The size, in bytes, from which files are hashed in the process
+            pool. *(Defaults to 8 MiB.)*
+        manifest : str
+            The path of the manifest file. It is excluded from the mirror.
+            *(Defaults to .pykblib-mirror.json within local_dir.)*
+
+        Returns
+        -------
+        MirrorResult
+            A namedtuple of lists of the relative paths that were uploaded,
+            deleted, left unchanged, and that failed to upload.
+
+        Raises
+        ------
+        KBFSException
+            If the manifest can't be read or written, a KBFSException is
+            raised.
+
+        """
+        if manifest is None:
+            manifest = os.path.join(local_dir, MANIFEST_NAME)
+        previous = self._load_manifest(manifest, remote_dir)
+        files = dict()
+        skip = os.path.abspath(manifest)
+        for root, _, names in os.walk(local_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.abspath(path) in (skip, skip + ".tmp"):
+                    continue
+                relative = os.path.relpath(path, local_dir)
+                stat = os.stat(path)
+                files[relative.replace(os.sep, "/")] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                }
+        current = dict()
+        unchanged = list()
+        to_hash = list()
+        for relative, entry in sorted(files.items()):
+            known = previous.get(relative)
+            if (
+                known is not None
+                and known["size"] == entry["size"]
+                and known["mtime"] == entry["mtime"]
+            ):
+                current[relative] = known
+                unchanged.append(relative)
+            else:
+                to_hash.append(relative)
+        digests = self._hash_files(
+            local_dir, to_hash, files, hash_workers, hash_threshold
+        )
+        to_upload = list()
+        for relative in to_hash:
+            entry = dict(files[relative], sha256=digests[relative])
+            known = previous.get(relative)
+            if known is not None and known["sha256"] == entry["sha256"]:
+                # Touched, but not modified.
+                current[relative] = entry
+                unchanged.append(relative)
+            else:
+                to_upload.append(relative)
+        uploaded = list()
+        failed = list()
+        deleted = list()
+        finished = False
+        try:
+            parents = sorted(
+                {posixpath.dirname(relative) for relative in to_upload}
+            )
+            for parent in parents:
+                self.makedirs(posixpath.join(remote_dir, parent))
+
+            def upload(relative):
+                with open(os.path.join(local_dir, relative), "rb") as source:
+                    self.write(posixpath.join(remote_dir, relative), source)
+
+            upload = bind_deadline(upload)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(upload, relative): relative
+                    for relative in to_upload
+                }
+                for future in as_completed(futures):
+                    relative = futures[future]
+                    try:
+                        future.result()
+                    except (KBFSException, OSError):
+                        failed.append(relative)
+                        continue
+                    current[relative] = dict(
+                        files[relative], sha256=digests[relative]
+                    )
+                    uploaded.append(relative)
+            for relative in sorted(set(previous) - set(files)):
+                if not delete:
+                    current[relative] = previous[relative]
+                    continue
+                try:
+                    self.remove(posixpath.join(remote_dir, relative))
+                    deleted.append(relative)
+                except KBFSException:
+                    current[relative] = previous[relative]
+            finished = True
+        finally:
+            if not finished:
+                # Remember the remote files that weren't reached, so that
+                # later runs can still update or delete them.
+                for relative, entry in previous.items():
+                    if relative not in deleted:
+                        current.setdefault(relative, entry)
+            self._save_manifest(manifest, remote_dir, current)
+        return MirrorResult(
+            sorted(uploaded), deleted, unchanged, sorted(failed)
+        )
+
+    def open(self, path, mode="rb"):
+        """Open a file in the team's folder as a binary stream.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+        mode : str
+            Either `rb` to read, `wb` to write, or `ab` to append. *(Defaults
+            to rb.)*
+
+        Returns
+        -------
+        file : file
+            A binary file object. Errors reported by the keybase client are
+            raised as a KBFSException when the file is closed.
+
+        Raises
+        ------
+        KBFSException
+            If the file could not be opened, a KBFSException is raised.
+
+        """
+        if mode not in ("rb", "wb", "ab"):
+            raise KBFSException("Unsupported file mode {}.".format(mode))
+        if self.mounted:
+            try:
+                return open(self.local_path(path), mode)
+            except OSError as error:
+                raise KBFSException(
+                    "Could not open {}: {}".format(path, error.strerror)
+                )
+        if mode == "rb":
+            process = self._spawn(
+                ["fs", "read", self.kbfs_path(path)], stdout=subprocess.PIPE
+            )
+            return KBFSFile(process, process.stdout, path)
+        arguments = ["fs", "write"]
+        if mode == "ab":
+            arguments.append("--append")
+        process = self._spawn(
+            arguments + [self.kbfs_path(path)], stdin=subprocess.PIPE
+        )
+        return KBFSFile(process, process.stdin, path)
+
+    def read(self, path, chunk_size=CHUNK_SIZE):
+        """Yield the contents of a file in fixed-size chunks.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+        chunk_size : int
+            The maximum size of each chunk, in bytes. *(Defaults to 64 KiB.)*
+
+        Yields
+        ------
+        chunk : bytes
+            Each successive chunk of the file.
+
+        Raises
+        ------
+        KBFSException
+            If the file could not be read, a KBFSException is raised.
+
+        """
+        with self.open(path, "rb") as source:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                yield chunk
+
+    def read_range(self, path, offset, length):
+        """Read a range of bytes from a file in the team's folder.
+
+        When KBFS is mounted, only the requested range is read from the file.
+        Otherwise, `keybase fs read` is asked to start at the offset, and is
+        stopped as soon as enough data has been received.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+        offset : int
+            The position of the first byte to read.
+        length : int
+            The maximum number of bytes to read.
+
+        Returns
+        -------
+        data : bytes
+            The data read, which is shorter than `length` if the end of the
+            file was reached.
+
+        Raises
+        ------
+        KBFSException
+            If the file could not be read, a KBFSException is raised.
+
+        """
+        if self.mounted:
+            with self.open(path, "rb") as source:
+                source.seek(offset)
+                return source.read(length)
+        process = self._spawn(
+            [
+                "fs",
+                "read",
+                "--offset",
+                str(offset),
+                "--size",
+                str(length),
+                self.kbfs_path(path),
+            ],
+            stdout=subprocess.PIPE,
+        )
+        chunks = list()
+        remaining = length
+        with KBFSFile(process, process.stdout, path) as source:
+            while remaining > 0:
+                chunk = source.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def remove(self, path):
+        """Delete a file from the team's folder.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+
+        Raises
+        ------
+        KBFSException
+            If the file could not be deleted, a KBFSException is raised.
+
+        """
+        if self.mounted:
+            try:
+                os.remove(self.local_path(path))
+            except OSError as error:
+                raise KBFSException(
+                    "Could not remove {}: {}".format(path, error.strerror)
+                )
+            return
+        self._run(["fs", "rm", self.kbfs_path(path)], path)
+
+    @contextmanager
+    def view(self, path, offset=0, length=None):
+        """Provide a zero-copy view of a range of a file in the team's folder.
+
+        This requires the KBFS mount. The view is only valid within the
+        `with` block, after which the underlying memory map is closed.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+        offset : int
+            The position of the first byte of the view. *(Defaults to 0.)*
+        length : int
+            The maximum length of the view, or None to view the rest of the
+            file. *(Defaults to None.)*
+
+        Yields
+        ------
+        view : memoryview
+            A read-only view of the requested range.
+
+        Raises
+        ------
+        KBFSException
+            If KBFS isn't mounted, or the file cannot be opened, a
+            KBFSException is raised.
+
+        """
+        if not self.mounted:
+            raise KBFSException(
+                "Viewing {} requires the KBFS mount.".format(path)
+            )
+        if os.path.isfile(self.local_path(path)) and not os.path.getsize(
+            self.local_path(path)
+        ):
+            # Empty files can't be memory-mapped.
+            yield memoryview(b"")
+            return
+        mapping = self.map(path)
+        end = None if length is None else offset + length
+        view = memoryview(mapping)
+        try:
+            with view[offset:end] as window:
+                yield window
+        finally:
+            view.release()
+            mapping.close()
+
+    def write(self, path, data, chunk_size=CHUNK_SIZE, append=False):
+        """Write data to a file in the team's folder.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file, relative to the team's folder.
+        data : bytes, file or iterable
+            The data to write: a bytes object, a readable binary stream (which
+            is copied in chunks), or an iterable of bytes objects.
+        chunk_size : int
+            The size of the chunks read from a stream, in bytes. *(Defaults
+            to 64 KiB.)*
+        append : bool
+            Whether to append to the file rather than replace it. *(Defaults
+            to False.)*
+
+        Returns
+        -------
+        size : int
+            The number of bytes written.
+
+        Raises
+        ------
+        KBFSException
+            If the file could not be written, a KBFSException is raised.
+
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            chunks = [data]
+        elif hasattr(data, "read"):
+            chunks = iter(lambda: data.read(chunk_size), b"")
+        else:
+            chunks = data
+        size = 0
+        with self.open(path, "ab" if append else "wb") as target:
+            for chunk in chunks:
+                target.write(chunk)
+                size += len(chunk)
+        return size
+
+    def _hash_files(self, local_dir, relatives, files, workers, threshold):
+        """Hash the specified local files.
+
+        Parameters
+        ----------
+        local_dir : str
+            The local directory containing the files.
+        relatives : list
+            The paths of the files to hash, relative to local_dir.
+        files : dict
+            The size and modification time of each file, by relative path.
+        workers : int
+            The number of processes used to hash large files, or None for the
+            number of CPUs.
+        threshold : int
+            The size, in bytes, from which files are hashed in the process
+            pool.
+
+        Returns
+        -------
+        digests : dict
+            The SHA-256 digest of each file, by relative path.
+
+        """
+        digests = dict()
+        large = [
+            relative
+            for relative in relatives
+            if files[relative]["size"] >= threshold
+        ]
+        if large:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                paths = [os.path.join(local_dir, name) for name in large]
+                digests.update(zip(large, pool.map(_hash_file, paths)))
+        for relative in relatives:
+            if relative not in digests:
+                digests[relative] = _hash_file(
+                    os.path.join(local_dir, relative)
+                )
+        return digests
+
+    def _load_manifest(self, manifest, remote_dir):
+        """Load the entries of a mirror manifest.
+
+        Parameters
+        ----------
+        manifest : str
+            The path of the manifest file.
+        remote_dir : str
+            The destination directory of the mirror.
+
+        Returns
+        -------
+        entries : dict
+            The manifest entries by relative path, or an empty dict if the
+            manifest doesn't exist or belongs to a different destination.
+
+        """
+        try:
+            with open(manifest) as source:
+                contents = json.load(source)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as error:
+            raise KBFSException(
+                "Could not read manifest {}: {}".format(manifest, error)
+            )
+        if contents.get("remote") != self.kbfs_path(remote_dir):
+            return dict()
+        return contents.get("files", dict())
+
+    def _run(self, arguments, path):
+        """Run a `keybase fs` command to completion.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the keybase client.
+        path : str
+            The path the command acts on, used in error messages.
+
+        Raises
+        ------
+        KBFSException
+            If the command fails, a KBFSException is raised.
+
+        """
+        process = self._spawn(arguments)
+        error = process.stderr.read()
+        process.stderr.close()
+        if process.wait():
+            raise KBFSException(
+                "Could not access {}: {}".format(path, error.decode().strip())
+            )
+
+    def _save_manifest(self, manifest, remote_dir, entries):
+        """Atomically write a mirror manifest.
+
+        Parameters
+        ----------
+        manifest : str
+            The path of the manifest file.
+        remote_dir : str
+            The destination directory of the mirror.
+        entries : dict
+            The manifest entries by relative path.
+
+        """
+        contents = {"remote": self.kbfs_path(remote_dir), "files": entries}
+        temporary = manifest + ".tmp"
+        try:
+            with open(temporary, "w") as target:
+                json.dump(contents, target, sort_keys=True)
+            os.replace(temporary, manifest)
+        except OSError as error:
+            raise KBFSException(
+                "Could not write manifest {}: {}".format(manifest, error)
+            )
+
+    def _spawn(self, arguments, stdin=None, stdout=None):
+        """Start a `keybase fs` process.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the keybase client.
+        stdin : int
+            The process's standard input. *(Defaults to None.)*
+        stdout : int
+            The process's standard output. *(Defaults to None.)*
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process.
+
+        Raises
+        ------
+        KBFSException
+            If the keybase client could not be started, a KBFSException is
+            raised.
+
+        """
+        try:
+            return self._team._api.open_process(
+                arguments, stdin=stdin, stdout=stdout
+            )
+        except APIException as exception:
+            raise KBFSException(exception.message)
+
+
+class KBFSFile:
+    """A binary file object backed by a `keybase fs` process's pipe."""
+
+    def __init__(self, process, pipe, path):
+        """Initialize the KBFSFile class.
+
+        Parameters
+        ----------
+        process : subprocess.Popen
+            The `keybase fs` process.
+        pipe : file
+            The process's standard output when reading, or its standard input
+            when writing.
+        path : str
+            The path of the file, used in error messages.
+
+        """
+        self._eof = False
+        self._process = process
+        self._pipe = pipe
+        self.closed = False
+        self.name = path
+
+    def __enter__(self):
+        """Allow the file to be used as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the file."""
+        self.close()
+
+    def __iter__(self):
+        """Iterate over the lines of the file."""
+        for line in self._pipe:
+            yield line
+        self._eof = True
+
+    def close(self):
+        """Close the pipe and wait for the keybase client to finish.
+
+        If a file being read is closed before it has been read to the end, the
+        keybase client is simply stopped.
+
+        Raises
+        ------
+        KBFSException
+            If the keybase client reported an error, a KBFSException is
+            raised.
+
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._pipe.close()
+        if self.readable() and not self._eof:
+            self._process.kill()
+            self._process.wait()
+            self._process.stderr.close()
+            return
+        error = self._process.stderr.read()
+        self._process.stderr.close()
+        if self._process.wait():
+            raise KBFSException(
+                "Could not access {}: {}".format(
+                    self.name, error.decode().strip()
+                )
+            )
+
+    def read(self, size=-1):
+        """Read up to the specified number of bytes.
+
+        Parameters
+        ----------
+        size : int
+            The maximum number of bytes to read, or -1 to read until EOF.
+            *(Defaults to -1.)*
+
+        Returns
+        -------
+        data : bytes
+            The data read, or an empty bytes object at EOF.
+
+        """
+        data = self._pipe.read(size)
+        if not data or size < 0:
+            self._eof = True
+        return data
+
+    def readable(self):
+        """Return whether the file was opened for reading."""
+        return self._pipe is self._process.stdout
+
+    def writable(self):
+        """Return whether the file was opened for writing."""
+        return self._pipe is self._process.stdin
+
+    def write(self, data):
+        """Write the specified data to the file.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to be written.
+
+        Returns
+        -------
+        size : int
+            The number of bytes written.
+
+        Raises
+        ------
+        KBFSException
+            If the keybase client exited early, a KBFSException is raised.
+
+        """
+        try:
+            self._pipe.write(data)
+        except BrokenPipeError:
+            self.closed = True
+            error = self._process.stderr.read().decode().strip()
+            self._process.wait()
+            raise KBFSException(
+                "Could not write {}: {}".format(self.name, error)
+            )
+        return len(data)
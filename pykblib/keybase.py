@@ -1,10 +1,21 @@
 """Defines the core Keybase class."""
 
-from collections import defaultdict
-
-from pykblib.api import KeybaseAPI
+import re
+import shlex
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.api import KeybaseAPI, bind_deadline
+from pykblib.cache import TTLCache
+from pykblib.chat import Chat
+from pykblib.crypto import Crypto
 from pykblib.exceptions import APIException, KeybaseException, TeamException
 from pykblib.team import Team
+from pykblib.wallet import Wallet
+
+UserLookup = namedtuple("UserLookup", ["valid", "username", "error"])
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
 
 
 class Keybase:
@@ -12,17 +23,80 @@ class Keybase:
 
     Attributes
     ----------
+    chat : Chat
+        The interface to the active user's Keybase chat.
+    crypto : Crypto
+        The interface for encrypting and signing data as the active user.
     teams : list
         The list of teams to which the active user belongs.
     username : str
         The username of the active user.
+    wallet : Wallet
+        The interface to the active user's Stellar wallet.
 
     """
 
-    def __init__(self):
-        """Ensure that the class has everything it needs to succeed."""
+    def __init__(
+        self,
+        transport=None,
+        executable="keybase",
+        hooks=None,
+        timeout=None,
+        scheduler=None,
+        retry=None,
+        breaker=None,
+        team_cache=None,
+    ):
+        """Ensure that the class has everything it needs to succeed.
+
+        Parameters
+        ----------
+        transport : object
+            A transport to handle Keybase commands in-process, such as
+            `pykblib.fake.FakeKeybase`. *(Defaults to None, in which case the
+            keybase client is used.)*
+        executable : str
+            The command used to start the keybase client. *(Defaults to
+            keybase.)*
+        hooks : pykblib.metrics.CallHooks
+            Instrumentation hooks to call before and after each call to
+            Keybase, including those made while initializing. *(Defaults to
+            None.)*
+        timeout : float
+            The maximum number of seconds allowed for each call to Keybase.
+            Use `pykblib.api.deadline` to limit the total time taken by
+            several calls. *(Defaults to None, for no limit.)*
+        scheduler : pykblib.limits.Scheduler
+            A scheduler limiting the rate and concurrency of calls that
+            change teams, which adapts to the load the Keybase server accepts.
+            *(Defaults to None.)*
+        retry : pykblib.retry.RetryPolicy
+            A policy for retrying calls that fail because of the keybase
+            client or service. *(Defaults to None.)*
+        breaker : pykblib.retry.CircuitBreaker
+            A circuit breaker which fails calls fast while the keybase
+            service appears to be down. *(Defaults to None.)*
+        team_cache : pykblib.cache.SharedTeamCache
+            A cache in which processes on the same host share team membership
+            and team lists, to avoid fetching them repeatedly. *(Defaults to
+            None.)*
+
+        """
         self._active_teams = dict()
-        self._api = KeybaseAPI()
+        self._api = KeybaseAPI(
+            transport,
+            executable,
+            hooks,
+            timeout,
+            scheduler,
+            retry,
+            breaker,
+            team_cache,
+        )
+        self._users = TTLCache(maxsize=4096, ttl=3600)
+        self.chat = Chat(self)
+        self.crypto = Crypto(self)
+        self.wallet = Wallet(self)
         self.username = self._get_username()
         self.teams = list()
         self.update_team_list()
@@ -85,6 +159,10 @@ class Keybase:
     def delete_team(self, team_name):
         """Delete the specified team, and all of its sub-teams.
 
+        When called within a `pykblib.api.deadline`, the deletions share what
+        remains of it, and the first to run out of time raises a
+        TimeoutException, leaving the remaining teams in place.
+
         Parameters
         ----------
         team_name : str
@@ -216,6 +294,58 @@ class Keybase:
                 requests[team_name].add(user_name)
         return requests
 
+    def lookup_users(self, names, max_workers=8, negative_ttl=60):
+        """Resolve many usernames or social assertions concurrently.
+
+        Results are cached for an hour, so repeated lookups of the same names
+        don't reach the Keybase service. Names that couldn't be resolved are
+        cached for a shorter time, since the failure may have been transient.
+
+        Parameters
+        ----------
+        names : iterable
+            The usernames or assertions to resolve, e.g. `alice` or
+            `alice@github`.
+        max_workers : int
+            The maximum number of lookups made at once. *(Defaults to 8.)*
+        negative_ttl : float
+            The number of seconds for which failed lookups are cached.
+            *(Defaults to 60.)*
+
+        Returns
+        -------
+        results : dict
+            A dict with the names for keys and `UserLookup` namedtuples,
+            containing `valid`, the resolved `username`, and the `error`
+            reported by Keybase, as values.
+
+        """
+        names = list(dict.fromkeys(names))
+        results = {name: self._users.get(name) for name in names}
+        pending = [name for name in names if results[name] is None]
+
+        def lookup(name):
+            try:
+                output = self._api.run_command(
+                    "id {}".format(shlex.quote(name))
+                )
+            except APIException as exception:
+                result = UserLookup(False, None, exception.message)
+                self._users.set(name, result, ttl=negative_ttl)
+                return result
+            output = _ANSI_ESCAPE.sub("", output)
+            match = re.search(r"Identifying (\S+)", output)
+            result = UserLookup(True, match.group(1) if match else name, None)
+            self._users.set(name, result)
+            return result
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                results.update(
+                    zip(pending, pool.map(bind_deadline(lookup), pending))
+                )
+        return results
+
     def request_access(self, team_name):
         """Request access to the specified team name.
 
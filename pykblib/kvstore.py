@@ -0,0 +1,569 @@
+"""Defines the KVStore class."""
+
+import threading
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.api import bind_deadline
+from pykblib.exceptions import (
+    APIException,
+    KVConflictException,
+    KVStoreException,
+    TimeoutException,
+)
+
+_DELETED = object()
+
+
+class KVStore(MutableMapping):
+    """A mapping-like interface to one namespace of a team's key-value store.
+
+    Values are strings. Every entry that is read or written is cached locally
+    along with its revision, and `KVStore.refresh` compares the cached
+    revisions against the store's listing in a single query, so unchanged
+    entries never have to be fetched twice.
+
+    Writes that carry a known revision are checked against the store, so an
+    entry that was changed by another writer since it was last read raises a
+    KVConflictException rather than being silently overwritten.
+
+    With `write_back` enabled, writes are held locally and coalesced until
+    `KVStore.flush` is called, the store is used as a context manager, or
+    `flush_delay` seconds have passed since the first pending write.
+
+    Attributes
+    ----------
+    namespace : str
+        The namespace within the team's store.
+    write_back : bool
+        Whether writes are held locally until flushed.
+    flush_delay : float
+        The number of seconds after which pending writes are flushed
+        automatically, or None to flush them only on request.
+    workers : int
+        The number of concurrent queries made by the bulk functions.
+
+    """
+
+    def __init__(
+        self,
+        team,
+        namespace="default",
+        write_back=False,
+        flush_delay=None,
+        workers=8,
+    ):
+        """Initialize the KVStore class.
+
+        Parameters
+        ----------
+        team : Team
+            The Team whose key-value store this KVStore accesses.
+        namespace : str
+            The namespace within the team's store. *(Defaults to default.)*
+        write_back : bool
+            Whether writes are held locally until flushed. *(Defaults to
+            False.)*
+        flush_delay : float
+            The number of seconds after which pending writes are flushed
+            automatically. *(Defaults to None.)*
+        workers : int
+            The number of concurrent queries made by the bulk functions.
+            *(Defaults to 8.)*
+
+        """
+        self._cache = dict()
+        self._lock = threading.RLock()
+        self._pending = dict()
+        self._team = team
+        self._timer = None
+        self.flush_delay = flush_delay
+        self.namespace = namespace
+        self.workers = workers
+        self.write_back = write_back
+
+    def __delitem__(self, key):
+        """Delete an entry, raising a KeyError if it doesn't exist."""
+        if key not in self:
+            raise KeyError(key)
+        if self.write_back:
+            self._hold(key, _DELETED)
+        else:
+            self.delete(key)
+
+    def __enter__(self):
+        """Use the store as a context manager that flushes on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Flush any pending writes."""
+        self.flush()
+
+    def __getitem__(self, key):
+        """Retrieve an entry's value, or raise a KeyError if it's missing."""
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        """Iterate over the keys in the namespace."""
+        return iter(self.keys())
+
+    def __len__(self):
+        """Return the number of entries in the namespace."""
+        return len(self.keys())
+
+    def __setitem__(self, key, value):
+        """Write an entry, checking its cached revision if there is one."""
+        if self.write_back:
+            self._hold(key, value)
+        else:
+            self.put(key, value)
+
+    def delete(self, key, revision=None):
+        """Delete an entry from the store.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        revision : int
+            The revision the entry is expected to have. *(Defaults to the
+            cached revision, if any.)*
+
+        Returns
+        -------
+        revision : int
+            The entry's new revision.
+
+        Raises
+        ------
+        KVConflictException
+            If the entry was changed by another writer, a KVConflictException
+            is raised.
+        KVStoreException
+            If the entry could not be deleted, a KVStoreException is raised.
+
+        """
+        return self._write("del", key, None, revision)
+
+    def flush(self):
+        """Write any pending writes to the store.
+
+        The pending writes are made concurrently. Those that fail remain
+        pending, so that the flush can be retried.
+
+        Raises
+        ------
+        KVConflictException
+            If any of the entries were changed by another writer, a
+            KVConflictException is raised.
+        KVStoreException
+            If any of the writes failed, a KVStoreException is raised.
+        TimeoutException
+            If any of the writes timed out, a TimeoutException is raised.
+
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+        try:
+            failed = self._write_many(pending)
+        except BaseException:
+            # Nothing is known to have been written, so keep every write.
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending.setdefault(key, value)
+            raise
+        if failed:
+            with self._lock:
+                for key in failed:
+                    # Writes made during the flush take precedence.
+                    self._pending.setdefault(key, pending[key])
+            self._raise_failures(failed)
+
+    def get(self, key, default=None, fresh=False):
+        """Retrieve an entry's value.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        default : str
+            The value to return if the entry doesn't exist. *(Defaults to
+            None.)*
+        fresh : bool
+            Whether to bypass the cache and query the store. *(Defaults to
+            False.)*
+
+        Returns
+        -------
+        value : str
+            The entry's value, or the default.
+
+        Raises
+        ------
+        KVStoreException
+            If the entry could not be retrieved, a KVStoreException is raised.
+
+        """
+        with self._lock:
+            if key in self._pending:
+                value = self._pending[key]
+                return default if value is _DELETED else value
+            if not fresh and key in self._cache:
+                value = self._cache[key][1]
+                return default if value is None else value
+        value = self._fetch(key)
+        return default if value is None else value
+
+    def get_many(self, keys, fresh=False):
+        """Retrieve the values of many entries concurrently.
+
+        Parameters
+        ----------
+        keys : iterable
+            The keys of the entries.
+        fresh : bool
+            Whether to refresh the cache before reading. Only the entries
+            whose revisions have changed are then fetched again. *(Defaults to
+            False.)*
+
+        Returns
+        -------
+        values : dict
+            The values of the entries that exist, by key.
+
+        Raises
+        ------
+        KVStoreException
+            If any entry could not be retrieved, a KVStoreException is raised.
+
+        """
+        keys = list(keys)
+        if fresh:
+            self.refresh()
+        with self._lock:
+            missing = [
+                key
+                for key in keys
+                if key not in self._pending and key not in self._cache
+            ]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(bind_deadline(self._fetch), missing))
+        values = dict()
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def keys(self):
+        """List the keys in the namespace.
+
+        Returns
+        -------
+        keys : list
+            The keys of the entries in the namespace, including any pending
+            writes.
+
+        Raises
+        ------
+        KVStoreException
+            If the keys could not be listed, a KVStoreException is raised.
+
+        """
+        keys = set(self._list())
+        with self._lock:
+            for key, value in self._pending.items():
+                if value is _DELETED:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return sorted(keys)
+
+    def put(self, key, value, revision=None):
+        """Write an entry to the store.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        value : str
+            The entry's value.
+        revision : int
+            The revision the entry is expected to have. *(Defaults to the
+            cached revision, if any.)*
+
+        Returns
+        -------
+        revision : int
+            The entry's new revision.
+
+        Raises
+        ------
+        KVConflictException
+            If the entry was changed by another writer, a KVConflictException
+            is raised.
+        KVStoreException
+            If the entry could not be written, a KVStoreException is raised.
+
+        """
+        return self._write("put", key, value, revision)
+
+    def put_many(self, entries):
+        """Write many entries to the store concurrently.
+
+        Parameters
+        ----------
+        entries : dict
+            The values to write, by key.
+
+        Raises
+        ------
+        KVConflictException
+            If any of the entries were changed by another writer, a
+            KVConflictException is raised.
+        KVStoreException
+            If any of the writes failed, a KVStoreException is raised.
+        TimeoutException
+            If any of the writes timed out, a TimeoutException is raised.
+
+        """
+        failed = self._write_many(dict(entries))
+        if failed:
+            self._raise_failures(failed)
+
+    def refresh(self):
+        """Drop any cached entries whose revisions have changed.
+
+        This takes a single query, regardless of the number of entries.
+
+        Raises
+        ------
+        KVStoreException
+            If the keys could not be listed, a KVStoreException is raised.
+
+        """
+        revisions = self._list()
+        with self._lock:
+            for key in list(self._cache):
+                if revisions.get(key, 0) != self._cache[key][0]:
+                    del self._cache[key]
+
+    def _fetch(self, key):
+        """Retrieve an entry from the store and cache it.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+
+        Returns
+        -------
+        value : str
+            The entry's value, or None if it doesn't exist.
+
+        Raises
+        ------
+        KVStoreException
+            If the entry could not be retrieved, a KVStoreException is raised.
+
+        """
+        response = self._query("get", {"entryKey": key})
+        value = getattr(response.result, "entryValue", None)
+        with self._lock:
+            self._cache[key] = (response.result.revision, value)
+        return value
+
+    def _hold(self, key, value):
+        """Hold a write until the store is flushed.
+
+        Parameters
+        ----------
+        key : str
+            The entry's key.
+        value : str
+            The entry's value, or _DELETED to delete it.
+
+        """
+        with self._lock:
+            self._pending[key] = value
+            if self.flush_delay is not None and self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _list(self):
+        """List the keys in the namespace with their revisions.
+
+        Returns
+        -------
+        revisions : dict
+            The revision of each existing entry, by key.
+
+        Raises
+        ------
+        KVStoreException
+            If the keys could not be listed, a KVStoreException is raised.
+
+        """
+        response = self._query("list", dict())
+        return {
+            entry.entryKey: entry.revision
+            for entry in getattr(response.result, "entryKeys", None) or []
+        }
+
+    def _query(self, method, options):
+        """Send a query to the team's key-value store.
+
+        Parameters
+        ----------
+        method : str
+            The kvstore API method.
+        options : dict
+            The options for the method, besides the team and namespace.
+
+        Returns
+        -------
+        response : namedtuple
+            The API's response.
+
+        Raises
+        ------
+        KVConflictException
+            If the store reported a revision conflict, a KVConflictException
+            is raised.
+        KVStoreException
+            If the query failed, a KVStoreException is raised.
+
+        """
+        options = dict(options, team=self._team.name, namespace=self.namespace)
+        query = {"method": method, "params": {"options": options}}
+        try:
+            return self._team._api.call_api("kvstore", query)
+        except APIException as exception:
+            key = options.get("entryKey", self.namespace)
+            if "revision" in exception.message.lower():
+                raise KVConflictException(
+                    "{} was changed by another writer.".format(key)
+                )
+            raise KVStoreException(
+                "Could not {} {}: {}".format(method, key, exception.message)
+            )
+
+    def _raise_failures(self, failed):
+        """Raise an exception summarizing the failures of a bulk write.
+
+        Parameters
+        ----------
+        failed : dict
+            The exception raised for each failed write, by key.
+
+        Raises
+        ------
+        KVConflictException
+            If any of the writes conflicted, a KVConflictException is raised.
+        TimeoutException
+            If any of the writes timed out, a TimeoutException is raised.
+        KVStoreException
+            Otherwise, a KVStoreException is raised.
+
+        """
+        keys = ", ".join(sorted(failed))
+        if any(
+            isinstance(exception, KVConflictException)
+            for exception in failed.values()
+        ):
+            raise KVConflictException(
+                "Conflicting writes to: {}.".format(keys)
+            )
+        if any(
+            isinstance(exception, TimeoutException)
+            for exception in failed.values()
+        ):
+            raise TimeoutException("Timed out writing: {}.".format(keys))
+        raise KVStoreException("Could not write: {}.".format(keys))
+
+    def _write(self, method, key, value, revision):
+        """Write or delete an entry and update the cache.
+
+        Parameters
+        ----------
+        method : str
+            Either put or del.
+        key : str
+            The entry's key.
+        value : str
+            The entry's value, when writing.
+        revision : int
+            The revision the entry is expected to have, or None to use the
+            cached revision, if any.
+
+        Returns
+        -------
+        revision : int
+            The entry's new revision.
+
+        Raises
+        ------
+        KVConflictException
+            If the entry was changed by another writer, a KVConflictException
+            is raised.
+        KVStoreException
+            If the entry could not be written, a KVStoreException is raised.
+
+        """
+        options = {"entryKey": key}
+        if value is not None:
+            options["entryValue"] = value
+        with self._lock:
+            if revision is None and key in self._cache:
+                revision = self._cache[key][0]
+        if revision is not None:
+            options["revision"] = revision + 1
+        try:
+            response = self._query(method, options)
+        except KVConflictException:
+            with self._lock:
+                self._cache.pop(key, None)
+            raise
+        with self._lock:
+            self._cache[key] = (response.result.revision, value)
+        return response.result.revision
+
+    def _write_many(self, entries):
+        """Write or delete many entries concurrently.
+
+        Parameters
+        ----------
+        entries : dict
+            The values to write, or _DELETED, by key.
+
+        Returns
+        -------
+        failed : dict
+            The exception raised for each failed write, by key.
+
+        """
+
+        def write(item):
+            key, value = item
+            try:
+                if value is _DELETED:
+                    self.delete(key)
+                else:
+                    self.put(key, value)
+            except Exception as exception:
+                return key, exception
+            return key, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(bind_deadline(write), entries.items())
+            return {key: error for key, error in results if error is not None}
@@ -0,0 +1,614 @@
+"""Defines the rate and concurrency limiters used by PyKBLib."""
+
+import contextlib
+import re
+import threading
+import time
+from collections import deque
+
+from pykblib.metrics import Histogram
+
+# The method class of each mutating call, by service and method name.
+DEFAULT_CLASSES = {
+    ("team", "add-members"): "team-write",
+    ("team", "create-team"): "team-write",
+    ("team", "delete"): "team-write",
+    ("team", "edit-member"): "team-write",
+    ("team", "ignore-request"): "team-write",
+    ("team", "leave-team"): "team-write",
+    ("team", "remove-member"): "team-write",
+    ("team", "rename-subteam"): "team-write",
+    ("team", "request-access"): "team-write",
+}
+
+# The maximum number of calls per second for each method class.
+DEFAULT_RATES = {"team-write": 10}
+
+# The priority lanes, from highest to lowest priority.
+LANES = ("interactive", "bulk")
+INTERACTIVE, BULK = LANES
+
+# Error messages indicating that the Keybase server is shedding load.
+THROTTLE_PATTERN = re.compile(
+    r"rate.?limit|too many|throttl|\b429\b|try again later", re.IGNORECASE
+)
+
+
+class TokenBucket:
+    """A thread-safe token bucket rate limiter.
+
+    Tokens are added at a steady rate up to the bucket's capacity, and each
+    operation consumes one. Short bursts up to the capacity are allowed, while
+    the long-term rate never exceeds the refill rate.
+
+    Attributes
+    ----------
+    rate : float
+        The number of tokens added per second.
+    capacity : float
+        The maximum number of tokens the bucket can hold.
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        """Initialize the TokenBucket class.
+
+        Parameters
+        ----------
+        rate : float
+            The number of tokens added per second.
+        capacity : float
+            The maximum number of tokens the bucket can hold. The bucket
+            starts full. *(Defaults to one second's worth of tokens, or at
+            least one.)*
+
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def acquire(self, tokens=1, timeout=None):
+        """Wait until the specified number of tokens can be consumed.
+
+        Parameters
+        ----------
+        tokens : float
+            The number of tokens to consume. *(Defaults to 1.)*
+        timeout : float
+            The maximum number of seconds to wait, or None to wait as long as
+            necessary. *(Defaults to None.)*
+
+        Returns
+        -------
+        acquired : bool
+            True if the tokens were consumed, or False if the timeout expired
+            first.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while 1:
+            wait = self._take(tokens)
+            if wait <= 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """Consume the specified number of tokens if they are available.
+
+        Parameters
+        ----------
+        tokens : float
+            The number of tokens to consume. *(Defaults to 1.)*
+
+        Returns
+        -------
+        acquired : bool
+            True if the tokens were consumed.
+
+        """
+        return self._take(tokens) <= 0
+
+    def _take(self, tokens):
+        """Refill the bucket, then consume tokens if enough are available.
+
+        Parameters
+        ----------
+        tokens : float
+            The number of tokens to consume.
+
+        Returns
+        -------
+        wait : float
+            Zero if the tokens were consumed, or otherwise the number of
+            seconds until enough tokens will be available.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+
+class AIMDLimiter:
+    """An adaptive concurrency limiter.
+
+    The number of operations allowed at once grows additively, by about
+    `increase` each time a full limit's worth of operations succeeds within
+    the latency target, and shrinks multiplicatively, by the `backoff` factor,
+    when an operation is throttled or exceeds the latency target. It shrinks
+    at most once for the operations started before the previous decrease, so
+    that a burst of errors from one round of operations only counts once.
+
+    Attributes
+    ----------
+    active : int
+        The number of operations in progress.
+    backoff : float
+        The factor by which the limit is multiplied when decreased.
+    increase : float
+        The amount by which the limit grows for each round of successes.
+    latency_target : float
+        The number of seconds above which an operation counts as congested,
+        or None to only back off when throttled.
+    limit : float
+        The current concurrency limit, of which the integer part is enforced.
+    maximum : int
+        The largest the limit can grow.
+    minimum : int
+        The smallest the limit can shrink.
+
+    """
+
+    def __init__(
+        self,
+        initial=4,
+        minimum=1,
+        maximum=64,
+        increase=1,
+        backoff=0.5,
+        latency_target=None,
+    ):
+        """Initialize the AIMDLimiter class.
+
+        Parameters
+        ----------
+        initial : int
+            The starting concurrency limit. *(Defaults to 4.)*
+        minimum : int
+            The smallest the limit can shrink. *(Defaults to 1.)*
+        maximum : int
+            The largest the limit can grow. *(Defaults to 64.)*
+        increase : float
+            The amount by which the limit grows for each round of successes.
+            *(Defaults to 1.)*
+        backoff : float
+            The factor by which the limit is multiplied when decreased.
+            *(Defaults to 0.5.)*
+        latency_target : float
+            The number of seconds above which an operation counts as
+            congested. *(Defaults to None.)*
+
+        """
+        self._condition = threading.Condition()
+        self._decreased = float("-inf")
+        self.active = 0
+        self.backoff = backoff
+        self.increase = increase
+        self.latency_target = latency_target
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+
+    def acquire(self, timeout=None):
+        """Wait until another operation is allowed to start.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait, or None to wait as long as
+            necessary. *(Defaults to None.)*
+
+        Returns
+        -------
+        acquired : bool
+            True if the operation may start, or False if the timeout expired
+            first. Each successful acquisition must be followed by a call to
+            `AIMDLimiter.release`.
+
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self.active < int(self.limit), timeout
+            ):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, started, throttled=False, failed=False):
+        """Finish an operation, and adjust the limit based on its outcome.
+
+        Parameters
+        ----------
+        started : float
+            The `time.monotonic()` value when the operation started.
+        throttled : bool
+            Whether the operation was rejected or slowed by the server.
+            *(Defaults to False.)*
+        failed : bool
+            Whether the operation failed for another reason, in which case
+            the limit is left unchanged. *(Defaults to False.)*
+
+        """
+        latency = time.monotonic() - started
+        congested = throttled or (
+            self.latency_target is not None and latency > self.latency_target
+        )
+        with self._condition:
+            self.active -= 1
+            if congested:
+                if started >= self._decreased:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._decreased = time.monotonic()
+            elif not failed:
+                self.limit = min(
+                    self.maximum, self.limit + self.increase / self.limit
+                )
+            self._condition.notify_all()
+
+
+class PriorityLanes:
+    """Shares a number of worker slots between lanes of differing priority.
+
+    A call in a lane can only start once every call queued in a higher lane
+    has started, and once it is first in its own lane's queue. Slots can be
+    reserved for a lane, in which case the other lanes can never use them, so
+    that, for example, bulk jobs can't occupy every slot while interactive
+    calls wait for theirs.
+
+    Attributes
+    ----------
+    capacity : int
+        The total number of calls that may run at once.
+    lanes : tuple
+        The names of the lanes, from highest to lowest priority.
+    reserved : dict
+        The number of slots reserved for each lane.
+
+    """
+
+    def __init__(self, capacity, lanes=LANES, reserved=None):
+        """Initialize the PriorityLanes class.
+
+        Parameters
+        ----------
+        capacity : int
+            The total number of calls that may run at once.
+        lanes : tuple
+            The names of the lanes, from highest to lowest priority.
+            *(Defaults to LANES, i.e. interactive and bulk.)*
+        reserved : dict
+            The number of slots reserved for each lane. *(Defaults to a
+            quarter of the capacity, or at least one slot, for the highest
+            priority lane.)*
+
+        """
+        if reserved is None:
+            reserved = {lanes[0]: max(1, capacity // 4)}
+        self._active = dict.fromkeys(lanes, 0)
+        self._condition = threading.Condition()
+        self._max_queued = dict.fromkeys(lanes, 0)
+        self._queues = {lane: deque() for lane in lanes}
+        self._waits = {lane: Histogram() for lane in lanes}
+        self.capacity = capacity
+        self.lanes = tuple(lanes)
+        self.reserved = reserved
+
+    def acquire(self, lane, timeout=None):
+        """Wait until a call in the specified lane is allowed to start.
+
+        Parameters
+        ----------
+        lane : str
+            The name of the call's lane.
+        timeout : float
+            The maximum number of seconds to wait, or None to wait as long as
+            necessary. *(Defaults to None.)*
+
+        Returns
+        -------
+        acquired : bool
+            True if the call may start, or False if the timeout expired
+            first. Each successful acquisition must be followed by a call to
+            `PriorityLanes.release`.
+
+        Raises
+        ------
+        ValueError
+            If the lane doesn't exist, a ValueError is raised.
+
+        """
+        if lane not in self._queues:
+            raise ValueError("Unknown priority lane {}.".format(lane))
+        ticket = object()
+        started = time.monotonic()
+        with self._condition:
+            queue = self._queues[lane]
+            queue.append(ticket)
+            self._max_queued[lane] = max(self._max_queued[lane], len(queue))
+            acquired = self._condition.wait_for(
+                lambda: self._may_start(lane, ticket), timeout
+            )
+            queue.remove(ticket)
+            if acquired:
+                self._active[lane] += 1
+                self._waits[lane].observe(time.monotonic() - started)
+            # The next call in this lane, or in a lower one, may now start.
+            self._condition.notify_all()
+            return acquired
+
+    def release(self, lane):
+        """Finish a call, freeing its slot.
+
+        Parameters
+        ----------
+        lane : str
+            The name of the call's lane.
+
+        """
+        with self._condition:
+            self._active[lane] -= 1
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """Return the current state and wait times of each lane.
+
+        Returns
+        -------
+        state : dict
+            A dict keyed by lane, holding the number of `active` and `queued`
+            calls, the largest number queued at once as `max_queued`, and a
+            histogram of the seconds waited for a slot as `wait`, in the
+            format used by `pykblib.metrics.MetricsCollector.snapshot`.
+
+        """
+        with self._condition:
+            return {
+                lane: {
+                    "active": self._active[lane],
+                    "queued": len(self._queues[lane]),
+                    "max_queued": self._max_queued[lane],
+                    "wait": self._waits[lane].snapshot(),
+                }
+                for lane in self.lanes
+            }
+
+    def _may_start(self, lane, ticket):
+        """Return True if the call holding the ticket may start now."""
+        if self._queues[lane][0] is not ticket:
+            return False
+        for other in self.lanes:
+            if other == lane:
+                break
+            if self._queues[other]:
+                return False
+        held = sum(
+            max(0, self.reserved.get(other, 0) - self._active[other])
+            for other in self.lanes
+            if other != lane
+        )
+        return sum(self._active.values()) + held < self.capacity
+
+
+class Scheduler:
+    """Limits the rate and concurrency of calls to Keybase by method class.
+
+    Calls are grouped into method classes, such as `team-write` for the
+    calls that change teams. Each class with a rate has its own TokenBucket
+    and AIMDLimiter, so that bulk jobs run as many calls at once as the
+    server sustains, and back off when it starts throttling them. Calls in
+    other classes are only limited by the priority lanes, if any.
+
+    Given a capacity, the Scheduler also limits the total number of calls run
+    at once, and shares them between PriorityLanes. Calls are made in the
+    interactive lane unless made within `pykblib.api.priority`, so that bulk
+    jobs can make way for interactive calls::
+
+        keybase = Keybase(scheduler=Scheduler(capacity=8))
+        with priority(BULK):
+            sync_members(keybase)
+
+    A Scheduler can be shared by several KeybaseAPI instances.
+
+    Attributes
+    ----------
+    classes : dict
+        The method class of each scheduled call, keyed by service and method
+        name.
+    limiters : dict
+        The AIMDLimiter of each method class.
+    buckets : dict
+        The TokenBucket of each method class.
+    lanes : PriorityLanes
+        The priority lanes, or None if the total isn't limited.
+
+    """
+
+    def __init__(
+        self,
+        rates=None,
+        classes=None,
+        limiter=None,
+        capacity=None,
+        reserved=None,
+    ):
+        """Initialize the Scheduler class.
+
+        Parameters
+        ----------
+        rates : dict
+            The maximum number of calls per second for each method class, or
+            None for no rate limit. *(Defaults to DEFAULT_RATES.)*
+        classes : dict
+            The method class of each scheduled call, keyed by `(service,
+            method)` tuples. *(Defaults to DEFAULT_CLASSES.)*
+        limiter : callable
+            A function returning a new concurrency limiter for a method
+            class. *(Defaults to AIMDLimiter.)*
+        capacity : int
+            The total number of calls that may run at once. *(Defaults to
+            None, for no limit.)*
+        reserved : dict
+            The number of slots reserved for each priority lane. *(Defaults
+            to a quarter of the capacity for the interactive lane.)*
+
+        """
+        rates = DEFAULT_RATES if rates is None else rates
+        limiter = AIMDLimiter if limiter is None else limiter
+        self._local = threading.local()
+        self.buckets = {
+            name: TokenBucket(rate)
+            for name, rate in rates.items()
+            if rate is not None
+        }
+        self.classes = DEFAULT_CLASSES if classes is None else classes
+        self.lanes = (
+            None
+            if capacity is None
+            else PriorityLanes(capacity, reserved=reserved)
+        )
+        self.limiters = {name: limiter() for name in rates}
+
+    def classify(self, service, method):
+        """Return the method class of a call.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+
+        Returns
+        -------
+        name : str
+            The name of the method class, or None if the call isn't scheduled.
+
+        """
+        name = self.classes.get((service, method))
+        return name if name in self.limiters else None
+
+    @contextlib.contextmanager
+    def slot(self, service, method, timeout=None, lane=None):
+        """Wait for a call's turn to run, and learn from its outcome.
+
+        Calls made from within a call that already holds a slot, such as the
+        command run by `KeybaseAPI.call_api`, are not scheduled again.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+        timeout : float
+            The maximum number of seconds to wait, or None to wait as long as
+            necessary. *(Defaults to None.)*
+        lane : str
+            The call's priority lane. *(Defaults to INTERACTIVE.)*
+
+        Yields
+        ------
+        acquired : bool
+            True if the call may run, or False if the timeout expired first.
+
+        """
+        name = self.classify(service, method)
+        lanes = self.lanes
+        if getattr(self._local, "held", False) or (
+            name is None and lanes is None
+        ):
+            yield True
+            return
+        expiry = None if timeout is None else time.monotonic() + timeout
+
+        def time_left():
+            if expiry is None:
+                return None
+            return max(0, expiry - time.monotonic())
+
+        lane = INTERACTIVE if lane is None else lane
+        if lanes is not None and not lanes.acquire(lane, timeout):
+            yield False
+            return
+        try:
+            limiter = None
+            if name is not None:
+                bucket = self.buckets.get(name)
+                if bucket is not None and not bucket.acquire(
+                    timeout=time_left()
+                ):
+                    yield False
+                    return
+                limiter = self.limiters[name]
+                if not limiter.acquire(time_left()):
+                    yield False
+                    return
+            started = time.monotonic()
+            self._local.held = True
+            try:
+                yield True
+            except Exception as exception:
+                if limiter is not None:
+                    message = getattr(exception, "message", str(exception))
+                    limiter.release(
+                        started,
+                        throttled=bool(THROTTLE_PATTERN.search(message or "")),
+                        failed=True,
+                    )
+                raise
+            except BaseException:
+                if limiter is not None:
+                    limiter.release(started, failed=True)
+                raise
+            else:
+                if limiter is not None:
+                    limiter.release(started)
+            finally:
+                self._local.held = False
+        finally:
+            if lanes is not None:
+                lanes.release(lane)
+
+    def snapshot(self):
+        """Return the current state of each method class.
+
+        Returns
+        -------
+        state : dict
+            A dict keyed by method class, holding each class's concurrency
+            `limit`, the number of `active` calls and its `rate`.
+
+        """
+        return {
+            name: {
+                "limit": int(limiter.limit),
+                "active": limiter.active,
+                "rate": (
+                    self.buckets[name].rate if name in self.buckets else None
+                ),
+            }
+            for name, limiter in self.limiters.items()
+        }
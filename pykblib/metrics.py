@@ -0,0 +1,462 @@
+"""Defines the instrumentation hooks and metrics collector for KeybaseAPI."""
+
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+
+CallInfo = namedtuple(
+    "CallInfo",
+    [
+        "service",
+        "method",
+        "duration",
+        "bytes_out",
+        "bytes_in",
+        "spawns",
+        "spawn_time",
+        "parse_time",
+        "error",
+    ],
+)
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# Commands whose second word names the operation, e.g. `team list-requests`.
+_SUBCOMMAND_SERVICES = ("chat", "fs", "team", "wallet")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def command_name(arguments):
+    """Return the service and method names describing a command.
+
+    Parameters
+    ----------
+    arguments : list
+        The command's arguments, without the leading `keybase`.
+
+    Returns
+    -------
+    names : tuple
+        The `(service, method)` pair. The method is the command's second word
+        for commands with sub-commands, such as `team list-requests`, and is
+        otherwise the same as the service, so that arguments like usernames
+        never become part of the name.
+
+    """
+    service = arguments[0] if arguments else ""
+    if service in _SUBCOMMAND_SERVICES and len(arguments) > 1:
+        return (service, arguments[1])
+    return (service, service)
+
+
+class _Call:
+    """The measurements of a call in progress."""
+
+    __slots__ = (
+        "service",
+        "method",
+        "start",
+        "bytes_out",
+        "bytes_in",
+        "spawns",
+        "spawn_time",
+        "parse_time",
+    )
+
+    def __init__(self, service, method, bytes_out):
+        """Start measuring a call."""
+        self.service = service
+        self.method = method
+        self.start = time.perf_counter()
+        self.bytes_out = bytes_out
+        self.bytes_in = None
+        self.spawns = 0
+        self.spawn_time = None
+        self.parse_time = None
+
+    def spawned(self, spawn_time=None):
+        """Record that a process was started, and how long it took."""
+        self.spawns += 1
+        if spawn_time is not None:
+            self.spawn_time = (self.spawn_time or 0) + spawn_time
+
+    def received(self, size):
+        """Record the number of bytes received."""
+        self.bytes_in = (self.bytes_in or 0) + size
+
+
+class CallHooks:
+    """Holds the hooks called before and after each KeybaseAPI call.
+
+    Pre-call hooks receive the service and method names of each call as it
+    starts. Post-call hooks receive a `CallInfo` namedtuple once it finishes,
+    containing the following:
+
+    * **service** and **method**: The call's names, e.g. `team` and
+      `add-members` for an API query, or `team` and `list-requests` for a
+      command.
+    * **duration**: The total number of seconds taken.
+    * **bytes_out** and **bytes_in**: The size of the query or command sent,
+      and of the output received, or None where unknown.
+    * **spawns**: The number of processes started.
+    * **spawn_time**: The number of seconds spent starting processes, or None
+      where it can't be told apart from waiting on them.
+    * **parse_time**: The number of seconds spent decoding the output, or
+      None if it wasn't decoded.
+    * **error**: The error message if the call failed, or None.
+
+    A call made from within another, such as the command run by
+    `KeybaseAPI.call_api`, is measured as part of the outer call. Exceptions
+    raised by hooks are logged and otherwise ignored.
+
+    Attributes
+    ----------
+    pre : list
+        The functions called before each call.
+    post : list
+        The functions called after each call.
+
+    """
+
+    def __init__(self):
+        """Initialize the CallHooks class."""
+        self._local = threading.local()
+        self.pre = list()
+        self.post = list()
+
+    def __bool__(self):
+        """Return True if any hooks are registered."""
+        return bool(self.pre or self.post)
+
+    def add(self, pre=None, post=None):
+        """Register hooks.
+
+        Parameters
+        ----------
+        pre : callable
+            A function called with the service and method names before each
+            call. *(Defaults to None.)*
+        post : callable
+            A function called with a `CallInfo` namedtuple after each call.
+            *(Defaults to None.)*
+
+        """
+        if pre is not None:
+            self.pre.append(pre)
+        if post is not None:
+            self.post.append(post)
+
+    def remove(self, hook):
+        """Unregister a hook.
+
+        Parameters
+        ----------
+        hook : callable
+            The pre-call or post-call hook to remove.
+
+        """
+        for hooks in (self.pre, self.post):
+            while hook in hooks:
+                hooks.remove(hook)
+
+    def current(self):
+        """Return the measurements of this thread's call in progress, if any.
+
+        Returns
+        -------
+        call : object
+            The call's measurements, or None.
+
+        """
+        return getattr(self._local, "call", None)
+
+    def finish(self, call, error=None):
+        """Finish measuring a call, and pass its measurements to the hooks.
+
+        Parameters
+        ----------
+        call : object
+            The value returned by `CallHooks.start`.
+        error : str
+            The error message, if the call failed. *(Defaults to None.)*
+
+        """
+        if self.current() is call:
+            self._local.call = None
+        info = CallInfo(
+            call.service,
+            call.method,
+            time.perf_counter() - call.start,
+            call.bytes_out,
+            call.bytes_in,
+            call.spawns,
+            call.spawn_time,
+            call.parse_time,
+            error,
+        )
+        for hook in list(self.post):
+            try:
+                hook(info)
+            except Exception:
+                _LOGGER.exception("Post-call hook %r failed.", hook)
+
+    def start(self, service, method, bytes_out=None, track=True):
+        """Start measuring a call, after passing its names to the hooks.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+        bytes_out : int
+            The number of bytes sent. *(Defaults to None.)*
+        track : bool
+            Whether calls made by this thread until the call finishes are
+            part of it. This should be False for calls that outlive the
+            function that started them, such as streams. *(Defaults to
+            True.)*
+
+        Returns
+        -------
+        call : object
+            The call's measurements, to be passed to `CallHooks.finish`.
+
+        """
+        for hook in list(self.pre):
+            try:
+                hook(service, method)
+            except Exception:
+                _LOGGER.exception("Pre-call hook %r failed.", hook)
+        call = _Call(service, method, bytes_out)
+        if track:
+            self._local.call = call
+        return call
+
+
+class Histogram:
+    """A cumulative histogram of observed values.
+
+    The histogram isn't thread-safe, so its users must hold their own lock
+    while observing values or taking snapshots.
+
+    Attributes
+    ----------
+    buckets : tuple
+        The upper bounds of the buckets, in ascending order.
+    count : int
+        The number of values observed.
+    counts : list
+        The number of values in each bucket, and above the last.
+    sum : float
+        The sum of the values observed.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initialize the Histogram class.
+
+        Parameters
+        ----------
+        buckets : tuple
+            The upper bounds of the buckets, in ascending order. *(Defaults
+            to DEFAULT_BUCKETS.)*
+
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Record a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Return the cumulative bucket counts, count and sum."""
+        cumulative, total = list(), 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+
+class MetricsCollector:
+    """Collects counters and latency histograms for each KeybaseAPI method.
+
+    The collector is a post-call hook, and can be registered with
+    `KeybaseAPI.add_hook`::
+
+        metrics = MetricsCollector()
+        keybase._api.add_hook(post=metrics)
+
+    Attributes
+    ----------
+    buckets : tuple
+        The upper bounds of the latency histogram buckets, in seconds.
+
+    """
+
+    _COUNTERS = ("calls", "errors", "spawns", "bytes_out", "bytes_in")
+    _TIMINGS = ("duration", "spawn_time", "parse_time")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initialize the MetricsCollector class.
+
+        Parameters
+        ----------
+        buckets : tuple
+            The upper bounds of the latency histogram buckets, in seconds.
+            *(Defaults to DEFAULT_BUCKETS, from 1 ms to 10 s.)*
+
+        """
+        self._lock = threading.Lock()
+        self._methods = dict()
+        self.buckets = tuple(sorted(buckets))
+
+    def __call__(self, call):
+        """Record a finished call.
+
+        Parameters
+        ----------
+        call : CallInfo
+            The call's measurements.
+
+        """
+        with self._lock:
+            key = (call.service, call.method)
+            entry = self._methods.get(key)
+            if entry is None:
+                entry = dict.fromkeys(self._COUNTERS, 0)
+                for timing in self._TIMINGS:
+                    entry[timing] = Histogram(self.buckets)
+                self._methods[key] = entry
+            entry["calls"] += 1
+            entry["errors"] += call.error is not None
+            entry["spawns"] += call.spawns
+            entry["bytes_out"] += call.bytes_out or 0
+            entry["bytes_in"] += call.bytes_in or 0
+            for timing in self._TIMINGS:
+                value = getattr(call, timing)
+                if value is not None:
+                    entry[timing].observe(value)
+
+    def dump(self, target):
+        """Write a snapshot of the metrics as JSON.
+
+        Parameters
+        ----------
+        target : str or file
+            The path of the file to write, or a file-like object.
+
+        """
+        data = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        if hasattr(target, "write"):
+            target.write(data)
+        else:
+            with open(target, "w") as output:
+                output.write(data)
+
+    def prometheus(self, prefix="pykblib"):
+        """Return the metrics in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix of the metric names. *(Defaults to pykblib.)*
+
+        Returns
+        -------
+        text : str
+            The metrics, ready to be served to a Prometheus scraper.
+
+        """
+        snapshot = self.snapshot()
+        lines = list()
+        for counter in self._COUNTERS:
+            name = "{}_{}_total".format(prefix, counter)
+            lines.append("# TYPE {} counter".format(name))
+            for key, entry in sorted(snapshot.items()):
+                lines.append(
+                    "{}{{{}}} {}".format(name, _labels(key), entry[counter])
+                )
+        for timing in self._TIMINGS:
+            name = "{}_{}_seconds".format(prefix, timing)
+            lines.append("# TYPE {} histogram".format(name))
+            for key, entry in sorted(snapshot.items()):
+                labels = _labels(key)
+                histogram = entry[timing]
+                for bound, count in histogram["buckets"]:
+                    lines.append(
+                        '{}_bucket{{{},le="{}"}} {}'.format(
+                            name, labels, bound, count
+                        )
+                    )
+                lines.append(
+                    "{}_sum{{{}}} {}".format(name, labels, histogram["sum"])
+                )
+                lines.append(
+                    "{}_count{{{}}} {}".format(
+                        name, labels, histogram["count"]
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Discard all of the collected metrics."""
+        with self._lock:
+            self._methods.clear()
+
+    def snapshot(self):
+        """Return the current metrics.
+
+        Returns
+        -------
+        metrics : dict
+            A dict with a `service/method` key for each method called. Each
+            value holds the method's counters, i.e. `calls`, `errors`,
+            `spawns`, `bytes_out` and `bytes_in`, and histograms of its
+            `duration`, `spawn_time` and `parse_time`. Each histogram holds
+            its cumulative `buckets` as `[upper_bound, count]` pairs, and the
+            `count` and `sum` of the observed values.
+
+        """
+        with self._lock:
+            return {
+                "{}/{}".format(*key): {
+                    name: (
+                        value.snapshot()
+                        if isinstance(value, Histogram)
+                        else value
+                    )
+                    for name, value in entry.items()
+                }
+                for key, entry in self._methods.items()
+            }
+
+
+def _labels(key):
+    """Format a `service/method` key as Prometheus labels."""
+    service, _, method = key.partition("/")
+    return 'service="{}",method="{}"'.format(
+        service.replace('"', '\\"'), method.replace('"', '\\"')
+    )
@@ -0,0 +1,237 @@
+"""Defines the retry policy and circuit breaker used by KeybaseAPI."""
+
+import random
+import re
+import threading
+import time
+
+# The calls that only read data, and can safely be made again.
+DEFAULT_IDEMPOTENT = frozenset(
+    [
+        ("chat", "list"),
+        ("chat", "listconvsonname"),
+        ("chat", "read"),
+        ("fs", "ls"),
+        ("fs", "stat"),
+        ("id", "id"),
+        ("status", "status"),
+        ("team", "list-requests"),
+        ("team", "list-team-memberships"),
+        ("team", "list-user-memberships"),
+        ("wallet", "balances"),
+    ]
+)
+
+# Error messages indicating that the keybase client or service failed,
+# rather than the request itself.
+TRANSIENT_PATTERN = re.compile(
+    r"connection refused|connection reset|broken pipe|\bEOF\b|"
+    r"could not start keybase|could not connect|"
+    r"service (?:is )?(?:not running|unavailable|restarting)|"
+    r"temporar(?:y|ily)|timed? ?out|try again|\b50[234]\b",
+    re.IGNORECASE,
+)
+
+
+def is_transient(message):
+    """Return True if an error message describes a transient failure.
+
+    Parameters
+    ----------
+    message : str
+        The error message.
+
+    Returns
+    -------
+    transient : bool
+        True if the failure was caused by the keybase client, the local
+        service or the network, so that trying again might succeed.
+
+    """
+    return bool(TRANSIENT_PATTERN.search(message or ""))
+
+
+class RetryPolicy:
+    """Decides which failed calls to retry, and how long to wait first.
+
+    Only calls that fail with a transient error are retried, and only if
+    they are idempotent: the read methods in DEFAULT_IDEMPOTENT, and any
+    writes marked as safe with `RetryPolicy.mark_safe`. The delay before
+    each retry is chosen at random, up to an exponentially growing limit, so
+    that clients that failed together don't all retry together.
+
+    Attributes
+    ----------
+    attempts : int
+        The maximum number of attempts, including the first.
+    base : float
+        The limit of the first delay, in seconds, which doubles with each
+        retry.
+    cap : float
+        The largest limit of any delay, in seconds.
+    idempotent : set
+        The `(service, method)` tuples of the calls that may be retried.
+
+    """
+
+    def __init__(self, attempts=3, base=0.1, cap=5.0, idempotent=None):
+        """Initialize the RetryPolicy class.
+
+        Parameters
+        ----------
+        attempts : int
+            The maximum number of attempts, including the first. *(Defaults
+            to 3.)*
+        base : float
+            The limit of the first delay, in seconds. *(Defaults to 0.1.)*
+        cap : float
+            The largest limit of any delay, in seconds. *(Defaults to 5.0.)*
+        idempotent : iterable
+            The `(service, method)` tuples of the calls that may be retried.
+            *(Defaults to DEFAULT_IDEMPOTENT.)*
+
+        """
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.idempotent = set(
+            DEFAULT_IDEMPOTENT if idempotent is None else idempotent
+        )
+
+    def delay(self, attempt):
+        """Return the number of seconds to wait before a retry.
+
+        Parameters
+        ----------
+        attempt : int
+            The number of attempts made so far.
+
+        Returns
+        -------
+        delay : float
+            A random delay between zero and the attempt's limit.
+
+        """
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+    def mark_safe(self, service, method):
+        """Allow a call that changes data to be retried.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method, which must have the same effect however
+            many times it is called.
+
+        """
+        self.idempotent.add((service, method))
+
+    def should_retry(self, service, method, message, attempt):
+        """Return True if a failed call should be made again.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        method : str
+            The name of the method.
+        message : str
+            The error message.
+        attempt : int
+            The number of attempts made so far.
+
+        Returns
+        -------
+        retry : bool
+            True if the call may be retried.
+
+        """
+        return (
+            attempt < self.attempts
+            and (service, method) in self.idempotent
+            and is_transient(message)
+        )
+
+
+class CircuitBreaker:
+    """Fails calls fast while the keybase service appears to be down.
+
+    The breaker is closed while calls succeed. Once `threshold` calls in a
+    row fail with transient errors, it opens, and refuses calls for
+    `reset_timeout` seconds. It then lets a single trial call through: if it
+    succeeds, the breaker closes, and otherwise it opens again.
+
+    Attributes
+    ----------
+    reset_timeout : float
+        The number of seconds calls are refused for once the breaker opens.
+    state : str
+        One of CLOSED, OPEN or HALF_OPEN.
+    threshold : int
+        The number of transient failures in a row that open the breaker.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=10.0):
+        """Initialize the CircuitBreaker class.
+
+        Parameters
+        ----------
+        threshold : int
+            The number of transient failures in a row that open the breaker.
+            *(Defaults to 5.)*
+        reset_timeout : float
+            The number of seconds calls are refused for once the breaker
+            opens. *(Defaults to 10.0.)*
+
+        """
+        self._changed = time.monotonic()
+        self._failures = 0
+        self._lock = threading.Lock()
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.threshold = threshold
+
+    def allow(self):
+        """Return True if a call may be made now.
+
+        Returns
+        -------
+        allowed : bool
+            True if the breaker is closed, or if the call is the trial call
+            of a half-open breaker. A trial call that never reports its
+            outcome is replaced after another `reset_timeout` seconds.
+
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._changed < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._changed = now
+            return True
+
+    def failure(self):
+        """Record a call that failed with a transient error."""
+        with self._lock:
+            self._failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self._failures >= self.threshold
+            ):
+                self.state = self.OPEN
+                self._changed = time.monotonic()
+
+    def success(self):
+        """Record a call that reached the keybase service."""
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
@@ -0,0 +1,1141 @@
+"""Defines the Sidecar daemon and the SidecarTransport class.
+
+A Sidecar serves the Keybase calls of every PyKBLib process on a host over a
+Unix socket. It runs them on a shared pool of workers, caches the results of
+team reads for all of its clients, and makes concurrent identical reads only
+once. Processes use it by passing a SidecarTransport to Keybase::
+
+    keybase = Keybase(transport=SidecarTransport())
+
+The daemon is started with the `pykblib-sidecar` command, or with
+`python -m pykblib.sidecar`.
+
+Requests and responses are sent as JSON Lines, one request at a time on each
+connection. Processes started with `open_process` stream arbitrary binary
+data, so they are started locally rather than by the sidecar.
+
+The socket must be in a directory that only its user can write to, and both
+ends of each connection check that the other belongs to the same user where
+the platform allows it, so other users can neither make calls through the
+sidecar nor impersonate it.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import shlex
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from pykblib.api import KeybaseAPI, deadline, remaining
+from pykblib.cache import TTLCache
+from pykblib.exceptions import (
+    APIException,
+    ServiceUnavailableException,
+    SidecarException,
+    TimeoutException,
+)
+from pykblib.metrics import command_name
+
+# The reads whose results are shared between clients until they expire.
+# `status` isn't among them, since it's how scripts notice that the user has
+# logged out, or that the service has restarted.
+CACHED_METHODS = frozenset(
+    [
+        ("id", "id"),
+        ("team", "list-requests"),
+        ("team", "list-team-memberships"),
+        ("team", "list-user-memberships"),
+    ]
+)
+
+# The exceptions passed from the sidecar to its clients, by name.
+_EXCEPTIONS = {
+    exception.__name__: exception
+    for exception in (
+        APIException,
+        ServiceUnavailableException,
+        TimeoutException,
+    )
+}
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def default_socket_path():
+    """Return the default path of the sidecar's socket.
+
+    Returns
+    -------
+    path : str
+        `pykblib.sock` in the user's runtime directory, if there is one, or
+        otherwise in a private directory named after the user's ID in the
+        temporary directory, which the sidecar creates.
+
+    """
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "pykblib.sock")
+    return os.path.join(
+        tempfile.gettempdir(),
+        "pykblib-{}".format(os.getuid()),
+        "pykblib.sock",
+    )
+
+
+def _check_directory(path):
+    """Ensure that no other user can replace the socket at a path.
+
+    Parameters
+    ----------
+    path : str
+        The path of the socket.
+
+    Raises
+    ------
+    SidecarException
+        If the socket's directory isn't a directory owned by the current
+        user, which no one else can write to, a SidecarException is raised.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        status = os.lstat(directory)
+    except OSError as error:
+        raise SidecarException(
+            "Could not check {}: {}".format(directory, error.strerror or error)
+        )
+    if (
+        not stat.S_ISDIR(status.st_mode)
+        or status.st_uid != os.getuid()
+        or status.st_mode & 0o022
+    ):
+        raise SidecarException(
+            "{} must be a directory owned by the current user, which no one "
+            "else can write to.".format(directory)
+        )
+
+
+def _peer_uid(connection):
+    """Return the user ID of the process at the other end of a connection.
+
+    Parameters
+    ----------
+    connection : socket.socket
+        The connected Unix socket.
+
+    Returns
+    -------
+    uid : int
+        The user ID, or None if the platform doesn't report it.
+
+    """
+    option = getattr(socket, "SO_PEERCRED", None)
+    if option is None:
+        return None
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, option, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", credentials)[1]
+
+
+def _api_query(command):
+    """Return the service and query of an API command.
+
+    Parameters
+    ----------
+    command : str
+        The command, as passed to `KeybaseAPI.run_command`.
+
+    Returns
+    -------
+    query : tuple
+        The service's name, and its query encoded as JSON on a single line,
+        or None if the command isn't a valid API query.
+
+    """
+    try:
+        arguments = shlex.split(command)
+    except ValueError:
+        return None
+    if len(arguments) != 4 or arguments[1:3] != ["api", "-m"]:
+        return None
+    try:
+        query = json.loads(arguments[3])
+    except ValueError:
+        return None
+    return (arguments[0], json.dumps(query, separators=(",", ":")))
+
+
+def _method(command):
+    """Return the service and method names of a command.
+
+    Parameters
+    ----------
+    command : str
+        The command, as passed to `KeybaseAPI.run_command`.
+
+    Returns
+    -------
+    names : tuple
+        The `(service, method)` pair, using the method of API queries.
+
+    """
+    try:
+        arguments = shlex.split(command)
+    except ValueError:
+        return (None, None)
+    if len(arguments) == 4 and arguments[1:3] == ["api", "-m"]:
+        try:
+            return (arguments[0], json.loads(arguments[3]).get("method"))
+        except (ValueError, AttributeError):
+            return (arguments[0], None)
+    return command_name(arguments)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Serves the requests sent on a single connection."""
+
+    def setup(self):
+        """Register the connection, so that it's closed when stopping."""
+        super().setup()
+        with self.server.sidecar._lock:
+            self.server.sidecar._clients.add(self.request)
+
+    def finish(self):
+        """Unregister the connection."""
+        with self.server.sidecar._lock:
+            self.server.sidecar._clients.discard(self.request)
+        super().finish()
+
+    def handle(self):
+        """Answer each request until the client disconnects."""
+        sidecar = self.server.sidecar
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                self._send({"error": "Malformed request."})
+                continue
+            try:
+                if request.get("op") == "stream":
+                    self._stream(sidecar, request)
+                    continue
+                response = sidecar.handle(request)
+            except Exception as exception:
+                # Keep the connection, and tell the client what went wrong.
+                _LOGGER.exception("Could not handle a request.")
+                response = {
+                    "error": "The sidecar failed: {}".format(exception)
+                }
+            self._send(response)
+
+    def _send(self, response):
+        """Write a response to the client."""
+        self.wfile.write(
+            json.dumps(response, separators=(",", ":")).encode() + b"\n"
+        )
+        self.wfile.flush()
+
+    def _stream(self, sidecar, request):
+        """Write each line of a stream to the client as it arrives."""
+        try:
+            for line in sidecar.backend.stream_lines(request["command"]):
+                self._send({"line": line})
+        except (APIException, TimeoutException) as exception:
+            self._send(_error(exception))
+        else:
+            self._send({"end": True})
+
+
+class _APIProcess:
+    """A keybase client answering a stream of queries for one API service."""
+
+    def __init__(self, backend, service):
+        """Start `keybase SERVICE api`, reading queries from a pipe."""
+        self._buffer = b""
+        self._errors = deque(maxlen=10)
+        self.process = backend.open_process(
+            [service, "api"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.service = service
+        # Keep reading the client's errors, so that its pipe never fills.
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    @property
+    def alive(self):
+        """Return True if the client is still running."""
+        return self.process.poll() is None
+
+    def call(self, query, timeout=None):
+        """Send a query, and return the client's response.
+
+        Parameters
+        ----------
+        query : str
+            The query, encoded as JSON on a single line.
+        timeout : float
+            The number of seconds to wait for the response, or None.
+
+        Returns
+        -------
+        output : str
+            The response, encoded as JSON.
+
+        Raises
+        ------
+        APIException
+            If the client exits, an APIException is raised.
+        TimeoutException
+            If the response doesn't arrive in time, the client is killed, and
+            a TimeoutException is raised.
+
+        """
+        expiry = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.process.stdin.write(query.encode() + b"\n")
+            self.process.stdin.flush()
+        except OSError:
+            self.close()
+            raise APIException(self._exited())
+        descriptor = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            if expiry is not None:
+                wait = expiry - time.monotonic()
+                if (
+                    wait <= 0
+                    or not select.select([descriptor], [], [], wait)[0]
+                ):
+                    self.close()
+                    raise TimeoutException(
+                        "Timed out waiting for keybase {} api.".format(
+                            self.service
+                        )
+                    )
+            chunk = os.read(descriptor, 65536)
+            if not chunk:
+                self.close()
+                raise APIException(self._exited())
+            self._buffer += chunk
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line.decode()
+
+    def close(self):
+        """Stop the client."""
+        if self.alive:
+            self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _drain(self):
+        """Keep the last few lines the client writes to its standard error."""
+        for line in self.process.stderr:
+            self._errors.append(line.decode(errors="replace").strip())
+        self.process.stderr.close()
+
+    def _exited(self):
+        """Describe the client's exit."""
+        message = "keybase {} api exited".format(self.service)
+        errors = [error for error in self._errors if error]
+        return "{}: {}".format(message, errors[-1]) if errors else message
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A Unix socket server which handles each connection in a thread."""
+
+    daemon_threads = True
+
+    def verify_request(self, request, client_address):
+        """Refuse connections from other users."""
+        uid = _peer_uid(request)
+        if uid is None or uid == os.getuid():
+            return True
+        _LOGGER.warning("Refused a connection from user %s.", uid)
+        return False
+
+
+class Sidecar:
+    """Serves Keybase calls to the PyKBLib processes on a host.
+
+    Calls are run by the backend on a pool of workers shared by every
+    client. The results of the reads in CACHED_METHODS are cached for
+    `cache_ttl` seconds, and any other team call clears the cache, since it
+    may have changed a team. Concurrent identical reads wait for a single
+    call to finish.
+
+    Each clearing of the cache starts a new generation. The result of a read
+    is only cached, or shared with reads made later, while the generation in
+    which it started lasts, so a read that overlaps a team change is never
+    served once the change has been made.
+
+    With `persistent` processes, API queries aren't each run by a new keybase
+    client. Instead, each worker keeps a `keybase SERVICE api` client running
+    for every service it has called, and writes queries to it one line at a
+    time, which avoids starting a client for every call. A client that times
+    out is killed, and replaced at the next call. Other commands, and calls
+    made through a transport, are passed to the backend as they are.
+
+    Attributes
+    ----------
+    backend : object
+        The transport or KeybaseAPI instance that makes the calls.
+    path : str
+        The path of the Unix socket.
+    persistent : bool
+        Whether API queries are written to long-lived keybase clients.
+    stats : dict
+        The number of `requests` served, `errors` returned, `cache_hits`,
+        `cache_misses`, and reads `coalesced` with another client's.
+
+    """
+
+    def __init__(
+        self,
+        path=None,
+        backend=None,
+        workers=8,
+        cache_ttl=30,
+        cache_size=4096,
+        persistent=None,
+    ):
+        """Initialize the Sidecar class.
+
+        Parameters
+        ----------
+        path : str
+            The path of the Unix socket. *(Defaults to the path returned by
+            default_socket_path.)*
+        backend : object
+            The transport or KeybaseAPI instance that makes the calls.
+            *(Defaults to a KeybaseAPI using the keybase client.)*
+        workers : int
+            The maximum number of calls run at once. *(Defaults to 8.)*
+        cache_ttl : float
+            The number of seconds for which the results of reads are
+            cached, or 0 to disable the cache. *(Defaults to 30.)*
+        cache_size : int
+            The maximum number of cached results. *(Defaults to 4096.)*
+        persistent : bool
+            Whether to write API queries to long-lived keybase clients,
+            started with the backend's `open_process`. *(Defaults to True if
+            the backend is a KeybaseAPI using the keybase client, rather than
+            a transport.)*
+
+        """
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._clients = set()
+        self._generation = 0
+        self._inflight = dict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._processes = defaultdict(list)
+        self._server = None
+        self._stopped = False
+        self._thread = None
+        self.backend = KeybaseAPI() if backend is None else backend
+        self.cache_ttl = cache_ttl
+        self.path = default_socket_path() if path is None else path
+        if persistent is None:
+            persistent = (
+                isinstance(self.backend, KeybaseAPI)
+                and self.backend.transport is None
+            )
+        self.persistent = persistent
+        self.stats = dict.fromkeys(
+            ["requests", "errors", "cache_hits", "cache_misses", "coalesced"],
+            0,
+        )
+
+    def handle(self, request):
+        """Answer a single request.
+
+        Parameters
+        ----------
+        request : dict
+            The request, holding its `op`, i.e. run, delete or stats, its
+            `command`, and the number of seconds it may take as `timeout`.
+
+        Returns
+        -------
+        response : dict
+            The `output` of the request, or its `error` message and the name
+            of its `exception`.
+
+        """
+        operation = request.get("op")
+        if operation == "stats":
+            with self._lock:
+                return {"output": dict(self.stats)}
+        self._count("requests")
+        command = request.get("command")
+        if operation == "run":
+            names = _method(command)
+        elif operation == "delete":
+            names = ("team", "delete")
+        else:
+            self._count("errors")
+            return {"error": "Unknown operation {}.".format(operation)}
+        # A call that may change a team makes cached team data stale, both
+        # while it runs and once it has finished.
+        invalidates = names[0] == "team" and names not in CACHED_METHODS
+        if invalidates:
+            self._invalidate()
+        try:
+            output = self._submit(
+                operation,
+                command,
+                request.get("timeout"),
+                self.cache_ttl and names in CACHED_METHODS,
+            )
+        except (APIException, TimeoutException) as exception:
+            self._count("errors")
+            return _error(exception)
+        except Exception as exception:
+            self._count("errors")
+            _LOGGER.exception("Could not handle %s.", command)
+            return {"error": "The sidecar failed: {}".format(exception)}
+        finally:
+            if invalidates:
+                self._invalidate()
+        return {"output": output}
+
+    def serve(self):
+        """Serve requests until `Sidecar.stop` is called.
+
+        Raises
+        ------
+        SidecarException
+            If another sidecar is already serving on the socket, a
+            SidecarException is raised.
+
+        """
+        self._bind()
+        _LOGGER.info("Serving Keybase calls on %s.", self.path)
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve requests in a background thread.
+
+        Raises
+        ------
+        SidecarException
+            If another sidecar is already serving on the socket, a
+            SidecarException is raised.
+
+        """
+        self._bind()
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving requests, and remove the socket and idle clients."""
+        server, self._server = self._server, None
+        with self._lock:
+            self._stopped = True
+            processes = [
+                process
+                for idle in self._processes.values()
+                for process in idle
+            ]
+            self._processes.clear()
+        for process in processes:
+            process.close()
+        if server is None:
+            return
+        server.shutdown()
+        server.server_close()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._pool.shutdown(wait=False)
+
+    def _bind(self):
+        """Create the socket, replacing any left behind by a dead sidecar.
+
+        Raises
+        ------
+        SidecarException
+            If another sidecar is already serving on the socket, or the
+            socket's path isn't private to the current user, a
+            SidecarException is raised.
+
+        """
+        try:
+            os.mkdir(os.path.dirname(os.path.abspath(self.path)), 0o700)
+        except FileExistsError:
+            pass
+        except OSError as error:
+            raise SidecarException(
+                "Could not create the directory of {}: {}".format(
+                    self.path, error.strerror or error
+                )
+            )
+        _check_directory(self.path)
+        if os.path.lexists(self.path):
+            status = os.lstat(self.path)
+            if (
+                not stat.S_ISSOCK(status.st_mode)
+                or status.st_uid != os.getuid()
+            ):
+                raise SidecarException(
+                    "{} is not a socket owned by the current user.".format(
+                        self.path
+                    )
+                )
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                try:
+                    os.unlink(self.path)
+                except OSError as error:
+                    raise SidecarException(
+                        "Could not remove {}: {}".format(
+                            self.path, error.strerror or error
+                        )
+                    )
+            else:
+                raise SidecarException(
+                    "A sidecar is already serving on {}.".format(self.path)
+                )
+            finally:
+                probe.close()
+        self._server = _Server(self.path, _Handler)
+        self._server.sidecar = self
+        # Connections from other users are refused as well, where the
+        # platform reports who made them.
+        os.chmod(self.path, 0o600)
+
+    def _call(self, operation, command, timeout):
+        """Make a call with the backend, within its time limit."""
+        api_query = _api_query(command) if operation == "run" else None
+        if self.persistent and api_query is not None:
+            return self._query(*api_query, timeout)
+        function = (
+            self.backend.run_command
+            if operation == "run"
+            else self.backend.delete_team
+        )
+        if timeout is None:
+            return function(command)
+        with deadline(timeout):
+            return function(command)
+
+    def _count(self, name):
+        """Increment one of the statistics."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def _invalidate(self):
+        """Clear the cache, and start a new generation of reads."""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def _query(self, service, query, timeout):
+        """Write an API query to an idle client of the service.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service.
+        query : str
+            The query, encoded as JSON on a single line.
+        timeout : float
+            The number of seconds the call may take, or None.
+
+        Returns
+        -------
+        output : str
+            The client's response.
+
+        """
+        process = None
+        with self._lock:
+            idle = self._processes[service]
+            while idle and process is None:
+                process = idle.pop()
+                if not process.alive:
+                    process.close()
+                    process = None
+        if process is None:
+            process = _APIProcess(self.backend, service)
+        try:
+            output = process.call(query, timeout)
+        except BaseException:
+            process.close()
+            raise
+        with self._lock:
+            stopped = self._stopped
+            if not stopped:
+                self._processes[service].append(process)
+        if stopped:
+            process.close()
+        return output
+
+    def _submit(self, operation, command, timeout, cached):
+        """Run a call on the worker pool, sharing the results of reads.
+
+        Parameters
+        ----------
+        operation : str
+            The operation, i.e. run or delete.
+        command : str
+            The command or team name.
+        timeout : float
+            The number of seconds the call may take, or None.
+        cached : bool
+            Whether the call's result may be cached and shared.
+
+        Returns
+        -------
+        output : object
+            The call's output.
+
+        Raises
+        ------
+        TimeoutException
+            If the call doesn't finish in time, a TimeoutException is raised.
+
+        """
+        if not cached:
+            future = self._pool.submit(self._call, operation, command, timeout)
+            return _result(future, timeout)
+        output = self._cache.get(command)
+        if output is not None:
+            self._count("cache_hits")
+            return output
+        with self._lock:
+            generation = self._generation
+            inflight = self._inflight.get(command)
+            # Reads started before the cache was last cleared aren't joined.
+            started = inflight is None or inflight[0] != generation
+            if started:
+                self.stats["cache_misses"] += 1
+                inflight = self._inflight[command] = (
+                    generation,
+                    self._pool.submit(self._call, operation, command, timeout),
+                )
+            else:
+                self.stats["coalesced"] += 1
+        future = inflight[1]
+        if started:
+            future.add_done_callback(
+                lambda done: self._store(command, inflight)
+            )
+        return _result(future, timeout)
+
+    def _store(self, command, inflight):
+        """Cache the result of a finished read, unless it may be stale.
+
+        Parameters
+        ----------
+        command : str
+            The command that was run.
+        inflight : tuple
+            The generation in which the read started, and its future.
+
+        """
+        generation, future = inflight
+        with self._lock:
+            if self._inflight.get(command) is inflight:
+                del self._inflight[command]
+            if future.exception() is None and generation == self._generation:
+                self._cache.set(command, future.result())
+
+
+class SidecarTransport:
+    """A transport which makes calls through a Sidecar.
+
+    Each thread keeps its own connection to the sidecar. If the sidecar
+    can't be reached, or the connection breaks, the call fails with an
+    APIException, which a `pykblib.retry.RetryPolicy` treats as transient.
+
+    Attributes
+    ----------
+    fallback : object
+        The transport or KeybaseAPI instance that starts processes.
+    path : str
+        The path of the sidecar's socket.
+
+    """
+
+    def __init__(self, path=None, fallback=None):
+        """Initialize the SidecarTransport class.
+
+        Parameters
+        ----------
+        path : str
+            The path of the sidecar's socket. *(Defaults to the path
+            returned by default_socket_path.)*
+        fallback : object
+            The transport or KeybaseAPI instance that starts processes for
+            `SidecarTransport.open_process`. *(Defaults to a KeybaseAPI
+            using the keybase client.)*
+
+        """
+        self._connections = list()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.fallback = KeybaseAPI() if fallback is None else fallback
+        self.path = default_socket_path() if path is None else path
+
+    def close(self):
+        """Close every connection to the sidecar."""
+        with self._lock:
+            connections, self._connections = self._connections, list()
+        for connection, reader in connections:
+            reader.close()
+            connection.close()
+
+    def delete_team(self, team_name):
+        """Delete the specified team through the sidecar.
+
+        Parameters
+        ----------
+        team_name : str
+            The name of the team to be deleted.
+
+        Raises
+        ------
+        APIException
+            If the team cannot be deleted, an APIException is raised.
+
+        """
+        self._request({"op": "delete", "command": team_name})
+
+    def open_process(self, arguments, stdin=None, stdout=None):
+        """Start a process locally, with the fallback.
+
+        Parameters
+        ----------
+        arguments : list
+            The arguments to pass to the keybase client.
+        stdin : int or file
+            The process's standard input. *(Defaults to None.)*
+        stdout : int or file
+            The process's standard output. *(Defaults to None.)*
+
+        Returns
+        -------
+        process : subprocess.Popen
+            The running process.
+
+        """
+        return self.fallback.open_process(
+            arguments, stdin=stdin, stdout=stdout
+        )
+
+    def run_command(self, command):
+        """Run a command through the sidecar.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Returns
+        -------
+        output : str
+            The output of the command.
+
+        Raises
+        ------
+        APIException
+            If the command fails, an APIException is raised.
+
+        """
+        return self._request({"op": "run", "command": command})
+
+    def stats(self):
+        """Return the sidecar's statistics.
+
+        Returns
+        -------
+        stats : dict
+            The sidecar's `Sidecar.stats`.
+
+        """
+        return self._request({"op": "stats"})
+
+    def stream_lines(self, command):
+        """Stream a command's output through the sidecar.
+
+        The stream uses a connection of its own, which is closed when the
+        stream ends.
+
+        Parameters
+        ----------
+        command : str
+            The command to be run.
+
+        Yields
+        ------
+        line : str
+            Each line of the command's output.
+
+        """
+        connection = self._connect()
+        try:
+            reader = connection.makefile("rb")
+            self._send(connection, {"op": "stream", "command": command})
+            for line in reader:
+                response = json.loads(line.decode())
+                if "line" not in response:
+                    _raise(response)
+                    return
+                yield response["line"]
+            raise APIException("The sidecar closed the stream.")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        """Open a new connection to the sidecar.
+
+        Returns
+        -------
+        connection : socket.socket
+            The connected socket.
+
+        Raises
+        ------
+        APIException
+            If the sidecar can't be reached, an APIException is raised.
+        SidecarException
+            If the socket belongs to another user, a SidecarException is
+            raised.
+
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            uid = _peer_uid(connection)
+            if uid is None:
+                # Trust the socket only if no other user could have made it.
+                _check_directory(self.path)
+                uid = os.stat(self.path).st_uid
+        except OSError as error:
+            connection.close()
+            raise APIException(
+                "Could not connect to the sidecar at {}: {}".format(
+                    self.path, error.strerror or error
+                )
+            )
+        except SidecarException:
+            connection.close()
+            raise
+        if uid != os.getuid():
+            connection.close()
+            raise SidecarException(
+                "The sidecar at {} belongs to user {}.".format(self.path, uid)
+            )
+        return connection
+
+    def _request(self, request):
+        """Send a request on this thread's connection, and read the response.
+
+        Parameters
+        ----------
+        request : dict
+            The request.
+
+        Returns
+        -------
+        output : object
+            The output of the request.
+
+        Raises
+        ------
+        APIException
+            If the request fails, or the sidecar can't be reached, an
+            APIException is raised.
+        SidecarException
+            If the socket belongs to another user, a SidecarException is
+            raised.
+        TimeoutException
+            If the current deadline expires first, a TimeoutException is
+            raised.
+
+        """
+        time_left = remaining()
+        if time_left is not None:
+            if time_left <= 0:
+                raise TimeoutException("The deadline has passed.")
+            request["timeout"] = time_left
+        state = getattr(self._local, "connection", None)
+        if state is None or state[0].fileno() == -1:
+            # Connect, or reconnect after `SidecarTransport.close`.
+            connection = self._connect()
+            state = self._local.connection = (
+                connection,
+                connection.makefile("rb"),
+            )
+            with self._lock:
+                self._connections.append(state)
+        connection, reader = state
+        try:
+            # Allow the sidecar a moment to report the timeout itself.
+            connection.settimeout(None if time_left is None else time_left + 1)
+            self._send(connection, request)
+            line = reader.readline()
+        except socket.timeout:
+            self._drop()
+            raise TimeoutException("Timed out waiting for the sidecar.")
+        except OSError as error:
+            self._drop()
+            raise APIException(
+                "Connection reset by the sidecar: {}".format(
+                    error.strerror or error
+                )
+            )
+        if not line:
+            self._drop()
+            raise APIException("Connection reset by the sidecar.")
+        response = json.loads(line.decode())
+        _raise(response)
+        return response.get("output")
+
+    def _drop(self):
+        """Close this thread's connection, after it failed."""
+        state = self._local.connection
+        self._local.connection = None
+        with self._lock:
+            if state in self._connections:
+                self._connections.remove(state)
+        state[1].close()
+        state[0].close()
+
+    @staticmethod
+    def _send(connection, request):
+        """Write a request to a connection."""
+        connection.sendall(
+            json.dumps(request, separators=(",", ":")).encode() + b"\n"
+        )
+
+
+def _result(future, timeout):
+    """Wait for a call run on the worker pool, within its time limit."""
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        raise TimeoutException("Timed out waiting for a worker.")
+
+
+def _error(exception):
+    """Convert an exception into an error response."""
+    return {
+        "error": exception.message,
+        "exception": type(exception).__name__,
+    }
+
+
+def _raise(response):
+    """Raise the exception described by an error response, if any."""
+    if "error" in response:
+        exception = _EXCEPTIONS.get(response.get("exception"), APIException)
+        raise exception(response["error"])
+
+
+def main(argv=None):
+    """Run the sidecar daemon.
+
+    Parameters
+    ----------
+    argv : list
+        The command-line arguments. *(Defaults to sys.argv[1:].)*
+
+    Returns
+    -------
+    status : int
+        The exit status.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve Keybase calls to the PyKBLib processes on a host."
+    )
+    parser.add_argument(
+        "--socket", default=None, help="the path of the Unix socket"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="the maximum number of calls run at once",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=30,
+        help="the number of seconds for which reads are cached",
+    )
+    parser.add_argument(
+        "--no-persistent",
+        dest="persistent",
+        action="store_false",
+        help="start a keybase client for every call",
+    )
+    parser.add_argument(
+        "--executable",
+        default="keybase",
+        help="the command used to start the keybase client",
+    )
+    options = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO)
+
+    def terminate(signum, frame):
+        # Stop cleanly, removing the socket, when asked to terminate.
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    sidecar = Sidecar(
+        options.socket,
+        KeybaseAPI(executable=options.executable),
+        workers=options.workers,
+        cache_ttl=options.cache_ttl,
+        persistent=options.persistent,
+    )
+    try:
+        sidecar.serve()
+    except SidecarException as exception:
+        sys.stderr.write("{}\n".format(exception.message))
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sidecar.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""Defines the MessageStore class."""
+
+import sqlite3
+import threading
+from collections import defaultdict, namedtuple
+
+from pykblib.exceptions import StoreException
+
+StoredMessage = namedtuple(
+    "StoredMessage",
+    ["conversation_id", "message_id", "channel", "sender", "sent_at", "body"],
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    channel TEXT,
+    sender TEXT,
+    sent_at INTEGER,
+    body TEXT,
+    PRIMARY KEY (conversation_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender, sent_at);
+CREATE INDEX IF NOT EXISTS messages_by_channel ON messages (channel, sent_at);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (sent_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body, content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.rowid, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body)
+    VALUES ('delete', old.rowid, old.body);
+END;
+CREATE TABLE IF NOT EXISTS sync_state (
+    conversation_id TEXT PRIMARY KEY,
+    high_water INTEGER NOT NULL
+);
+"""
+
+
+def _channel_name(channel):
+    """Return the display name of a message's channel.
+
+    Parameters
+    ----------
+    channel : namedtuple
+        The channel information attached to a chat message.
+
+    Returns
+    -------
+    name : str
+        The channel name, in the form `team_name#topic_name` for team
+        channels.
+
+    """
+    topic_name = getattr(channel, "topic_name", None)
+    if getattr(channel, "members_type", None) == "team" and topic_name:
+        return "{}#{}".format(channel.name, topic_name)
+    return channel.name
+
+
+class MessageStore:
+    """A local, full-text indexed store of chat messages.
+
+    The store is backed by SQLite, and requires a build of SQLite with the
+    FTS5 extension enabled. In addition to the messages themselves, it keeps a
+    high-water mark for each conversation: the newest message ID up to which
+    the conversation's history is known to be complete.
+
+    """
+
+    def __init__(self, path=":memory:"):
+        """Open the message store, creating it if necessary.
+
+        Parameters
+        ----------
+        path : str
+            The path to the SQLite database file. *(Defaults to an in-memory
+            database.)*
+
+        Raises
+        ------
+        StoreException
+            If the database could not be opened, or if SQLite was built
+            without FTS5 support, a StoreException is raised.
+
+        """
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.executescript(_SCHEMA)
+        except sqlite3.Error as error:
+            raise StoreException(
+                "Could not open message store {}: {}".format(path, error)
+            )
+
+    def add(self, messages, synced=False):
+        """Add the specified chat messages to the store.
+
+        Messages that are already stored are ignored, and only text messages
+        are indexed. A conversation's high-water mark is advanced past any
+        messages that directly follow it, so messages received live keep the
+        mark current while gaps are left for `Chat.sync` to fill.
+
+        Parameters
+        ----------
+        messages : iterable
+            The chat messages, as returned by `Chat.iter_history` or
+            `Chat.listen`.
+        synced : bool
+            If True, the caller guarantees that no messages are missing
+            between the stored high-water mark and these messages, so the mark
+            is advanced to the newest of them. *(Defaults to False.)*
+
+        Returns
+        -------
+        count : int
+            The number of messages that were newly stored.
+
+        """
+        rows = list()
+        ids_by_conversation = defaultdict(list)
+        for message in messages:
+            ids_by_conversation[message.conversation_id].append(message.id)
+            content = getattr(message, "content", None)
+            if getattr(content, "type", None) != "text":
+                continue
+            rows.append(
+                (
+                    message.conversation_id,
+                    message.id,
+                    _channel_name(message.channel),
+                    message.sender.username,
+                    message.sent_at,
+                    content.text.body,
+                )
+            )
+        with self._lock, self._db:
+            count = self._db.executemany(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            ).rowcount
+            for conversation_id, message_ids in ids_by_conversation.items():
+                self._advance(conversation_id, message_ids, synced)
+        return count
+
+    def high_water(self, conversation_id):
+        """Return the high-water mark of the specified conversation.
+
+        Parameters
+        ----------
+        conversation_id : str
+            The ID of the conversation.
+
+        Returns
+        -------
+        message_id : int
+            The newest message ID up to which the conversation is known to be
+            complete, or 0 if the conversation has never been synced.
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT high_water FROM sync_state WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def mark_synced(self, conversation_id, message_id):
+        """Record that a conversation is complete up to the specified message.
+
+        Parameters
+        ----------
+        conversation_id : str
+            The ID of the conversation.
+        message_id : int
+            The ID of the newest message known to be stored.
+
+        """
+        with self._lock, self._db:
+            self._advance(conversation_id, [message_id], True)
+
+    def search(
+        self,
+        text=None,
+        sender=None,
+        channel=None,
+        since=None,
+        until=None,
+        limit=100,
+    ):
+        """Search the stored messages, newest first.
+
+        All of the specified criteria must match.
+
+        Parameters
+        ----------
+        text : str
+            An FTS5 query matched against message bodies. *(Defaults to
+            None.)*
+        sender : str
+            The username of the sender. *(Defaults to None.)*
+        channel : str
+            The channel name, in the form `team_name#topic_name` for team
+            channels. *(Defaults to None.)*
+        since : int
+            The earliest Unix timestamp to include. *(Defaults to None.)*
+        until : int
+            The latest Unix timestamp to include. *(Defaults to None.)*
+        limit : int
+            The maximum number of messages to return. *(Defaults to 100.)*
+
+        Returns
+        -------
+        messages : list
+            A list of `StoredMessage` namedtuples.
+
+        Raises
+        ------
+        StoreException
+            If the text query is malformed, a StoreException is raised.
+
+        """
+        query = "SELECT messages.* FROM messages"
+        clauses = list()
+        values = list()
+        if text is not None:
+            query += (
+                " JOIN messages_fts ON messages_fts.rowid = messages.rowid"
+            )
+            clauses.append("messages_fts MATCH ?")
+            values.append(text)
+        for clause, value in (
+            ("messages.sender = ?", sender),
+            ("messages.channel = ?", channel),
+            ("messages.sent_at >= ?", since),
+            ("messages.sent_at <= ?", until),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                values.append(value)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY messages.sent_at DESC LIMIT ?"
+        values.append(limit)
+        try:
+            with self._lock:
+                rows = self._db.execute(query, values).fetchall()
+        except sqlite3.OperationalError as error:
+            raise StoreException("Invalid search: {}".format(error))
+        return [StoredMessage(*row) for row in rows]
+
+    def close(self):
+        """Close the underlying database."""
+        with self._lock:
+            self._db.close()
+
+    def _advance(self, conversation_id, message_ids, synced):
+        """Advance a conversation's high-water mark.
+
+        Parameters
+        ----------
+        conversation_id : str
+            The ID of the conversation.
+        message_ids : list
+            The IDs of the messages that were just stored.
+        synced : bool
+            Whether the mark should advance to the newest ID regardless of
+            gaps.
+
+        """
+        row = self._db.execute(
+            "SELECT high_water FROM sync_state WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if synced:
+            high_water = max([row[0] if row else 0] + message_ids)
+        elif row is None:
+            # Without a mark there's no telling what came before.
+            return
+        else:
+            high_water = row[0]
+            for message_id in sorted(message_ids):
+                if message_id == high_water + 1:
+                    high_water = message_id
+        self._db.execute(
+            "INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+            (conversation_id, high_water),
+        )
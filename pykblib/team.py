@@ -4,6 +4,8 @@ from steffentools import dict_to_ntuple
 
 from pykblib.api import KeybaseAPI
 from pykblib.exceptions import APIException, KeybaseException, TeamException
+from pykblib.kbfs import KBFS
+from pykblib.kvstore import KVStore
 
 
 class Team:
@@ -11,6 +13,10 @@ class Team:
 
     Attributes
     ----------
+    fs : KBFS
+        The interface to the team's Keybase filesystem folder.
+    kv : KVStore
+        The default namespace of the team's key-value store.
     name : str
         The name of the team.
     role : str
@@ -39,8 +45,22 @@ class Team:
             The Keybase object that spawned this Team.
 
         """
-        self._api = KeybaseAPI()
+        # Use the same transport, client, hooks and call policies as the
+        # Keybase instance.
+        api = getattr(keybase_instance, "_api", None)
+        self._api = KeybaseAPI(
+            getattr(api, "transport", None),
+            getattr(api, "executable", "keybase"),
+            getattr(api, "hooks", None),
+            getattr(api, "timeout", None),
+            getattr(api, "scheduler", None),
+            getattr(api, "retry", None),
+            getattr(api, "breaker", None),
+            getattr(api, "team_cache", None),
+        )
         self._keybase = keybase_instance
+        self.fs = KBFS(self)
+        self.kv = KVStore(self)
         self.members_by_role = None  # Populated by self.update()
         self.name = team_name
         self.role = "None"
@@ -69,7 +89,7 @@ class Team:
         """
         self.add_members([username], role)
 
-    def add_members(self, username_list, role="reader"):
+    def add_members(self, username_list, role="reader", check=False):
         """Add the specified users to this team.
 
         *Note: Keybase adds the specified users one at a time, but still
@@ -79,7 +99,9 @@ class Team:
         fact that the first two users were successfully added. As a result, if
         an attempt to add multiple users fails, it is advised to run the
         `Team.update()` function to update the member lists, to determine
-        whether any of the specified users were successfully added.*
+        whether any of the specified users were successfully added. Passing
+        `check=True` avoids most such failures, by resolving the usernames
+        with `Keybase.lookup_users` first.*
 
         Parameters
         ----------
@@ -89,6 +111,15 @@ class Team:
             The role to assign to the new members. This must be either reader,
             writer, admin, or owner. In order to assign the owner role, the
             current user must be an owner of the team. *(Defaults to reader.)*
+        check : bool
+            Whether to look up the usernames before adding them. If True, only
+            the users that could be resolved are added. *(Defaults to False.)*
+
+        Returns
+        -------
+        invalid : list
+            The usernames that could not be resolved, and so weren't added.
+            This is always empty unless `check` is True.
 
         Raises
         ------
@@ -96,6 +127,21 @@ class Team:
             If the users couldn't be added, a TeamException is raised.
 
         """
+        invalid = list()
+        if check:
+            lookups = self._keybase.lookup_users(username_list)
+            invalid = [
+                username
+                for username in username_list
+                if not lookups[username].valid
+            ]
+            username_list = [
+                username
+                for username in username_list
+                if username not in invalid
+            ]
+            if not username_list:
+                return invalid
         query = {
             "method": "add-members",
             "params": {
@@ -117,6 +163,7 @@ class Team:
             raise TeamException(
                 "Could not add members to team {}.".format(self.name)
             )
+        return invalid
 
     def change_member_role(self, username, new_role):
         """Change the specified user's role within this team.
@@ -290,7 +337,8 @@ class Team:
             TeamException will be raised.
 
         """
-        deleted_users = self.members_by_role.deleted
+        # Copy the set, since Team.remove_member removes users from it.
+        deleted_users = list(self.members_by_role.deleted)
         success = True
         for user in deleted_users:
             try:
@@ -322,7 +370,8 @@ class Team:
             TeamException will be raised.
 
         """
-        reset_users = self.members_by_role.reset
+        # Copy the set, since Team.remove_member removes users from it.
+        reset_users = list(self.members_by_role.reset)
         success = True
         for user in reset_users:
             try:
@@ -0,0 +1,319 @@
+"""Defines the Wallet class."""
+
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pykblib.api import bind_deadline
+from pykblib.exceptions import (
+    APIException,
+    TimeoutException,
+    WalletException,
+)
+
+PaymentResult = namedtuple(
+    "PaymentResult", ["recipient", "amount", "sent", "tx_id", "error"]
+)
+
+
+class Wallet:
+    """Provides an interface to the active user's Stellar wallet.
+
+    Account balances are cached, and the cache is cleared whenever a payment
+    is sent through this Wallet. Payments made elsewhere are picked up once
+    the cache expires, or by requesting fresh balances.
+
+    Attributes
+    ----------
+    cache_ttl : float
+        The number of seconds for which balances are cached, or None to cache
+        them until a payment is sent.
+
+    """
+
+    def __init__(self, keybase_instance, cache_ttl=60):
+        """Initialize the Wallet class.
+
+        Parameters
+        ----------
+        keybase_instance : Keybase
+            The Keybase object that spawned this Wallet.
+        cache_ttl : float
+            The number of seconds for which balances are cached. *(Defaults to
+            60.)*
+
+        """
+        self._api = keybase_instance._api
+        self._balances = dict()
+        self._keybase = keybase_instance
+        self._lock = threading.Lock()
+        self.cache_ttl = cache_ttl
+
+    def balances(self, account_id=None, fresh=False):
+        """Retrieve the active user's accounts and their balances.
+
+        Parameters
+        ----------
+        account_id : str
+            If specified, only this account is retrieved. *(Defaults to
+            None.)*
+        fresh : bool
+            Whether to bypass the cache. *(Defaults to False.)*
+
+        Returns
+        -------
+        accounts : list
+            A list of namedtuples describing each account, including its
+            `accountID` and a `balance` list of amounts by asset.
+
+        Raises
+        ------
+        WalletException
+            If the balances could not be retrieved, a WalletException is
+            raised.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._balances.get(account_id)
+        if cached is not None and not fresh:
+            expiry, accounts = cached
+            if expiry is None or now < expiry:
+                return accounts
+        query = {"method": "balances"}
+        if account_id is not None:
+            query["params"] = {"options": {"account-id": account_id}}
+        try:
+            response = self._api.call_api("wallet", query)
+        except APIException as exception:
+            raise WalletException(
+                "Could not retrieve balances: {}".format(exception.message)
+            )
+        accounts = list(response.result or [])
+        expiry = None if self.cache_ttl is None else now + self.cache_ttl
+        with self._lock:
+            self._balances[account_id] = (expiry, accounts)
+        return accounts
+
+    def batch(self, payments, chunk_size=100, workers=4, batch_id=None):
+        """Send many payments, submitting them in concurrent batches.
+
+        Parameters
+        ----------
+        payments : iterable
+            The payments to send, as dicts with `recipient` and `amount` keys
+            and an optional `message` key.
+        chunk_size : int
+            The maximum number of payments in each batch submitted to
+            Keybase. *(Defaults to 100.)*
+        workers : int
+            The maximum number of batches submitted at once. *(Defaults to
+            4.)*
+        batch_id : str
+            An identifier for the payments, which Keybase attaches to each
+            transaction. Each batch is suffixed with its index. *(Defaults to
+            a timestamp.)*
+
+        Returns
+        -------
+        results : list
+            A `PaymentResult` namedtuple for each payment, in the order the
+            payments were given. If a batch times out or fails unexpectedly,
+            its payments may or may not have been sent, which their errors
+            say, so they shouldn't be retried without checking the history.
+
+        """
+        payments = [
+            dict(payment, amount=str(payment["amount"]))
+            for payment in payments
+        ]
+        if batch_id is None:
+            batch_id = "pykblib-{}".format(int(time.time() * 1000))
+        chunks = [
+            payments[start : start + chunk_size]
+            for start in range(0, len(payments), chunk_size)
+        ]
+
+        def submit(index):
+            chunk = chunks[index]
+            options = {
+                "batch_id": "{}-{}".format(batch_id, index),
+                "payments": chunk,
+            }
+            query = {"method": "batch", "params": {"options": options}}
+            error = None
+            try:
+                response = self._api.call_api("wallet", query)
+            except APIException as exception:
+                error = exception.message
+            except TimeoutException:
+                error = "Timed out; status unknown."
+            except Exception as exception:
+                # Keep the results of the other batches.
+                error = "Failed; status unknown: {}".format(exception)
+            if error is not None:
+                return [
+                    PaymentResult(
+                        payment["recipient"],
+                        payment["amount"],
+                        False,
+                        None,
+                        error,
+                    )
+                    for payment in chunk
+                ]
+            statuses = getattr(response.result, "payments", None) or []
+            results = list()
+            for position, payment in enumerate(chunk):
+                if position < len(statuses):
+                    status = statuses[position]
+                    error = getattr(status, "errMsg", None) or None
+                    sent = error is None and getattr(
+                        status, "status", "success"
+                    ) in ("success", "pending")
+                    if not sent and error is None:
+                        error = status.status
+                    tx_id = getattr(status, "txID", None) or None
+                else:
+                    sent, tx_id, error = False, None, "No result returned."
+                results.append(
+                    PaymentResult(
+                        payment["recipient"],
+                        payment["amount"],
+                        sent,
+                        tx_id,
+                        error,
+                    )
+                )
+            return results
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                chunk_results = list(
+                    pool.map(bind_deadline(submit), range(len(chunks)))
+                )
+        finally:
+            self.invalidate()
+        return [result for results in chunk_results for result in results]
+
+    def invalidate(self):
+        """Clear the cached balances."""
+        with self._lock:
+            self._balances.clear()
+
+    def iter_history(self, account_id=None):
+        """Iterate over an account's payments, newest first.
+
+        Pages are requested lazily, so iteration can stop early without
+        retrieving the whole history. Each page is fetched only once the
+        previous one has been consumed.
+
+        Parameters
+        ----------
+        account_id : str
+            The account whose history should be retrieved. *(Defaults to the
+            primary account.)*
+
+        Yields
+        ------
+        payment : namedtuple
+            Each payment in the account's history.
+
+        Raises
+        ------
+        WalletException
+            If the history could not be retrieved, a WalletException is
+            raised.
+
+        """
+        if account_id is None:
+            account_id = self._primary_account()
+        cursor = None
+        while 1:
+            options = {"account-id": account_id}
+            if cursor is not None:
+                options["cursor"] = cursor
+            query = {"method": "history", "params": {"options": options}}
+            try:
+                response = self._api.call_api("wallet", query)
+            except APIException as exception:
+                raise WalletException(
+                    "Could not retrieve history: {}".format(exception.message)
+                )
+            result = response.result
+            if hasattr(result, "_fields"):
+                entries = getattr(result, "payments", None) or []
+                cursor = getattr(result, "cursor", None)
+            else:
+                # The whole history was returned as a single list.
+                entries, cursor = result or [], None
+            for entry in entries:
+                yield getattr(entry, "payment", entry)
+            if not cursor or not entries:
+                return
+
+    def send(self, recipient, amount, currency=None, message=None):
+        """Send a payment.
+
+        Parameters
+        ----------
+        recipient : str
+            The username, Stellar address or federation address of the
+            recipient.
+        amount : str
+            The amount to send, in lumens unless a currency is specified.
+        currency : str
+            The code of a local currency in which the amount is expressed,
+            e.g. USD. *(Defaults to None.)*
+        message : str
+            A private note to include with the payment. *(Defaults to None.)*
+
+        Returns
+        -------
+        tx_id : str
+            The ID of the Stellar transaction.
+
+        Raises
+        ------
+        WalletException
+            If the payment could not be sent, a WalletException is raised.
+
+        """
+        options = {"recipient": recipient, "amount": str(amount)}
+        if currency is not None:
+            options["currency"] = currency
+        if message is not None:
+            options["message"] = message
+        query = {"method": "send", "params": {"options": options}}
+        try:
+            response = self._api.call_api("wallet", query)
+        except APIException as exception:
+            raise WalletException(
+                "Could not send payment to {}: {}".format(
+                    recipient, exception.message
+                )
+            )
+        finally:
+            self.invalidate()
+        return getattr(response.result, "txID", None)
+
+    def _primary_account(self):
+        """Return the ID of the active user's primary account.
+
+        Returns
+        -------
+        account_id : str
+            The ID of the primary account.
+
+        Raises
+        ------
+        WalletException
+            If the active user has no primary account, a WalletException is
+            raised.
+
+        """
+        for account in self.balances():
+            if getattr(account, "isPrimary", False):
+                return account.accountID
+        raise WalletException("The active user has no primary account.")
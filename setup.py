@@ -44,5 +44,10 @@ setup(
     include_package_data=True,
     install_requires=["steffentools >=0.1.0",
                       "pexpect>=4.6.0"],
-    entry_points={},
+    entry_points={
+        "console_scripts": [
+            "pykblib-fake-keybase=pykblib.fake:main",
+            "pykblib-sidecar=pykblib.sidecar:main",
+        ]
+    },
 )
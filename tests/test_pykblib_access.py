@@ -0,0 +1,149 @@
+"""Test the PyKBLib AccessRequestProcessor class."""
+
+import json
+import threading
+import time
+from unittest import TestCase, mock
+
+from pykblib.access import (
+    DEFER,
+    IGNORE,
+    AccessRequest,
+    AccessRequestProcessor,
+)
+from pykblib.exceptions import (
+    AccessException,
+    APIException,
+    KeybaseException,
+    TeamException,
+    TimeoutException,
+)
+
+
+def requests_json(*requests):
+    """Build simulated JSON output of `keybase team list-requests`."""
+    return json.dumps(
+        [
+            {"name": team, "username": username, "fullName": "", "ctime": 0}
+            for team, username in requests
+        ]
+    )
+
+
+def policy(request):
+    """Accept writers, ignore spammers, and defer everyone else."""
+    if request.username.startswith("writer"):
+        return "writer"
+    if request.username.startswith("spam"):
+        return IGNORE
+    return DEFER
+
+
+class AccessRequestProcessorTest(TestCase):
+    def setUp(self):
+        self.keybase = mock.MagicMock()
+        self.api = self.keybase._api
+        self.teams = dict()
+        self.keybase.team.side_effect = lambda name: self.teams.setdefault(
+            name, mock.MagicMock()
+        )
+        self.processor = AccessRequestProcessor(self.keybase, policy)
+
+    def test_access_process(self):
+        self.api.run_command.return_value = requests_json(
+            ("team_one", "writer_a"),
+            ("team_one", "writer_b"),
+            ("team_two", "writer_c"),
+            ("team_one", "spammer"),
+            ("team_one", "someone"),
+        )
+        outcomes = self.processor.process()
+        self.api.run_command.assert_called_with("team list-requests --json")
+        self.assertEqual(len(outcomes), 5)
+        # Accepted requests are batched by team and role.
+        self.teams["team_one"].add_members.assert_called_once_with(
+            ["writer_a", "writer_b"], "writer"
+        )
+        self.teams["team_two"].add_members.assert_called_once_with(
+            ["writer_c"], "writer"
+        )
+        self.keybase.ignore_request.assert_called_once_with(
+            "team_one", "spammer"
+        )
+        self.assertIn(
+            (AccessRequest("team_one", "someone"), DEFER, None), outcomes
+        )
+
+        # Only new requests are processed at the next poll.
+        self.api.run_command.return_value = requests_json(
+            ("team_one", "someone"), ("team_one", "writer_d")
+        )
+        outcomes = self.processor.process()
+        self.assertEqual(
+            outcomes,
+            [(AccessRequest("team_one", "writer_d"), "writer", None)],
+        )
+
+    def test_access_failures(self):
+        self.api.run_command.return_value = requests_json(
+            ("team_one", "writer_a"), ("team_one", "spammer")
+        )
+        self.keybase.team.side_effect = None
+        self.keybase.team.return_value.add_members.side_effect = TeamException(
+            "Could not add members."
+        )
+        self.keybase.ignore_request.side_effect = KeybaseException("Failed.")
+        outcomes = self.processor.process()
+        self.assertEqual(
+            [outcome.error for outcome in outcomes],
+            ["Failed.", "Could not add members."],
+        )
+        # Failed requests are retried at the next poll.
+        self.keybase.team.return_value.add_members.side_effect = None
+        self.keybase.ignore_request.side_effect = None
+        self.keybase.team.return_value.add_members.side_effect = (
+            TimeoutException("Timed out.")
+        )
+        outcomes = self.processor.process()
+        self.assertEqual(
+            [outcome.error for outcome in outcomes], [None, "Timed out."]
+        )
+        self.keybase.team.return_value.add_members.side_effect = None
+        outcomes = self.processor.process()
+        self.assertEqual([outcome.error for outcome in outcomes], [None])
+        # Requests aren't marked as seen until the policy has decided them.
+        self.api.run_command.return_value = requests_json(
+            ("team_one", "writer_b")
+        )
+        policy = self.processor.policy
+        self.processor.policy = mock.MagicMock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            self.processor.process()
+        self.processor.policy = policy
+        self.assertEqual(len(self.processor.process()), 1)
+
+    def test_access_text_fallback(self):
+        self.api.run_command.side_effect = APIException("Unknown flag.")
+        self.keybase.list_requests.return_value = {"team_one": {"writer_a"}}
+        outcomes = self.processor.process()
+        self.assertEqual(
+            outcomes,
+            [(AccessRequest("team_one", "writer_a"), "writer", None)],
+        )
+        self.keybase.list_requests.side_effect = KeybaseException("Failed.")
+        with self.assertRaises(AccessException):
+            self.processor.process()
+
+    def test_access_run(self):
+        self.api.run_command.return_value = requests_json()
+        thread = threading.Thread(target=self.processor.run, args=(0.01,))
+        thread.start()
+        deadline = time.monotonic() + 5
+        while self.api.run_command.call_count < 2:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        with self.assertRaises(AccessException):
+            self.processor.run()
+        self.processor.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
@@ -1,11 +1,27 @@
 """Test the PyKBLib Keybase API class."""
 
+import subprocess
+import threading
+import time
 from unittest import TestCase, mock
 
 import pexpect
 
-from pykblib.api import KeybaseAPI
-from pykblib.exceptions import APIException
+from pykblib.api import (
+    KeybaseAPI,
+    bind_deadline,
+    deadline,
+    priority,
+    remaining,
+)
+from pykblib.exceptions import (
+    APIException,
+    ServiceUnavailableException,
+    TimeoutException,
+)
+from pykblib.fake import FakeKeybase
+from pykblib.limits import BULK, Scheduler
+from pykblib.retry import CircuitBreaker, RetryPolicy
 
 
 class KeybaseAPITest(TestCase):
@@ -60,6 +76,37 @@ class KeybaseAPITest(TestCase):
         ]
         self.api.delete_team("test_team")
 
+    @mock.patch("pykblib.api.subprocess.Popen")
+    def test_api_open_process(self, mock_popen):
+        mock_popen.return_value = "process"
+        self.assertEqual(
+            self.api.open_process(["fs", "read", "/keybase/team/x"]),
+            "process",
+        )
+        mock_popen.assert_called_with(
+            ["keybase", "fs", "read", "/keybase/team/x"],
+            stdin=None,
+            stdout=None,
+            stderr=subprocess.PIPE,
+        )
+        mock_popen.side_effect = FileNotFoundError(2, "No such file")
+        with self.assertRaises(APIException):
+            self.api.open_process(["status"])
+
+    @mock.patch("pykblib.api.pexpect.spawn")
+    def test_api_stream_lines(self, mock_spawn):
+        mock_child = mock.MagicMock()
+        mock_spawn.return_value = mock_child
+        mock_child.readline.side_effect = [
+            b"first line\r\n",
+            b"second line\r\n",
+            pexpect.exceptions.EOF("EOF"),
+        ]
+        lines = list(self.api.stream_lines("chat api-listen"))
+        self.assertEqual(lines, ["first line", "second line"])
+        mock_spawn.assert_called_with("keybase chat api-listen", timeout=None)
+        mock_child.close.assert_called_with(force=True)
+
     @mock.patch("pykblib.api.pexpect.run")
     def test_api_run_command(self, mock_run):
         # The pexpect.run function returns a bytes object.
@@ -74,3 +121,198 @@ class KeybaseAPITest(TestCase):
         )
         with self.assertRaises(APIException):
             self.api.run_command("test command")
+
+    def test_api_executable(self):
+        api = KeybaseAPI(executable="python -m pykblib.fake")
+        with mock.patch("pykblib.api.pexpect.run") as mock_run:
+            mock_run.return_value = b"output"
+            api.run_command("status")
+        mock_run.assert_called_with("python -m pykblib.fake status")
+        with mock.patch("pykblib.api.subprocess.Popen") as mock_popen:
+            api.open_process(["encrypt"])
+        mock_popen.assert_called_with(
+            ["python", "-m", "pykblib.fake", "encrypt"],
+            stdin=None,
+            stdout=None,
+            stderr=subprocess.PIPE,
+        )
+
+    def test_api_transport(self):
+        transport = mock.MagicMock()
+        api = KeybaseAPI(transport)
+        transport.run_command.return_value = '{"result": {"value": 1}}'
+        self.assertEqual(api.call_api("team", {}).result.value, 1)
+        transport.run_command.assert_called_with("team api -m '{}'")
+        api.delete_team("test_team")
+        transport.delete_team.assert_called_with("test_team")
+        api.open_process(["encrypt"], stdin=subprocess.PIPE)
+        transport.open_process.assert_called_with(
+            ["encrypt"], stdin=subprocess.PIPE, stdout=None
+        )
+        transport.stream_lines.return_value = iter(["line"])
+        self.assertEqual(list(api.stream_lines("chat api-listen")), ["line"])
+
+    def test_api_deadline(self):
+        self.assertIsNone(remaining())
+        with deadline(10):
+            self.assertLessEqual(remaining(), 10)
+            # Nested deadlines can only shorten the limit.
+            with deadline(60):
+                self.assertLessEqual(remaining(), 10)
+            with deadline(1):
+                self.assertLessEqual(remaining(), 1)
+            self.assertGreater(remaining(), 1)
+            # Functions run in other threads can share the deadline.
+            results = list()
+            bound = bind_deadline(lambda: results.append(remaining()))
+            thread = threading.Thread(target=bound)
+            thread.start()
+            thread.join()
+            self.assertLessEqual(results[0], 10)
+        self.assertIsNone(remaining())
+        transport = mock.MagicMock()
+        api = KeybaseAPI(transport)
+        with deadline(0):
+            with self.assertRaises(TimeoutException):
+                api.run_command("status")
+        transport.run_command.assert_not_called()
+
+    @mock.patch("pykblib.api.pexpect.run")
+    def test_api_run_command_timeout(self, mock_run):
+        child = mock.MagicMock()
+
+        def hang(command, timeout, events):
+            # Simulate a client that never finishes.
+            events[pexpect.TIMEOUT]({"child": child})
+            return b""
+
+        mock_run.side_effect = hang
+        with self.assertRaises(TimeoutException):
+            self.api.run_command("status", timeout=5)
+        child.terminate.assert_called_with(force=True)
+        self.assertLessEqual(mock_run.call_args[1]["timeout"], 5)
+        # The instance timeout applies to every call.
+        api = KeybaseAPI(timeout=2)
+        with self.assertRaises(TimeoutException):
+            api.run_command("status")
+        self.assertLessEqual(mock_run.call_args[1]["timeout"], 2)
+
+    @mock.patch("pykblib.api.pexpect.spawn")
+    def test_api_delete_team_timeout(self, mock_spawn):
+        mock_child = mock.MagicMock()
+        mock_spawn.return_value = mock_child
+
+        def hang(pattern, timeout):
+            time.sleep(timeout)
+            raise pexpect.exceptions.TIMEOUT("TIMEOUT")
+
+        mock_child.expect.side_effect = hang
+        with deadline(0.05):
+            with self.assertRaises(TimeoutException):
+                self.api.delete_team("test_team")
+        self.assertLessEqual(mock_child.expect.call_args[1]["timeout"], 0.05)
+        mock_child.close.assert_called_with(force=True)
+
+    def test_api_scheduler(self):
+        fake = FakeKeybase("test_user")
+        self.addCleanup(fake.close)
+        scheduler = Scheduler(rates={"team-write": None})
+        api = KeybaseAPI(fake, scheduler=scheduler)
+        limiter = scheduler.limiters["team-write"]
+        limit = limiter.limit
+        query = {
+            "method": "create-team",
+            "params": {"options": {"team": "test_team"}},
+        }
+        api.call_api("team", query)
+        self.assertGreater(limiter.limit, limit)
+        limit = limiter.limit
+        fake.inject_error("team/create-team", "Rate limit exceeded.")
+        with self.assertRaises(APIException):
+            api.call_api("team", query)
+        self.assertEqual(limiter.limit, limit / 2)
+        self.assertEqual(limiter.active, 0)
+        # Waiting for the scheduler counts against the call's time.
+        limiter.limit = 1
+        limiter.acquire()
+        with self.assertRaises(TimeoutException):
+            api.call_api("team", query, timeout=0.01)
+
+    def test_api_priority(self):
+        scheduler = mock.MagicMock()
+        scheduler.slot.return_value.__enter__.return_value = True
+        transport = mock.MagicMock()
+        transport.run_command.return_value = "output"
+        api = KeybaseAPI(transport, scheduler=scheduler)
+        api.run_command("status")
+        scheduler.slot.assert_called_with("status", "status", None, None)
+        with priority(BULK):
+            api.run_command("status")
+            scheduler.slot.assert_called_with("status", "status", None, BULK)
+            # The priority is carried into other threads.
+            bound = bind_deadline(lambda: api.run_command("status"))
+        scheduler.slot.reset_mock()
+        thread = threading.Thread(target=bound)
+        thread.start()
+        thread.join()
+        scheduler.slot.assert_called_with("status", "status", None, BULK)
+
+    @mock.patch("pykblib.api.time.sleep")
+    def test_api_retry(self, mock_sleep):
+        fake = FakeKeybase("test_user")
+        self.addCleanup(fake.close)
+        api = KeybaseAPI(fake, retry=RetryPolicy(attempts=3))
+        fake.inject_error("status", "connection refused", times=2)
+        self.assertIn("test_user", api.run_command("status"))
+        self.assertEqual(mock_sleep.call_count, 2)
+        # Writes and errors from Keybase itself aren't retried.
+        query = {
+            "method": "create-team",
+            "params": {"options": {"team": "test_team"}},
+        }
+        fake.inject_error("team/create-team", "connection refused")
+        with self.assertRaises(APIException):
+            api.call_api("team", query)
+        fake.inject_error("status", "not logged in")
+        with self.assertRaises(APIException):
+            api.run_command("status")
+        self.assertEqual(mock_sleep.call_count, 2)
+        # Writes marked as safe are retried.
+        api.retry.mark_safe("team", "create-team")
+        fake.inject_error("team/create-team", "connection refused")
+        api.call_api("team", query)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    def test_api_circuit_breaker(self):
+        fake = FakeKeybase("test_user")
+        self.addCleanup(fake.close)
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        api = KeybaseAPI(fake, breaker=breaker)
+        fake.inject_error("status", "connection refused", times=2)
+        for _ in range(2):
+            with self.assertRaises(APIException):
+                api.run_command("status")
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(ServiceUnavailableException):
+            api.run_command("status")
+        with self.assertRaises(ServiceUnavailableException):
+            api.open_process(["encrypt"])
+
+    def test_api_circuit_breaker_deadline(self):
+        fake = FakeKeybase("test_user")
+        self.addCleanup(fake.close)
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+        api = KeybaseAPI(fake, breaker=breaker)
+        # Callers whose own time has run out don't trip the breaker.
+        with deadline(0):
+            with self.assertRaises(TimeoutException):
+                api.run_command("status")
+            with self.assertRaises(TimeoutException):
+                api.delete_team("team_one")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        # Keybase timing out does.
+        fake.latency = 0.2
+        with deadline(0.05):
+            with self.assertRaises(TimeoutException):
+                api.run_command("status")
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
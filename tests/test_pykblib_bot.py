@@ -0,0 +1,118 @@
+"""Test the PyKBLib Bot class."""
+
+import asyncio
+import threading
+import time
+from unittest import TestCase, mock
+
+from steffentools import dict_to_ntuple
+
+from pykblib.bot import Bot
+from pykblib.exceptions import BotException
+
+
+def chat_message(body, conversation_id="conv_one", sender="other_user"):
+    """Build a simulated chat message."""
+    return dict_to_ntuple(
+        {
+            "id": 1,
+            "conversation_id": conversation_id,
+            "channel": {"name": "team_one", "members_type": "team"},
+            "sender": {"username": sender},
+            "sent_at": 1000,
+            "content": {"type": "text", "text": {"body": body}},
+        }
+    )
+
+
+class BotTest(TestCase):
+    def setUp(self):
+        self.keybase = mock.MagicMock()
+        self.keybase.username = "test_user"
+        self.bot = Bot(self.keybase, workers=4)
+
+    def test_bot_routing(self):
+        handler = mock.MagicMock()
+        self.bot.add_command("ping", handler)
+        # Messages that aren't registered commands are not queued.
+        self.assertFalse(self.bot.dispatch(chat_message("ping")))
+        self.assertFalse(self.bot.dispatch(chat_message("!pong")))
+        self.assertFalse(
+            self.bot.dispatch(chat_message("!ping", sender="test_user"))
+        )
+        self.assertTrue(self.bot.dispatch(chat_message("!ping a b")))
+        self.bot._executor.shutdown(wait=True)
+        handler.assert_called_once_with(chat_message("!ping a b"), ["a", "b"])
+
+    def test_bot_ordering(self):
+        handled = list()
+        release = threading.Event()
+
+        @self.bot.command("work")
+        def work(message, args):
+            if message.conversation_id == "conv_one":
+                release.wait(5)
+            handled.append((message.conversation_id, args[0]))
+
+        for index in range(3):
+            self.bot.dispatch(chat_message("!work {}".format(index)))
+        # Another conversation isn't blocked by the first.
+        self.bot.dispatch(chat_message("!work 0", conversation_id="conv_two"))
+        deadline = time.monotonic() + 5
+        while not handled and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(handled, [("conv_two", "0")])
+        metrics = self.bot.metrics()
+        self.assertEqual(metrics["queue_depth"], 2)
+        self.assertEqual(metrics["active_conversations"], 1)
+        release.set()
+        self.bot._executor.shutdown(wait=True)
+        self.assertEqual(
+            [arg for conv, arg in handled if conv == "conv_one"],
+            ["0", "1", "2"],
+        )
+        metrics = self.bot.metrics()
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["handlers"]["work"]["calls"], 4)
+
+    def test_bot_handler_errors(self):
+        self.bot.add_command("fail", mock.MagicMock(side_effect=ValueError))
+        with self.assertLogs("pykblib.bot"):
+            self.bot.dispatch(chat_message("!fail"))
+            self.bot._executor.shutdown(wait=True)
+        self.assertEqual(self.bot.metrics()["handlers"]["fail"]["errors"], 1)
+
+    def test_bot_reply(self):
+        message = chat_message("!ping")
+        self.bot.reply(message, "pong")
+        self.keybase.chat.send.assert_called_with(
+            {"members_type": "team", "name": "team_one"}, "pong"
+        )
+
+    def test_bot_run(self):
+        handler = mock.MagicMock()
+        self.bot.add_command("ping", handler)
+        self.keybase.chat.listen.return_value = (
+            message for message in [chat_message("!ping")] * 2
+        )
+        self.bot.run()
+        self.assertEqual(handler.call_count, 2)
+        self.bot._running = True
+        with self.assertRaises(BotException):
+            self.bot.run()
+
+    def test_bot_run_async(self):
+        handled = list()
+
+        @self.bot.command("ping")
+        async def ping(message, args):
+            await asyncio.sleep(0.05)
+            handled.append(args)
+
+        self.keybase.chat.listen.return_value = (
+            chat_message("!ping {}".format(index)) for index in (1, 2)
+        )
+        # Queued handlers finish before the coroutine returns.
+        asyncio.run(self.bot.run_async())
+        self.assertEqual(handled, [["1"], ["2"]])
+        self.assertEqual(self.bot.metrics()["active_conversations"], 0)
@@ -0,0 +1,181 @@
+"""Test the PyKBLib TTLCache and SharedTeamCache classes."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from pykblib import Keybase
+from pykblib.api import deadline
+from pykblib.cache import SharedTeamCache, TTLCache
+from pykblib.exceptions import APIException, TimeoutException
+from pykblib.fake import FakeKeybase
+
+
+class TTLCacheTest(TestCase):
+    @mock.patch("pykblib.cache.time")
+    def test_cache_expiry(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        cache = TTLCache(ttl=10)
+        cache.set("short", 1, ttl=1)
+        cache.set("long", 2)
+        self.assertEqual(cache.get("short"), 1)
+        mock_time.monotonic.return_value = 105
+        self.assertNotIn("short", cache)
+        self.assertEqual(cache.get("long"), 2)
+        mock_time.monotonic.return_value = 110
+        self.assertEqual(cache.get("long", "default"), "default")
+        self.assertEqual(len(cache), 0)
+
+    def test_cache_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Reading an entry makes it the most recently used.
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.pop("c"), 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class SharedTeamCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "teams.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch("pykblib.cache.time")
+    def test_cache_refresh(self, mock_time):
+        mock_time.time.return_value = 100
+        mock_time.sleep.side_effect = AssertionError("Unexpected wait.")
+        first = SharedTeamCache(self.path, max_age=10, max_stale=60)
+        second = SharedTeamCache(self.path, max_age=10, max_stale=60)
+        self.assertEqual(first.fetch("team/one", lambda: "a"), "a")
+        # Fresh entries are shared with other instances.
+        self.assertEqual(second.fetch("team/one", lambda: "b"), "a")
+        self.assertEqual(second.stats["hits"], 1)
+        # While one instance refreshes a stale entry, the others receive the
+        # previous value.
+        mock_time.time.return_value = 120
+
+        def refresh():
+            self.assertEqual(second.fetch("team/one", lambda: "c"), "a")
+            return "b"
+
+        self.assertEqual(first.fetch("team/one", refresh), "b")
+        self.assertEqual(second.stats["stale_hits"], 1)
+        self.assertEqual(second.fetch("team/one", lambda: "c"), "b")
+        self.assertEqual(first.stats["misses"], 2)
+        first.invalidate("team/")
+        self.assertEqual(second.fetch("team/one", lambda: "c"), "c")
+        first.close()
+        second.close()
+
+    def test_cache_lease(self):
+        first = SharedTeamCache(self.path, lease=0.2)
+        second = SharedTeamCache(self.path, lease=0.2)
+
+        def refresh():
+            # Without a previous value, the other instance waits, until the
+            # deadline expires or the lease is lost.
+            with deadline(0.05):
+                with self.assertRaises(TimeoutException):
+                    second.fetch("team/one", lambda: "b")
+            self.assertEqual(second.fetch("team/one", lambda: "b"), "b")
+            return "a"
+
+        self.assertEqual(first.fetch("team/one", refresh), "a")
+        self.assertGreater(second.stats["waits"], 1)
+        # The value fetched after losing the lease isn't stored.
+        self.assertEqual(first.fetch("team/one", lambda: "c"), "b")
+        first.close()
+        second.close()
+
+    def test_cache_keys(self):
+        cache = SharedTeamCache(self.path)
+        members = {
+            "method": "list-team-memberships",
+            "params": {"options": {"team": "one"}},
+        }
+        teams = {
+            "method": "list-user-memberships",
+            "params": {"options": {"username": "alice"}},
+        }
+        self.assertEqual(cache.key_for(members), "team/one")
+        self.assertEqual(cache.key_for(teams), "teams/alice")
+        cache.fetch("team/one", lambda: "a")
+        cache.fetch("team/one.sub", lambda: "a")
+        cache.fetch("team/oneself", lambda: "a")
+        cache.fetch("teams/alice", lambda: "a")
+        cache.invalidate_for(
+            {"method": "add-members", "params": {"options": {"team": "one"}}}
+        )
+        self.assertEqual(cache.fetch("team/one", lambda: "b"), "b")
+        self.assertEqual(cache.fetch("team/one.sub", lambda: "b"), "b")
+        # Teams whose names merely start with the same letters are kept.
+        self.assertEqual(cache.fetch("team/oneself", lambda: "b"), "a")
+        self.assertEqual(cache.fetch("teams/alice", lambda: "b"), "a")
+        cache.invalidate_for(
+            {"method": "leave-team", "params": {"options": {"team": "one"}}}
+        )
+        self.assertEqual(cache.fetch("teams/alice", lambda: "b"), "b")
+        cache.close()
+
+    def test_keybase_team_cache(self):
+        fake = FakeKeybase("test_user", users=["alice"])
+        team_cache = SharedTeamCache(self.path)
+        first = Keybase(transport=fake, team_cache=team_cache)
+        team = first.create_team("team_one")
+        first.update_team_list()
+        with mock.patch.object(
+            fake, "run_command", wraps=fake.run_command
+        ) as run_command:
+            # The team list fetched by the first instance is shared.
+            second = Keybase(
+                transport=fake, team_cache=SharedTeamCache(self.path)
+            )
+            second.update_team_list()
+            self.assertIn("team_one", second.teams)
+            commands = [call[0][0] for call in run_command.call_args_list]
+            self.assertFalse(
+                [c for c in commands if "list-user-memberships" in c]
+            )
+            # Changing a team removes its entry.
+            team.add_members(["alice"], "writer")
+            second_team = second.team("team_one")
+            self.assertEqual(second_team.members_by_role.writer, {"alice"})
+            # Errors aren't cached.
+            fake.inject_error("team/list-team-memberships", "failed")
+            team_cache.invalidate("team/")
+            with self.assertRaises(APIException):
+                second_team.update()
+            second_team.update()
+        first.delete_team("team_one")
+        second.update_team_list()
+        self.assertNotIn("team_one", second.teams)
+        fake.close()
+
+    def test_keybase_team_cache_commands(self):
+        fake = FakeKeybase("test_user", users=["alice"])
+        owner = Keybase(transport=fake)
+        owner.create_team("team_one")
+        fake.username = "alice"
+        team_cache = SharedTeamCache(self.path)
+        alice = Keybase(transport=fake, team_cache=team_cache)
+        alice.update_team_list()
+        team_cache.fetch("team/team_one", lambda: "a")
+        team_cache.fetch("team/team_two", lambda: "a")
+        # Reading the requests doesn't change any team.
+        alice.list_requests()
+        self.assertEqual(team_cache.fetch("team/team_one", lambda: "b"), "a")
+        # Joining a team through a command removes the team lists.
+        alice._api.run_command("team request-access team_one")
+        self.assertEqual(team_cache.fetch("team/team_one", lambda: "b"), "b")
+        self.assertEqual(team_cache.fetch("team/team_two", lambda: "b"), "a")
+        self.assertEqual(team_cache.fetch("teams/alice", lambda: "b"), "b")
+        fake.close()
@@ -0,0 +1,100 @@
+"""Test the PyKBLib RecordingTransport and ReplayTransport classes."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from pykblib import Keybase
+from pykblib.cassette import RecordingTransport, ReplayTransport
+from pykblib.exceptions import APIException, KeybaseException
+from pykblib.fake import FakeKeybase
+
+
+class CassetteTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cassette.jsonl.gz")
+        self.fake = FakeKeybase("test_user", users=["alice"], latency=0.01)
+
+    def tearDown(self):
+        self.fake.close()
+        shutil.rmtree(self.directory)
+
+    def record(self):
+        """Record a session of team and chat activity."""
+        with RecordingTransport(self.path, self.fake) as recorder:
+            keybase = Keybase(transport=recorder)
+            team = keybase.create_team("team_one")
+            team.add_members(["alice"], "writer")
+            self.fake.inject_error("team/create-team", "already exists")
+            with self.assertRaises(KeybaseException):
+                keybase.create_team("team_one")
+            stream = recorder.stream_lines("chat api-listen")
+            received = list()
+            thread = threading.Thread(
+                target=lambda: received.extend(stream), daemon=True
+            )
+            thread.start()
+            time.sleep(0.05)
+            keybase.chat.send(
+                {"name": "team_one", "members_type": "team"}, "hello"
+            )
+            time.sleep(0.05)
+            self.fake.close()
+            thread.join(5)
+            keybase.delete_team("team_one")
+        return received
+
+    def test_cassette_replay(self):
+        received = self.record()
+        self.assertEqual(len(received), 1)
+        replay = ReplayTransport(self.path, speed=None)
+        keybase = Keybase(transport=replay)
+        self.assertEqual(keybase.username, "test_user")
+        team = keybase.create_team("team_one")
+        team.add_members(["alice"], "writer")
+        self.assertEqual(team.members_by_role.writer, {"alice"})
+        # Recorded errors are replayed.
+        with self.assertRaises(KeybaseException):
+            keybase.create_team("team_one")
+        self.assertEqual(
+            list(replay.stream_lines("chat api-listen")), received
+        )
+        keybase.chat.send(
+            {"name": "team_one", "members_type": "team"}, "hello"
+        )
+        keybase.delete_team("team_one")
+        self.assertEqual(replay.remaining, 0)
+        # Unrecorded requests are refused.
+        with self.assertRaises(APIException):
+            replay.run_command("status")
+        with self.assertRaises(APIException):
+            replay.open_process(["encrypt"])
+
+    def test_cassette_speed(self):
+        with RecordingTransport(self.path, self.fake) as recorder:
+            for _ in range(5):
+                recorder.run_command("status")
+        started = time.monotonic()
+        replay = ReplayTransport(self.path)
+        for _ in range(5):
+            replay.run_command("status")
+        recorded_speed = time.monotonic() - started
+        self.assertGreaterEqual(recorded_speed, 0.05)
+        started = time.monotonic()
+        replay = ReplayTransport(self.path, speed=10, repeat=True)
+        for _ in range(5):
+            replay.run_command("status")
+        self.assertLess(time.monotonic() - started, recorded_speed)
+        # Responses are served again once they have been used up.
+        self.assertIn("test_user", replay.run_command("status"))
+
+    def test_cassette_invalid(self):
+        path = os.path.join(self.directory, "invalid.jsonl")
+        with open(path, "w") as cassette:
+            cassette.write('{"version": 99}\n')
+        with self.assertRaises(APIException):
+            ReplayTransport(path)
@@ -0,0 +1,548 @@
+"""Test the PyKBLib Chat class."""
+
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from steffentools import dict_to_ntuple
+
+from pykblib.api import deadline, remaining
+from pykblib.chat import Chat, DeliveryResult, _channel_options
+from pykblib.exceptions import (
+    APIException,
+    ChatException,
+    TimeoutException,
+)
+from pykblib.store import MessageStore
+
+
+def read_response(message_ids, next_token=None, last=False):
+    """Build a simulated response to a chat API read query."""
+    return dict_to_ntuple(
+        {
+            "result": {
+                "messages": [
+                    {
+                        "msg": {
+                            "id": message_id,
+                            "conversation_id": "conv_id",
+                            "channel": {"name": "team_one"},
+                            "sender": {"username": "test_user"},
+                            "sent_at": message_id * 10,
+                            "content": {
+                                "type": "text",
+                                "text": {
+                                    "body": "message {}".format(message_id)
+                                },
+                            },
+                        }
+                    }
+                    for message_id in message_ids
+                ],
+                "pagination": {
+                    "next": next_token,
+                    "num": len(message_ids),
+                    "last": last,
+                },
+            }
+        }
+    )
+
+
+def list_response(*conversations):
+    """Build a simulated response to a chat API list query."""
+    return dict_to_ntuple(
+        {
+            "result": {
+                "conversations": [
+                    {
+                        "id": conversation_id,
+                        "channel": {
+                            "name": name,
+                            "members_type": "team",
+                            "topic_type": "chat",
+                            "topic_name": topic_name,
+                        },
+                    }
+                    for conversation_id, name, topic_name in conversations
+                ]
+            }
+        }
+    )
+
+
+def create_chat():
+    """Create a Chat with a mocked API and a pre-loaded directory."""
+    keybase = mock.MagicMock()
+    chat = Chat(keybase)
+    api = keybase._api
+    api.call_api.return_value = list_response(
+        ("conv_id", "team_one", "general"),
+        ("conv_random", "team_one", "random"),
+    )
+    chat.refresh_conversations()
+    api.reset_mock()
+    return chat, api
+
+
+class ChatChannelTest(TestCase):
+    def test_chat_channel_options(self):
+        self.assertEqual(
+            _channel_options("team_one#random"),
+            {
+                "channel": {
+                    "name": "team_one",
+                    "members_type": "team",
+                    "topic_name": "random",
+                }
+            },
+        )
+        self.assertEqual(
+            _channel_options("team_one")["channel"]["topic_name"], "general"
+        )
+        self.assertEqual(
+            _channel_options("alice,bob"),
+            {
+                "channel": {
+                    "name": "alice,bob",
+                    "members_type": "impteamnative",
+                }
+            },
+        )
+        self.assertEqual(
+            _channel_options({"name": "raw"}), {"channel": {"name": "raw"}}
+        )
+
+
+class ChatHistoryTest(TestCase):
+    def setUp(self):
+        self.chat, self.api = create_chat()
+
+    def test_chat_iter_history(self):
+        self.api.call_api.side_effect = [
+            read_response([6, 5, 4], "page_2"),
+            read_response([3, 2, 1], "page_3", last=True),
+        ]
+        history = self.chat.iter_history("team_one", page_size=3)
+        self.assertEqual([msg.id for msg in history], [6, 5, 4, 3, 2, 1])
+        self.assertEqual(self.api.call_api.call_count, 2)
+        self.api.call_api.assert_called_with(
+            "chat",
+            {
+                "method": "read",
+                "params": {
+                    "options": {
+                        "conversation_id": "conv_id",
+                        "pagination": {"num": 3, "next": "page_2"},
+                        "peek": True,
+                    }
+                },
+            },
+        )
+
+    def test_chat_iter_history_since(self):
+        self.api.call_api.side_effect = [
+            read_response([6, 5, 4], "page_2"),
+            read_response([3, 2, 1], "page_3"),
+            read_response([], "page_4"),
+        ]
+        history = self.chat.iter_history("team_one", page_size=3, since=25)
+        self.assertEqual([msg.id for msg in history], [6, 5, 4, 3])
+
+    def test_chat_iter_history_resume(self):
+        self.api.call_api.side_effect = [
+            read_response([6, 5, 4], "page_2"),
+            read_response([3, 2, 1], "page_3", last=True),
+        ]
+        history = self.chat.iter_history("team_one", page_size=3)
+        self.assertEqual([next(history).id for _ in range(4)], [6, 5, 4, 3])
+        cursor = history.cursor
+        self.assertEqual(cursor, ("page_2", 1))
+        history.close()
+
+        # Resuming from the saved cursor re-reads only the current page.
+        self.api.call_api.side_effect = [
+            read_response([3, 2, 1], "page_3", last=True)
+        ]
+        history = self.chat.iter_history("team_one", cursor=cursor)
+        self.assertEqual([msg.id for msg in history], [2, 1])
+
+    def test_chat_iter_history_deadline(self):
+        budgets = list()
+
+        pages = [
+            read_response([6, 5, 4], "page_2"),
+            read_response([3], "page_3", last=True),
+        ]
+
+        def read(service, query):
+            budgets.append(remaining())
+            return pages.pop(0)
+
+        self.api.call_api.side_effect = read
+        with deadline(30):
+            history = self.chat.iter_history("team_one", page_size=3)
+            self.assertEqual([msg.id for msg in history], [6, 5, 4, 3])
+        # Both the first page and the prefetched one had the deadline.
+        self.assertEqual(len(budgets), 2)
+        self.assertTrue(all(0 < budget <= 30 for budget in budgets))
+
+    def test_chat_iter_history_failure(self):
+        self.api.call_api.side_effect = APIException("EXCEPTION")
+        history = self.chat.iter_history("team_one")
+        with self.assertRaises(ChatException):
+            next(history)
+        # A truncated history keeps failing rather than ending.
+        with self.assertRaises(ChatException):
+            next(history)
+
+        # The same applies to prefetched pages.
+        self.api.call_api.side_effect = [
+            read_response([6, 5, 4], "page_2"),
+            APIException("EXCEPTION"),
+        ]
+        history = self.chat.iter_history("team_one", page_size=3)
+        self.assertEqual([next(history).id for _ in range(3)], [6, 5, 4])
+        for _ in range(2):
+            with self.assertRaises(ChatException):
+                next(history)
+
+
+class ChatDirectoryTest(TestCase):
+    def setUp(self):
+        keybase = mock.MagicMock()
+        self.chat = Chat(keybase)
+        self.api = keybase._api
+
+    def test_chat_conversation_id(self):
+        self.api.call_api.side_effect = [
+            list_response(("conv_id", "team_one", "general")),
+            list_response(("conv_dev", "team_two", "dev")),
+        ]
+        self.assertEqual(self.chat.conversation_id("team_one"), "conv_id")
+        self.api.call_api.assert_called_once_with("chat", {"method": "list"})
+        # The directory is only loaded once.
+        self.assertEqual(
+            self.chat.conversation_id("team_one#general"), "conv_id"
+        )
+        self.assertEqual(self.api.call_api.call_count, 1)
+        # Unknown team channels are looked up by team, once per team.
+        self.assertEqual(self.chat.conversation_id("team_two#dev"), "conv_dev")
+        self.api.call_api.assert_called_with(
+            "chat",
+            {
+                "method": "listconvsonname",
+                "params": {
+                    "options": {
+                        "name": "team_two",
+                        "members_type": "team",
+                        "topic_type": "CHAT",
+                    }
+                },
+            },
+        )
+        self.assertIsNone(self.chat.conversation_id("team_two#missing"))
+        self.assertEqual(self.api.call_api.call_count, 2)
+
+    def test_chat_conversation_fallback(self):
+        self.api.call_api.side_effect = [
+            APIException("EXCEPTION"),
+            dict_to_ntuple({"result": {"id": 1}}),
+        ]
+        with self.assertRaises(ChatException):
+            self.chat.conversation_id("team_one")
+        # If the directory can't be loaded, messages are sent by name.
+        self.api.call_api.side_effect = [
+            APIException("EXCEPTION"),
+            dict_to_ntuple({"result": {"id": 1}}),
+        ]
+        self.chat.send("team_one", "hello")
+        options = self.api.call_api.call_args[0][1]["params"]["options"]
+        self.assertEqual(options["channel"]["name"], "team_one")
+
+    def test_chat_listen_updates_directory(self):
+        self.api.call_api.return_value = list_response()
+        self.chat.refresh_conversations()
+        self.api.stream_lines.return_value = iter(
+            [
+                '{"type": "chat", "msg": {"id": 1, '
+                '"conversation_id": "conv_new", "channel": '
+                '{"name": "team_three", "members_type": "team", '
+                '"topic_name": "general"}}}'
+            ]
+        )
+        list(self.chat.listen())
+        self.assertEqual(self.chat.conversation_id("team_three"), "conv_new")
+
+
+class ChatSendTest(TestCase):
+    def setUp(self):
+        self.chat, self.api = create_chat()
+
+    def test_chat_send(self):
+        self.api.call_api.return_value = dict_to_ntuple(
+            {"result": {"message": "message sent", "id": 42}}
+        )
+        self.assertEqual(self.chat.send("team_one#random", "hello"), 42)
+        self.api.call_api.assert_called_with(
+            "chat",
+            {
+                "method": "send",
+                "params": {
+                    "options": {
+                        "conversation_id": "conv_random",
+                        "message": {"body": "hello"},
+                    }
+                },
+            },
+        )
+        self.api.call_api.side_effect = APIException("EXCEPTION")
+        with self.assertRaises(ChatException):
+            self.chat.send("team_one", "hello")
+
+
+class ChatBroadcastTest(TestCase):
+    def setUp(self):
+        self.chat, self.api = create_chat()
+        self.chat._keybase.teams = ["team_one", "team_two", "team_three"]
+
+    def test_chat_broadcast(self):
+        def send(channel, message):
+            if channel == "team_two":
+                raise ChatException("Could not send.")
+            if channel == "team_four":
+                raise TimeoutException("Timed out.")
+            return len(channel)
+
+        with mock.patch.object(self.chat, "send", side_effect=send) as sender:
+            results = self.chat.broadcast("incident", max_workers=2)
+            self.assertEqual(
+                results,
+                {
+                    "team_one": DeliveryResult(True, 8, None),
+                    "team_two": DeliveryResult(False, None, "Could not send."),
+                    "team_three": DeliveryResult(True, 10, None),
+                },
+            )
+            self.assertEqual(
+                list(results), ["team_one", "team_two", "team_three"]
+            )
+            self.assertEqual(sender.call_count, 3)
+            # A timeout only fails its own target.
+            timed_out = self.chat.broadcast(
+                "incident", ["team_four", "team_one"]
+            )
+            self.assertEqual(
+                timed_out["team_four"],
+                DeliveryResult(False, None, "Timed out."),
+            )
+            self.assertTrue(timed_out["team_one"].delivered)
+
+            # Resuming only retries the failed target.
+            sender.reset_mock()
+            sender.side_effect = None
+            sender.return_value = 99
+            results = self.chat.broadcast("incident", results=results)
+            sender.assert_called_once_with("team_two", "incident")
+            self.assertEqual(
+                results["team_two"], DeliveryResult(True, 99, None)
+            )
+            self.assertEqual(
+                results["team_one"], DeliveryResult(True, 8, None)
+            )
+
+    @mock.patch("pykblib.chat.TokenBucket")
+    def test_chat_broadcast_rate(self, mock_bucket):
+        with mock.patch.object(self.chat, "send", return_value=1):
+            self.chat.broadcast("incident", ["team_one", "team_two"], rate=5)
+        mock_bucket.assert_called_with(5)
+        self.assertEqual(mock_bucket.return_value.acquire.call_count, 2)
+
+
+class ChatListenTest(TestCase):
+    def setUp(self):
+        self.chat, self.api = create_chat()
+
+    def test_chat_listen(self):
+        message = read_response([1]).result.messages[0].msg
+        self.api.stream_lines.return_value = iter(
+            [
+                "Listening for chat notifications.",
+                '{"type": "wallet", "notification": {}}',
+                '{"type": "chat", "source": "remote", "msg": '
+                '{"id": 1, "conversation_id": "conv_id", '
+                '"channel": {"name": "team_one"}, '
+                '"sender": {"username": "test_user"}, "sent_at": 10, '
+                '"content": {"type": "text", "text": {"body": "message 1"}}}}',
+            ]
+        )
+        store = mock.MagicMock()
+        self.assertEqual(list(self.chat.listen(store=store)), [message])
+        self.api.stream_lines.assert_called_with("chat api-listen")
+        store.add.assert_called_with([message])
+
+    def test_chat_sync(self):
+        store = MessageStore()
+        self.api.call_api.side_effect = [
+            read_response([3, 2], "page_2"),
+            read_response([1], "page_3", last=True),
+        ]
+        self.assertEqual(self.chat.sync("team_one", store, page_size=2), 3)
+        self.assertEqual(store.high_water("conv_id"), 3)
+
+        # The next sync stops as soon as it reaches the high-water mark.
+        self.api.call_api.side_effect = [
+            read_response([5, 4], "page_2"),
+            read_response([3, 2], "page_3"),
+        ]
+        self.assertEqual(self.chat.sync("team_one", store, page_size=2), 2)
+        self.assertEqual(store.high_water("conv_id"), 5)
+        self.assertEqual(
+            [result.message_id for result in store.search(text="message")],
+            [5, 4, 3, 2, 1],
+        )
+        store.close()
+
+
+class ChatTransferTest(TestCase):
+    def setUp(self):
+        self.chat, self.api = create_chat()
+        self.api.call_api.return_value = dict_to_ntuple(
+            {"result": {"message": "attachment sent", "id": 7}}
+        )
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_chat_upload_path(self):
+        path = os.path.join(self.temp_dir.name, "report.txt")
+        with open(path, "wb") as output:
+            output.write(b"report")
+        progress = mock.MagicMock()
+        self.assertEqual(
+            self.chat.upload(
+                "team_one", path, title="Report", progress=progress
+            ),
+            7,
+        )
+        options = self.api.call_api.call_args[0][1]["params"]["options"]
+        self.assertEqual(options["filename"], path)
+        self.assertEqual(options["title"], "Report")
+        progress.assert_called_with(6, 6)
+        # Transfers run on the pool within the caller's deadline.
+        budgets = list()
+
+        def attach(service, query):
+            budgets.append(remaining())
+            return dict_to_ntuple({"result": {"id": 9}})
+
+        self.api.call_api.side_effect = attach
+        with deadline(30):
+            future = self.chat.upload("team_one", path, wait=False)
+        self.assertEqual(future.result(), 9)
+        self.assertTrue(0 < budgets[0] <= 30)
+
+    def test_chat_upload_stream(self):
+        spooled = list()
+
+        def attach(service, query):
+            filename = query["params"]["options"]["filename"]
+            with open(filename, "rb") as spool:
+                spooled.append((os.path.basename(filename), spool.read()))
+            return dict_to_ntuple({"result": {"id": 8}})
+
+        self.api.call_api.side_effect = attach
+        stream = io.BytesIO(b"x" * 100000)
+        stream.name = "/some/where/data.bin"
+        future = self.chat.upload("team_one", stream, wait=False)
+        self.assertEqual(future.result(), 8)
+        self.assertEqual(spooled, [("data.bin", b"x" * 100000)])
+        # The spooled copy is removed afterwards.
+        spool_dir = os.path.dirname(
+            self.api.call_api.call_args[0][1]["params"]["options"]["filename"]
+        )
+        self.assertFalse(os.path.exists(spool_dir))
+
+        # Pipes have no file name.
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(write_fd, "wb") as pipe:
+            pipe.write(b"piped")
+        with os.fdopen(read_fd, "rb") as pipe:
+            self.assertEqual(self.chat.upload("team_one", pipe), 8)
+        self.assertEqual(spooled[-1], ("attachment", b"piped"))
+
+        self.api.call_api.side_effect = APIException("EXCEPTION")
+        with self.assertRaises(ChatException):
+            self.chat.upload("team_one", io.BytesIO(b"data"))
+
+    def test_chat_download_path(self):
+        message = dict_to_ntuple(
+            {
+                "id": 3,
+                "conversation_id": "conv_id",
+                "content": {"type": "attachment"},
+            }
+        )
+        dest = os.path.join(self.temp_dir.name, "out.bin")
+
+        def download(service, query):
+            with open(query["params"]["options"]["output"], "wb") as output:
+                output.write(b"data")
+
+        self.api.call_api.side_effect = download
+        progress = mock.MagicMock()
+        self.chat.download(message, dest, progress=progress)
+        self.api.call_api.assert_called_with(
+            "chat",
+            {
+                "method": "download",
+                "params": {
+                    "options": {
+                        "conversation_id": "conv_id",
+                        "message_id": 3,
+                        "output": dest,
+                    }
+                },
+            },
+        )
+        progress.assert_called_with(4, 4)
+
+    def test_chat_download_stream(self):
+        message = dict_to_ntuple(
+            {
+                "id": 3,
+                "conversation_id": "conv_id",
+                "channel": {
+                    "name": "team_one",
+                    "members_type": "team",
+                    "topic_name": "general",
+                },
+                "content": {
+                    "type": "attachment",
+                    "attachment": {"object": {"size": 100000}},
+                },
+            }
+        )
+        process = mock.MagicMock()
+        process.__enter__.return_value = process
+        process.stdout = io.BytesIO(b"y" * 100000)
+        process.stderr = io.BytesIO(b"")
+        process.returncode = 0
+        self.api.open_process.return_value = process
+        dest = io.BytesIO()
+        progress = mock.MagicMock()
+        self.chat.download(message, dest, progress=progress)
+        self.assertEqual(dest.getvalue(), b"y" * 100000)
+        self.api.open_process.assert_called_with(
+            ["chat", "download", "--channel", "general", "team_one", "3"],
+            stdout=mock.ANY,
+        )
+        progress.assert_called_with(100000, 100000)
+
+        process.stdout = io.BytesIO(b"")
+        process.stderr = io.BytesIO(b"not found")
+        process.returncode = 1
+        with self.assertRaises(ChatException):
+            self.chat.download(message, io.BytesIO())
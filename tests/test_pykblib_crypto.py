@@ -0,0 +1,126 @@
+"""Test the PyKBLib Crypto class."""
+
+import io
+import os
+import subprocess
+import sys
+from unittest import TestCase, mock
+
+from pykblib.crypto import CHUNK_MAGIC, Crypto
+from pykblib.exceptions import APIException, CryptoException
+
+# Stands in for the keybase client, "encrypting" its input by reversing it.
+REVERSE = "import sys; sys.stdout.buffer.write(sys.stdin.buffer.read()[::-1])"
+FAIL = "import sys; sys.stderr.write('bad signature'); sys.exit(1)"
+
+
+def spawner(script):
+    """Build a replacement for `KeybaseAPI.open_process`."""
+
+    def open_process(arguments, stdin=None, stdout=None):
+        return subprocess.Popen(
+            [sys.executable, "-c", script],
+            stdin=stdin,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+        )
+
+    return mock.MagicMock(side_effect=open_process)
+
+
+class CryptoTest(TestCase):
+    def setUp(self):
+        self.keybase = mock.MagicMock()
+        self.crypto = Crypto(self.keybase)
+        self.api = self.keybase._api
+        self.api.open_process = spawner(REVERSE)
+
+    def test_crypto_pipe(self):
+        with self.crypto.encrypt(
+            io.BytesIO(b"secret"), ["user_one"], team="team_one"
+        ) as reader:
+            self.assertEqual(reader.read(2), b"te")
+            self.assertEqual(reader.read(), b"rces")
+        self.api.open_process.assert_called_with(
+            ["encrypt", "--binary", "--team", "team_one", "user_one"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.assertEqual(
+            b"".join(self.crypto.decrypt([b"ter", b"ces"])), b"secret"
+        )
+        self.assertEqual(self.crypto.sign(b"data").read(), b"atad")
+        self.api.open_process.assert_called_with(
+            ["sign", "--binary"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def test_crypto_chunked(self):
+        data = bytes(range(256)) * 40
+        encrypted = self.crypto.encrypt(data, chunk_size=1000, workers=3)
+        framed = encrypted.read()
+        self.assertTrue(framed.startswith(CHUNK_MAGIC))
+        # Every chunk is processed by its own keybase client.
+        self.assertEqual(self.api.open_process.call_count, 11)
+        self.assertNotIn(data[:1000], framed)
+        self.assertIn(data[:1000][::-1], framed)
+        decrypted = self.crypto.decrypt(
+            io.BytesIO(framed), chunked=True, workers=2
+        )
+        self.assertEqual(decrypted.read(), data)
+        with self.assertRaises(CryptoException):
+            self.crypto.decrypt(b"not chunked", chunked=True).read()
+        with self.assertRaises(CryptoException):
+            self.crypto.decrypt(framed[:-10], chunked=True).read()
+        with self.assertRaises(CryptoException):
+            self.crypto.sign(data, detached=True, chunk_size=1000)
+
+    def test_crypto_verify(self):
+        self.assertEqual(self.crypto.verify(b"dengis").read(), b"signed")
+        self.api.open_process.assert_called_with(
+            ["verify"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.assertEqual(
+            self.crypto.verify(b"x", signature=b"sig").read(), b"x"
+        )
+        arguments = self.api.open_process.call_args[0][0]
+        self.assertEqual(arguments[:2], ["verify", "--detached"])
+        # The temporary signature file is removed.
+        self.assertFalse(os.path.exists(arguments[2]))
+        self.api.open_process = spawner(FAIL)
+        with self.assertRaisesRegex(CryptoException, "bad signature"):
+            self.crypto.verify(b"forged").read()
+        self.api.open_process = mock.MagicMock(side_effect=APIException("x"))
+        with self.assertRaises(CryptoException):
+            self.crypto.decrypt(b"data")
+
+    def test_crypto_sign_many(self):
+        messages = (str(index).encode() * 3 for index in range(20))
+        signatures = list(self.crypto.sign_many(messages, workers=4))
+        self.assertEqual(
+            signatures, [str(index).encode()[::-1] * 3 for index in range(20)]
+        )
+        self.assertEqual(self.api.open_process.call_count, 20)
+        self.api.open_process.assert_called_with(
+            ["sign", "--binary"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def test_crypto_verify_many(self):
+        self.api.open_process = spawner(
+            "import sys; data = sys.stdin.buffer.read()\n"
+            "if b'bad' in data: sys.stderr.write('invalid'); sys.exit(1)\n"
+            "sys.stdout.buffer.write(data[::-1])"
+        )
+        results = list(
+            self.crypto.verify_many(
+                [b"eno", b"bad", (b"data", b"sig")], workers=2
+            )
+        )
+        self.assertEqual(
+            [(result.valid, result.message) for result in results],
+            [(True, b"one"), (False, None), (True, b"data")],
+        )
+        self.assertEqual(results[1].error, "keybase verify failed: invalid")
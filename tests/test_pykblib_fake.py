@@ -0,0 +1,175 @@
+"""Test the PyKBLib FakeKeybase class."""
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from unittest import TestCase
+
+from pykblib import Keybase
+from pykblib.api import deadline
+from pykblib.exceptions import (
+    APIException,
+    KeybaseException,
+    TeamException,
+    TimeoutException,
+)
+from pykblib.fake import FakeKeybase, main
+
+
+class FakeKeybaseTest(TestCase):
+    def setUp(self):
+        self.fake = FakeKeybase("test_user", users=["alice", "bob"])
+        self.keybase = Keybase(transport=self.fake)
+
+    def tearDown(self):
+        self.fake.close()
+
+    def test_fake_teams(self):
+        self.assertEqual(self.keybase.username, "test_user")
+        team = self.keybase.create_team("team_one")
+        self.keybase.create_team("team_one.sub")
+        self.assertEqual(team.role, "owner")
+        team.add_members(["alice"], "writer")
+        team.update()
+        self.assertEqual(team.members_by_role.writer, {"alice"})
+        team.change_member_role("alice", "admin")
+        team.update()
+        self.assertEqual(team.members_by_role.admin, {"alice"})
+        with self.assertRaises(TeamException):
+            team.add_members(["nobody"])
+        self.keybase.update_team_list()
+        self.assertEqual(self.keybase.teams, ["team_one", "team_one.sub"])
+        # Teams with sub-teams cannot be deleted directly.
+        with self.assertRaises(APIException):
+            self.fake.delete_team("team_one")
+        self.keybase.delete_team("team_one")
+        self.assertEqual(self.keybase.teams, [])
+
+    def test_fake_statuses(self):
+        team = self.keybase.create_team("team_one")
+        team.add_members(["alice", "bob"])
+        self.fake.add_user("alice", "deleted")
+        self.fake.add_user("bob", "reset")
+        team.update()
+        self.assertEqual(team.members_by_role.deleted, {"alice"})
+        self.assertEqual(team.members_by_role.reset, {"bob"})
+        team.purge_deleted()
+        team.purge_reset()
+        team.update()
+        self.assertEqual(team.members_by_role.owner, {"test_user"})
+        self.assertEqual(team.members_by_role.deleted, set())
+        self.assertEqual(team.members_by_role.reset, set())
+        self.assertFalse(self.keybase.lookup_users(["alice"])["alice"].valid)
+
+    def test_fake_requests(self):
+        self.keybase.create_team("team_one")
+        self.fake.username = "bob"
+        self.fake.run_command("team request-access team_one")
+        with self.assertRaises(APIException):
+            self.fake.run_command("team request-access team_one")
+        self.fake.username = "test_user"
+        self.assertEqual(self.keybase.list_requests(), {"team_one": {"bob"}})
+        self.keybase.ignore_request("team_one", "bob")
+        self.assertEqual(self.keybase.list_requests(), {})
+        users = self.keybase.lookup_users(["alice", "nobody"])
+        self.assertTrue(users["alice"].valid)
+        self.assertFalse(users["nobody"].valid)
+
+    def test_fake_chat(self):
+        self.keybase.create_team("team_one")
+        channel = {"name": "team_one", "members_type": "team"}
+        listener = self.keybase._api.stream_lines("chat api-listen")
+        received = list()
+        thread = threading.Thread(
+            target=lambda: received.extend(listener), daemon=True
+        )
+        thread.start()
+        for number in range(5):
+            self.keybase.chat.send(channel, "message {}".format(number))
+        history = self.keybase.chat.iter_history(channel, page_size=2)
+        self.assertEqual(
+            [message.content.text.body for message in history],
+            ["message {}".format(number) for number in range(4, -1, -1)],
+        )
+        self.fake.close()
+        thread.join(5)
+        self.assertEqual(len(received), 5)
+        self.assertEqual(json.loads(received[0])["msg"]["id"], 1)
+
+    def test_fake_errors_and_latency(self):
+        self.fake.inject_error("team/create-team", times=2)
+        for _ in range(2):
+            with self.assertRaises(KeybaseException):
+                self.keybase.create_team("team_one")
+        self.keybase.create_team("team_one")
+        self.fake.inject_error("status", "offline", times=None)
+        for _ in range(3):
+            with self.assertRaises(APIException):
+                self.fake.run_command("status")
+        self.fake.clear_errors()
+        self.fake.run_command("status")
+        with self.assertRaises(APIException):
+            self.fake.run_command("unknown command")
+
+    def test_fake_deadline(self):
+        self.fake.latency = 0.05
+        with deadline(0.01):
+            with self.assertRaises(TimeoutException):
+                self.keybase.create_team("team_one")
+        with deadline(1):
+            self.keybase.create_team("team_one")
+        self.keybase._api.timeout = 0.01
+        with self.assertRaises(TimeoutException):
+            self.keybase.team("team_one").update()
+
+    def test_fake_executable(self):
+        self.keybase.create_team("team_one")
+        keybase = Keybase(executable=self.fake.executable())
+        self.assertEqual(keybase.teams, ["team_one"])
+        process = keybase._api.open_process(
+            ["encrypt", "--binary"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        encrypted = process.communicate(b"secret")[0]
+        process = keybase._api.open_process(
+            ["decrypt"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.assertEqual(process.communicate(encrypted)[0], b"secret")
+        # The client saves its changes to the state file.
+        keybase.create_team("team_two")
+        saved = FakeKeybase.load(self.fake._state_path)
+        self.assertEqual(
+            sorted(saved._state["teams"]), ["team_one", "team_two"]
+        )
+
+    def test_fake_main(self):
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+        try:
+            self.fake.save(path)
+            self.assertEqual(main(["--state", path, "team", "unknown"]), 1)
+            self.assertEqual(main(["--state", path, "status"]), 0)
+            fake = FakeKeybase.load(path)
+            process = fake.open_process(
+                ["fs", "write", "/keybase/team/team_one/file"],
+                stdin=subprocess.PIPE,
+            )
+            process.communicate(b"contents")
+            process = fake.open_process(
+                ["fs", "read", "--offset", "3", "/keybase/team/team_one/file"],
+                stdout=subprocess.PIPE,
+            )
+            self.assertEqual(process.communicate()[0], b"tents")
+            process = fake.open_process(
+                ["fs", "read", "/keybase/team/team_one/missing"],
+                stdout=subprocess.PIPE,
+            )
+            error = process.communicate()[1]
+            self.assertEqual(process.returncode, 1)
+            self.assertIn(b"ERROR", error)
+            fake.close()
+        finally:
+            os.remove(path)
@@ -0,0 +1,285 @@
+"""Test the PyKBLib KBFS class."""
+
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from pykblib.exceptions import KBFSException
+from pykblib.kbfs import KBFS
+
+
+def fake_process(stdout=b"", stderr=b"", returncode=0):
+    """Build a simulated `keybase fs` process."""
+    process = mock.MagicMock()
+    process.stdin = io.BytesIO()
+    process.stdin.close = mock.MagicMock()
+    process.stdout = io.BytesIO(stdout)
+    process.stderr = io.BytesIO(stderr)
+    process.wait.return_value = returncode
+    return process
+
+
+class KBFSPathTest(TestCase):
+    def test_kbfs_paths(self):
+        team = mock.MagicMock()
+        team.name = "team_one.sub"
+        fs = KBFS(team, mount_root="/mnt/kb")
+        self.assertEqual(
+            fs.kbfs_path("/dir/file.txt"),
+            "/keybase/team/team_one.sub/dir/file.txt",
+        )
+        self.assertEqual(fs.kbfs_path(""), "/keybase/team/team_one.sub")
+        self.assertEqual(
+            fs.local_path("dir/file.txt"),
+            os.path.join("/mnt/kb", "team", "team_one.sub", "dir", "file.txt"),
+        )
+        # Renaming the team is reflected in its paths.
+        team.name = "team_one.renamed"
+        self.assertEqual(fs.kbfs_path("a"), "/keybase/team/team_one.renamed/a")
+
+
+class KBFSMountedTest(TestCase):
+    def setUp(self):
+        self.mount = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.mount.name, "team", "team_one"))
+        self.team = mock.MagicMock()
+        self.team.name = "team_one"
+        self.fs = KBFS(self.team, mount_root=self.mount.name)
+
+    def tearDown(self):
+        self.mount.cleanup()
+
+    def test_kbfs_mounted_io(self):
+        self.assertTrue(self.fs.mounted)
+        self.assertEqual(self.fs.write("file.bin", b"a" * 100), 100)
+        self.fs.write("file.bin", io.BytesIO(b"b" * 50), append=True)
+        self.assertEqual(
+            b"".join(self.fs.read("file.bin", chunk_size=30)),
+            b"a" * 100 + b"b" * 50,
+        )
+        self.assertEqual(
+            [len(chunk) for chunk in self.fs.read("file.bin", chunk_size=60)],
+            [60, 60, 30],
+        )
+        self.fs.write("other.bin", [b"x", b"y"])
+        self.assertEqual(sorted(self.fs.listdir()), ["file.bin", "other.bin"])
+        self.team._api.open_process.assert_not_called()
+        with self.assertRaises(KBFSException):
+            self.fs.open("missing.bin")
+        with self.assertRaises(KBFSException):
+            self.fs.map("missing.bin")
+        with self.assertRaises(KBFSException):
+            list(self.fs.listdir("missing"))
+
+    def test_kbfs_mounted_ranges(self):
+        self.fs.write("file.bin", bytes(range(200)))
+        self.assertEqual(
+            self.fs.read_range("file.bin", 10, 5), bytes(range(10, 15))
+        )
+        self.assertEqual(
+            self.fs.read_range("file.bin", 198, 10), bytes([198, 199])
+        )
+        with self.fs.map("file.bin") as mapping:
+            self.assertEqual(mapping[100:103], bytes([100, 101, 102]))
+        with self.fs.view("file.bin", 50, 4) as view:
+            self.assertIsInstance(view, memoryview)
+            self.assertTrue(view.readonly)
+            self.assertEqual(view.tobytes(), bytes([50, 51, 52, 53]))
+        with self.fs.view("file.bin", 190) as view:
+            self.assertEqual(len(view), 10)
+        self.fs.write("empty.bin", b"")
+        with self.fs.view("empty.bin") as view:
+            self.assertEqual(len(view), 0)
+
+
+class KBFSPipeTest(TestCase):
+    def setUp(self):
+        self.team = mock.MagicMock()
+        self.team.name = "team_one"
+        self.fs = KBFS(self.team, mount_root="/nonexistent/mount")
+        self.api = self.team._api
+
+    def test_kbfs_pipe_read(self):
+        self.assertFalse(self.fs.mounted)
+        self.api.open_process.return_value = fake_process(b"z" * 100)
+        chunks = list(self.fs.read("dir/file.bin", chunk_size=40))
+        self.assertEqual([len(chunk) for chunk in chunks], [40, 40, 20])
+        self.api.open_process.assert_called_with(
+            ["fs", "read", "/keybase/team/team_one/dir/file.bin"],
+            stdin=None,
+            stdout=mock.ANY,
+        )
+        self.api.open_process.return_value = fake_process(
+            stderr=b"file does not exist", returncode=1
+        )
+        with self.assertRaises(KBFSException):
+            list(self.fs.read("missing.bin"))
+
+    def test_kbfs_pipe_read_early_close(self):
+        process = fake_process(b"z" * 100, returncode=-9)
+        self.api.open_process.return_value = process
+        with self.fs.open("file.bin") as source:
+            self.assertEqual(source.read(10), b"z" * 10)
+        process.kill.assert_called()
+
+    def test_kbfs_pipe_read_range(self):
+        process = fake_process(b"r" * 100000)
+        self.api.open_process.return_value = process
+        self.assertEqual(
+            self.fs.read_range("file.bin", 1000, 70000), b"r" * 70000
+        )
+        self.api.open_process.assert_called_with(
+            [
+                "fs",
+                "read",
+                "--offset",
+                "1000",
+                "--size",
+                "70000",
+                "/keybase/team/team_one/file.bin",
+            ],
+            stdin=None,
+            stdout=mock.ANY,
+        )
+        # The keybase client is stopped once enough data has been read.
+        process.kill.assert_called()
+        with self.assertRaises(KBFSException):
+            self.fs.map("file.bin")
+        with self.assertRaises(KBFSException):
+            with self.fs.view("file.bin"):
+                pass
+
+    def test_kbfs_pipe_write(self):
+        process = fake_process()
+        self.api.open_process.side_effect = [process, fake_process()]
+        self.assertEqual(
+            self.fs.write("file.bin", io.BytesIO(b"w" * 100), chunk_size=30),
+            100,
+        )
+        self.assertEqual(process.stdin.getvalue(), b"w" * 100)
+        self.api.open_process.assert_called_with(
+            ["fs", "write", "/keybase/team/team_one/file.bin"],
+            stdin=mock.ANY,
+            stdout=None,
+        )
+        self.fs.write("file.bin", b"more", append=True)
+        self.api.open_process.assert_called_with(
+            ["fs", "write", "--append", "/keybase/team/team_one/file.bin"],
+            stdin=mock.ANY,
+            stdout=None,
+        )
+
+    def test_kbfs_pipe_listdir(self):
+        self.api.open_process.return_value = fake_process(
+            b"file.bin\nsubdir/\n"
+        )
+        self.assertEqual(list(self.fs.listdir()), ["file.bin", "subdir"])
+        self.api.open_process.assert_called_with(
+            ["fs", "ls", "-1", "--nocolor", "/keybase/team/team_one"],
+            stdin=None,
+            stdout=mock.ANY,
+        )
+
+
+class KBFSMirrorTest(TestCase):
+    def setUp(self):
+        self.mount = tempfile.TemporaryDirectory()
+        self.remote = os.path.join(self.mount.name, "team", "team_one")
+        os.makedirs(self.remote)
+        self.local = tempfile.TemporaryDirectory()
+        team = mock.MagicMock()
+        team.name = "team_one"
+        self.fs = KBFS(team, mount_root=self.mount.name)
+
+    def tearDown(self):
+        self.mount.cleanup()
+        self.local.cleanup()
+
+    def write_local(self, relative, data):
+        path = os.path.join(self.local.name, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as target:
+            target.write(data)
+        return path
+
+    def read_remote(self, relative):
+        with open(os.path.join(self.remote, "backup", relative), "rb") as f:
+            return f.read()
+
+    def test_kbfs_mirror(self):
+        self.write_local("a.txt", b"alpha")
+        self.write_local("dir/b.bin", b"b" * 2000)
+        result = self.fs.mirror(
+            self.local.name, "backup", hash_workers=2, hash_threshold=1000
+        )
+        self.assertEqual(result.uploaded, ["a.txt", "dir/b.bin"])
+        self.assertEqual(self.read_remote("dir/b.bin"), b"b" * 2000)
+        # The manifest itself isn't mirrored.
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.remote, "backup"))),
+            ["a.txt", "dir"],
+        )
+
+        # Nothing has changed, so nothing is uploaded.
+        result = self.fs.mirror(self.local.name, "backup")
+        self.assertEqual(result.uploaded, [])
+        self.assertEqual(result.unchanged, ["a.txt", "dir/b.bin"])
+
+        # A touched file is hashed but not uploaded; a changed one is.
+        path = self.write_local("a.txt", b"alpha")
+        os.utime(path, ns=(1, 1))
+        self.write_local("dir/b.bin", b"c" * 2000)
+        self.write_local("new.txt", b"new")
+        with mock.patch(
+            "pykblib.kbfs.KBFS.write", wraps=self.fs.write
+        ) as writer:
+            result = self.fs.mirror(self.local.name, "backup")
+        self.assertEqual(result.uploaded, ["dir/b.bin", "new.txt"])
+        self.assertEqual(result.unchanged, ["a.txt"])
+        self.assertEqual(writer.call_count, 2)
+        self.assertEqual(self.read_remote("dir/b.bin"), b"c" * 2000)
+
+        # Stale remote files are only deleted when requested.
+        os.remove(os.path.join(self.local.name, "new.txt"))
+        result = self.fs.mirror(self.local.name, "backup")
+        self.assertEqual(result.deleted, [])
+        self.assertEqual(self.read_remote("new.txt"), b"new")
+        result = self.fs.mirror(self.local.name, "backup", delete=True)
+        self.assertEqual(result.deleted, ["new.txt"])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.remote, "backup", "new.txt"))
+        )
+
+    def test_kbfs_mirror_failures(self):
+        self.write_local("a.txt", b"alpha")
+        self.write_local("b.txt", b"beta")
+        original_write = self.fs.write
+
+        def write(path, data, **kwargs):
+            if path.endswith("b.txt"):
+                raise KBFSException("Could not write.")
+            return original_write(path, data, **kwargs)
+
+        with mock.patch.object(self.fs, "write", side_effect=write):
+            result = self.fs.mirror(self.local.name)
+        self.assertEqual(result.uploaded, ["a.txt"])
+        self.assertEqual(result.failed, ["b.txt"])
+        # The failed file is retried on the next run.
+        result = self.fs.mirror(self.local.name)
+        self.assertEqual(result.uploaded, ["b.txt"])
+        self.assertEqual(result.unchanged, ["a.txt"])
+
+        # A run that fails partway keeps the files it didn't reach in the
+        # manifest.
+        self.write_local("a.txt", b"changed")
+        os.remove(os.path.join(self.local.name, "b.txt"))
+        with mock.patch.object(
+            self.fs, "makedirs", side_effect=KBFSException("Failed.")
+        ):
+            with self.assertRaises(KBFSException):
+                self.fs.mirror(self.local.name, delete=True)
+        result = self.fs.mirror(self.local.name, delete=True)
+        self.assertEqual(result.uploaded, ["a.txt"])
+        self.assertEqual(result.deleted, ["b.txt"])
+        self.assertFalse(os.path.exists(os.path.join(self.remote, "b.txt")))
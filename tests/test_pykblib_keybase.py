@@ -268,6 +268,26 @@ class KeybaseTest(TestCase):
         )
         self.assertEqual(result, {"team_one.subteam": {"test_user"}})
 
+    def test_keybase_lookup_users(self):
+        def run_command(command):
+            if "nobody" in command:
+                raise APIException("user not found")
+            return "\x1b[1m▶\x1b[0m INFO Identifying \x1b[1malice\x1b[22m\n"
+
+        self.keybase._api.run_command.side_effect = run_command
+        results = self.keybase.lookup_users(
+            ["alice@github", "nobody", "alice@github"]
+        )
+        self.assertEqual(list(results), ["alice@github", "nobody"])
+        self.assertEqual(results["alice@github"].username, "alice")
+        self.assertTrue(results["alice@github"].valid)
+        self.assertFalse(results["nobody"].valid)
+        self.assertEqual(results["nobody"].error, "user not found")
+        self.keybase._api.run_command.assert_any_call("id nobody")
+        # Both results are cached.
+        self.keybase.lookup_users(["nobody", "alice@github"])
+        self.assertEqual(self.keybase._api.run_command.call_count, 2)
+
     def test_keybase_request_access(self):
         # First let's test a failed attempt.
         self.keybase._api.run_command.return_value = "error message"
@@ -0,0 +1,174 @@
+"""Test the PyKBLib KVStore class."""
+
+import threading
+from unittest import TestCase, mock
+
+from steffentools import dict_to_ntuple
+
+from pykblib.exceptions import (
+    APIException,
+    KVConflictException,
+    KVStoreException,
+    TimeoutException,
+)
+from pykblib.kvstore import KVStore
+
+
+class FakeStore:
+    """Simulates the kvstore API for a single team."""
+
+    def __init__(self):
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.methods = list()
+
+    def __call__(self, service, query):
+        options = query["params"]["options"]
+        method = query["method"]
+        with self.lock:
+            self.methods.append(method)
+            if method == "list":
+                return dict_to_ntuple(
+                    {
+                        "result": {
+                            "entryKeys": [
+                                {"entryKey": key, "revision": revision}
+                                for key, (revision, value) in sorted(
+                                    self.entries.items()
+                                )
+                                if value is not None
+                            ]
+                        }
+                    }
+                )
+            key = options["entryKey"]
+            revision, value = self.entries.get(key, (0, None))
+            if method == "get":
+                return dict_to_ntuple(
+                    {"result": {"entryValue": value, "revision": revision}}
+                )
+            if "revision" in options and options["revision"] != revision + 1:
+                raise APIException("revision out of date")
+            if key == "broken":
+                raise APIException("server error")
+            self.entries[key] = (revision + 1, options.get("entryValue"))
+            return dict_to_ntuple({"result": {"revision": revision + 1}})
+
+    def count(self, method):
+        return self.methods.count(method)
+
+
+class KVStoreTest(TestCase):
+    def setUp(self):
+        self.team = mock.MagicMock()
+        self.team.name = "team_one"
+        self.server = FakeStore()
+        self.team._api.call_api.side_effect = self.server
+        self.kv = KVStore(self.team, namespace="bots")
+
+    def test_kvstore_mapping(self):
+        self.kv["greeting"] = "hello"
+        self.team._api.call_api.assert_called_with(
+            "kvstore",
+            {
+                "method": "put",
+                "params": {
+                    "options": {
+                        "entryKey": "greeting",
+                        "entryValue": "hello",
+                        "team": "team_one",
+                        "namespace": "bots",
+                    }
+                },
+            },
+        )
+        self.assertEqual(self.kv["greeting"], "hello")
+        # The value was cached when it was written.
+        self.assertEqual(self.server.count("get"), 0)
+        self.kv["other"] = "value"
+        self.assertEqual(sorted(self.kv), ["greeting", "other"])
+        self.assertEqual(len(self.kv), 2)
+        del self.kv["other"]
+        self.assertNotIn("other", self.kv)
+        with self.assertRaises(KeyError):
+            self.kv["missing"]
+        # Empty values are values.
+        self.server.entries["empty"] = (1, "")
+        self.assertEqual(self.kv["empty"], "")
+        with self.assertRaises(KeyError):
+            del self.kv["missing"]
+
+    def test_kvstore_revisions(self):
+        self.server.entries["config"] = (3, "old")
+        self.assertEqual(self.kv.get("config"), "old")
+        self.assertEqual(self.kv.get("config"), "old")
+        self.assertEqual(self.server.count("get"), 1)
+        # Another writer changes the entry.
+        self.server.entries["config"] = (4, "new")
+        with self.assertRaises(KVConflictException):
+            self.kv["config"] = "mine"
+        self.assertEqual(self.kv.get("config"), "new")
+        self.assertEqual(self.kv.put("config", "mine"), 5)
+        # Refreshing only drops the entries whose revisions changed.
+        self.server.entries["other"] = (1, "x")
+        self.kv.get("other")
+        self.server.entries["config"] = (6, "newer")
+        self.kv.refresh()
+        self.assertEqual(self.kv.get("config"), "newer")
+        self.assertEqual(self.kv.get("other"), "x")
+        self.assertEqual(self.server.count("get"), 4)
+        with self.assertRaises(KVStoreException):
+            self.kv["broken"] = "value"
+
+    def test_kvstore_bulk(self):
+        self.kv.put_many({"key{}".format(index): "v" for index in range(20)})
+        self.assertEqual(self.server.count("put"), 20)
+        self.server.entries["key0"] = (2, "changed")
+        values = self.kv.get_many(["key0", "key1", "missing"], fresh=True)
+        self.assertEqual(values, {"key0": "changed", "key1": "v"})
+        # Only the changed entry and the unknown one were fetched.
+        self.assertEqual(self.server.count("get"), 2)
+        with self.assertRaises(KVConflictException):
+            self.server.entries["key2"] = (5, "changed")
+            self.kv.put_many({"key2": "a", "key3": "b"})
+        self.assertEqual(self.server.entries["key3"], (2, "b"))
+
+    def test_kvstore_write_back(self):
+        kv = KVStore(self.team, write_back=True)
+        with kv:
+            for index in range(10):
+                kv["counter"] = str(index)
+            kv["temporary"] = "value"
+            del kv["temporary"]
+            self.assertEqual(kv["counter"], "9")
+            self.assertNotIn("temporary", kv.keys())
+            self.assertEqual(self.server.count("put"), 0)
+        # Rapid writes to the same key were coalesced.
+        self.assertEqual(self.server.entries["counter"], (1, "9"))
+        self.assertEqual(self.server.count("put"), 1)
+        # Failed writes remain pending so the flush can be retried.
+        kv["broken"] = "value"
+        with self.assertRaises(KVStoreException):
+            kv.flush()
+        self.assertEqual(kv._pending, {"broken": "value"})
+        # So do writes that timed out, or were interrupted.
+        with mock.patch.object(
+            kv, "put", side_effect=TimeoutException("timed out")
+        ):
+            with self.assertRaises(TimeoutException):
+                kv.flush()
+        self.assertEqual(kv._pending, {"broken": "value"})
+        with mock.patch.object(
+            kv, "_write_many", side_effect=KeyboardInterrupt
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                kv.flush()
+        self.assertEqual(kv._pending, {"broken": "value"})
+
+    def test_kvstore_flush_delay(self):
+        kv = KVStore(self.team, write_back=True, flush_delay=0.05)
+        kv["key"] = "value"
+        timer = kv._timer
+        timer.join(5)
+        self.assertEqual(self.server.entries["key"], (1, "value"))
+        self.assertIsNone(kv._timer)
@@ -0,0 +1,184 @@
+"""Test the PyKBLib rate and concurrency limiters."""
+
+import threading
+import time
+from unittest import TestCase, mock
+
+from pykblib.exceptions import APIException
+from pykblib.limits import (
+    BULK,
+    INTERACTIVE,
+    AIMDLimiter,
+    PriorityLanes,
+    Scheduler,
+    TokenBucket,
+)
+
+
+class TokenBucketTest(TestCase):
+    @mock.patch("pykblib.limits.time")
+    def test_token_bucket(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        bucket = TokenBucket(2, capacity=2)
+        # The bucket starts full.
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        # Tokens are refilled at the specified rate.
+        mock_time.monotonic.return_value = 100.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        # But never beyond the bucket's capacity.
+        mock_time.monotonic.return_value = 200.0
+        self.assertTrue(bucket.try_acquire(2))
+        self.assertFalse(bucket.try_acquire())
+
+    @mock.patch("pykblib.limits.time")
+    def test_token_bucket_acquire(self, mock_time):
+        clock = [0.0]
+        mock_time.monotonic.side_effect = lambda: clock[0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        mock_time.sleep.side_effect = sleep
+        bucket = TokenBucket(4, capacity=1)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        mock_time.sleep.assert_called_with(0.25)
+        self.assertFalse(bucket.acquire(timeout=0.1))
+
+
+class AIMDLimiterTest(TestCase):
+    def test_aimd_limiter(self):
+        limiter = AIMDLimiter(initial=2, maximum=4)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(timeout=0))
+        # Each success widens the limit by a fraction of a slot.
+        limiter.release(time.monotonic())
+        self.assertEqual(limiter.limit, 2.5)
+        limiter.release(time.monotonic())
+        self.assertEqual(limiter.limit, 2.9)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(time.monotonic())
+        self.assertEqual(limiter.limit, 4)
+        # Throttling halves the limit, but only once for the calls that were
+        # already running when it happened.
+        started = time.monotonic()
+        limiter.release(started, throttled=True)
+        limiter.release(started, throttled=True)
+        self.assertEqual(limiter.limit, 2)
+        limiter.release(time.monotonic(), throttled=True)
+        self.assertEqual(limiter.limit, 1)
+        # Other failures leave the limit unchanged.
+        limiter.release(time.monotonic(), failed=True)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_aimd_limiter_latency(self):
+        limiter = AIMDLimiter(initial=8, latency_target=0.5)
+        limiter.acquire()
+        limiter.release(time.monotonic() - 1)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_aimd_limiter_wait(self):
+        limiter = AIMDLimiter(initial=1)
+        limiter.acquire()
+        started = time.monotonic()
+        threading.Timer(0.05, limiter.release, [started]).start()
+        self.assertTrue(limiter.acquire(timeout=5))
+
+
+class PriorityLanesTest(TestCase):
+    def test_priority_lanes(self):
+        lanes = PriorityLanes(3, reserved={INTERACTIVE: 1})
+        # Bulk calls can't use the slot reserved for interactive calls.
+        self.assertTrue(lanes.acquire(BULK))
+        self.assertTrue(lanes.acquire(BULK))
+        self.assertFalse(lanes.acquire(BULK, timeout=0))
+        self.assertTrue(lanes.acquire(INTERACTIVE))
+        self.assertFalse(lanes.acquire(INTERACTIVE, timeout=0))
+        # Queued interactive calls start before queued bulk calls.
+        started = list()
+
+        def call(lane):
+            lanes.acquire(lane)
+            started.append(lane)
+
+        threads = [threading.Thread(target=call, args=[BULK])]
+        threads[0].start()
+        while not lanes.snapshot()[BULK]["queued"]:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=call, args=[INTERACTIVE]))
+        threads[1].start()
+        while not lanes.snapshot()[INTERACTIVE]["queued"]:
+            time.sleep(0.001)
+        lanes.release(BULK)
+        threads[1].join()
+        self.assertEqual(started, [INTERACTIVE])
+        lanes.release(INTERACTIVE)
+        threads[0].join()
+        self.assertEqual(started, [INTERACTIVE, BULK])
+        snapshot = lanes.snapshot()
+        self.assertEqual(snapshot[BULK]["active"], 2)
+        self.assertEqual(snapshot[BULK]["queued"], 0)
+        self.assertEqual(snapshot[BULK]["max_queued"], 1)
+        self.assertEqual(snapshot[INTERACTIVE]["wait"]["count"], 2)
+        with self.assertRaises(ValueError):
+            lanes.acquire("unknown")
+
+
+class SchedulerTest(TestCase):
+    def test_scheduler(self):
+        scheduler = Scheduler(rates={"team-write": None})
+        self.assertEqual(
+            scheduler.classify("team", "add-members"), "team-write"
+        )
+        self.assertIsNone(scheduler.classify("team", "list-team-memberships"))
+        limiter = scheduler.limiters["team-write"]
+        limit = limiter.limit
+        with scheduler.slot("team", "add-members") as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(limiter.active, 1)
+            # Nested calls aren't scheduled again.
+            with scheduler.slot("team", "add-members"):
+                self.assertEqual(limiter.active, 1)
+        self.assertEqual(limiter.active, 0)
+        self.assertGreater(limiter.limit, limit)
+        limit = limiter.limit
+        with self.assertRaises(APIException):
+            with scheduler.slot("team", "remove-member"):
+                raise APIException("Too many requests, try again later.")
+        self.assertEqual(limiter.limit, limit / 2)
+        self.assertEqual(
+            scheduler.snapshot(),
+            {
+                "team-write": {
+                    "limit": int(limit / 2),
+                    "active": 0,
+                    "rate": None,
+                }
+            },
+        )
+
+    def test_scheduler_timeout(self):
+        scheduler = Scheduler(rates={"team-write": 1})
+        scheduler.buckets["team-write"].try_acquire()
+        with scheduler.slot("team", "add-members", timeout=0) as acquired:
+            self.assertFalse(acquired)
+        # Unscheduled calls never wait.
+        with scheduler.slot("chat", "send", timeout=0) as acquired:
+            self.assertTrue(acquired)
+
+    def test_scheduler_lanes(self):
+        scheduler = Scheduler(capacity=2)
+        self.assertEqual(scheduler.lanes.reserved, {INTERACTIVE: 1})
+        # With a capacity, every call is scheduled.
+        with scheduler.slot("chat", "send", lane=BULK) as acquired:
+            self.assertTrue(acquired)
+            with scheduler.slot("chat", "read") as acquired:
+                # Nested calls are still not scheduled again.
+                self.assertTrue(acquired)
+            self.assertEqual(scheduler.lanes.snapshot()[BULK]["active"], 1)
+        self.assertEqual(scheduler.lanes.snapshot()[BULK]["active"], 0)
@@ -0,0 +1,175 @@
+"""Test the PyKBLib instrumentation hooks and MetricsCollector class."""
+
+import io
+import json
+from unittest import TestCase, mock
+
+import pexpect
+
+from pykblib import Keybase
+from pykblib.api import KeybaseAPI
+from pykblib.exceptions import APIException
+from pykblib.fake import FakeKeybase
+from pykblib.metrics import CallHooks, CallInfo, MetricsCollector
+
+
+def call_info(method="send", duration=0.02, error=None, **kwargs):
+    """Build a CallInfo namedtuple with sensible defaults."""
+    values = {
+        "service": "chat",
+        "method": method,
+        "duration": duration,
+        "bytes_out": 10,
+        "bytes_in": 100,
+        "spawns": 1,
+        "spawn_time": None,
+        "parse_time": 0.001,
+        "error": error,
+    }
+    values.update(kwargs)
+    return CallInfo(**values)
+
+
+class CallHooksTest(TestCase):
+    def setUp(self):
+        self.fake = FakeKeybase("test_user")
+        self.api = KeybaseAPI(self.fake)
+        self.pre = mock.MagicMock()
+        self.calls = list()
+        self.api.add_hook(pre=self.pre, post=self.calls.append)
+
+    def test_hooks_call_api(self):
+        self.api.call_api("team", {"method": "list-self-memberships"})
+        self.pre.assert_called_once_with("team", "list-self-memberships")
+        # The command run by call_api is measured as part of the query.
+        self.assertEqual(len(self.calls), 1)
+        call = self.calls[0]
+        self.assertEqual(call.service, "team")
+        self.assertEqual(call.method, "list-self-memberships")
+        self.assertEqual(call.bytes_out, 35)
+        self.assertGreater(call.bytes_in, 0)
+        self.assertGreater(call.duration, call.parse_time)
+        self.assertIsNone(call.error)
+
+        self.fake.inject_error("team/list-self-memberships", "failed")
+        with self.assertRaises(APIException):
+            self.api.call_api("team", {"method": "list-self-memberships"})
+        self.assertEqual(self.calls[1].error, "failed")
+        self.assertIsNone(self.calls[1].parse_time)
+
+    def test_hooks_commands(self):
+        self.api.run_command("team list-requests -t team_one")
+        self.assertEqual(self.calls[0][:2], ("team", "list-requests"))
+        self.api.run_command("id test_user")
+        self.assertEqual(self.calls[1][:2], ("id", "id"))
+        lines = list(self.api.stream_lines("status"))
+        self.assertEqual(self.calls[2][:2], ("status", "status"))
+        self.assertEqual(self.calls[2].bytes_in, sum(map(len, lines)) + 2)
+
+        # Hooks that fail are logged, and don't interrupt the call.
+        self.api.add_hook(post=mock.MagicMock(side_effect=ValueError))
+        with self.assertLogs("pykblib.metrics"):
+            self.api.run_command("status")
+        self.assertEqual(len(self.calls), 4)
+
+        self.api.remove_hook(self.pre)
+        self.api.run_command("status")
+        self.assertEqual(self.pre.call_count, 4)
+
+    @mock.patch("pykblib.api.pexpect.run")
+    def test_hooks_spawns(self, mock_run):
+        api = KeybaseAPI(hooks=self.api.hooks)
+        mock_run.return_value = b'{"result": {}}'
+        api.call_api("team", {"method": "list-self-memberships"})
+        self.assertEqual(self.calls[0].spawns, 1)
+        self.assertEqual(self.calls[0].bytes_in, 14)
+        with mock.patch("pykblib.api.subprocess.Popen"):
+            api.open_process(["fs", "read", "/keybase/team/x"])
+        self.assertEqual(self.calls[1][:2], ("fs", "read"))
+        self.assertIsNotNone(self.calls[1].spawn_time)
+        with mock.patch("pykblib.api.pexpect.spawn") as mock_spawn:
+            mock_spawn.return_value.expect.side_effect = (
+                pexpect.exceptions.EOF("EOF")
+            )
+            with self.assertRaises(APIException):
+                api.delete_team("team_one")
+        self.assertEqual(self.calls[2][:2], ("team", "delete"))
+        self.assertEqual(
+            self.calls[2].error, "Failed to delete team team_one."
+        )
+
+    def test_hooks_shared_by_teams(self):
+        collector = MetricsCollector()
+        hooks = CallHooks()
+        hooks.add(post=collector)
+        keybase = Keybase(transport=self.fake, hooks=hooks)
+        keybase.create_team("team_one").update()
+        self.assertEqual(
+            sorted(collector.snapshot()),
+            [
+                "status/status",
+                "team/create-team",
+                "team/list-team-memberships",
+                "team/list-user-memberships",
+            ],
+        )
+        self.assertEqual(
+            collector.snapshot()["team/list-team-memberships"]["calls"], 2
+        )
+
+    def test_hooks_empty(self):
+        hooks = CallHooks()
+        self.assertFalse(hooks)
+        api = KeybaseAPI(self.fake, hooks=hooks)
+        api.run_command("status")
+        self.assertIsNone(hooks.current())
+        self.assertEqual(self.calls, [])
+
+
+class MetricsCollectorTest(TestCase):
+    def setUp(self):
+        self.collector = MetricsCollector(buckets=(0.01, 0.1))
+        self.collector(call_info(duration=0.005))
+        self.collector(call_info(duration=0.05, error="failed"))
+        self.collector(call_info(duration=1, spawns=0, bytes_in=None))
+        self.collector(call_info(method="read", duration=0.01))
+
+    def test_metrics_snapshot(self):
+        snapshot = self.collector.snapshot()
+        send = snapshot["chat/send"]
+        self.assertEqual(send["calls"], 3)
+        self.assertEqual(send["errors"], 1)
+        self.assertEqual(send["spawns"], 2)
+        self.assertEqual(send["bytes_out"], 30)
+        self.assertEqual(send["bytes_in"], 200)
+        self.assertEqual(
+            send["duration"]["buckets"], [[0.01, 1], [0.1, 2], ["+Inf", 3]]
+        )
+        self.assertEqual(send["duration"]["sum"], 1.055)
+        self.assertEqual(send["spawn_time"]["count"], 0)
+        self.assertEqual(
+            snapshot["chat/read"]["duration"]["buckets"][0], [0.01, 1]
+        )
+        self.collector.reset()
+        self.assertEqual(self.collector.snapshot(), {})
+
+    def test_metrics_dump(self):
+        output = io.StringIO()
+        self.collector.dump(output)
+        self.assertEqual(
+            json.loads(output.getvalue())["chat/send"]["calls"], 3
+        )
+        text = self.collector.prometheus()
+        self.assertIn("# TYPE pykblib_calls_total counter", text)
+        self.assertIn(
+            'pykblib_calls_total{service="chat",method="send"} 3', text
+        )
+        self.assertIn(
+            'pykblib_duration_seconds_bucket{service="chat",method="send",'
+            'le="+Inf"} 3',
+            text,
+        )
+        self.assertIn(
+            'pykblib_duration_seconds_count{service="chat",method="read"} 1',
+            text,
+        )
@@ -0,0 +1,66 @@
+"""Test the PyKBLib retry policy and circuit breaker."""
+
+from unittest import TestCase, mock
+
+from pykblib.retry import CircuitBreaker, RetryPolicy, is_transient
+
+
+class RetryPolicyTest(TestCase):
+    def test_is_transient(self):
+        self.assertTrue(
+            is_transient("dial unix keybased.sock: connection refused")
+        )
+        self.assertTrue(is_transient("Could not start keybase: No such file"))
+        self.assertFalse(is_transient('Team "cancel" does not exist'))
+        self.assertFalse(is_transient(None))
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(attempts=3)
+        refused = "connection refused"
+        self.assertTrue(policy.should_retry("status", "status", refused, 1))
+        self.assertTrue(policy.should_retry("status", "status", refused, 2))
+        self.assertFalse(policy.should_retry("status", "status", refused, 3))
+        # Writes are only retried once they're marked as safe.
+        self.assertFalse(
+            policy.should_retry("team", "add-members", refused, 1)
+        )
+        policy.mark_safe("team", "add-members")
+        self.assertTrue(policy.should_retry("team", "add-members", refused, 1))
+        # Errors from Keybase itself are never retried.
+        self.assertFalse(policy.should_retry("status", "status", "denied", 1))
+
+    @mock.patch("pykblib.retry.random.uniform")
+    def test_retry_policy_delay(self, mock_uniform):
+        mock_uniform.side_effect = lambda low, high: high
+        policy = RetryPolicy(base=0.5, cap=3)
+        self.assertEqual(
+            [policy.delay(attempt) for attempt in range(1, 6)],
+            [0.5, 1, 2, 3, 3],
+        )
+
+
+class CircuitBreakerTest(TestCase):
+    @mock.patch("pykblib.retry.time")
+    def test_circuit_breaker(self, mock_time):
+        mock_time.monotonic.return_value = 100.0
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        # After the reset timeout, a single trial call is let through.
+        mock_time.monotonic.return_value = 110.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        mock_time.monotonic.return_value = 120.0
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
@@ -0,0 +1,266 @@
+"""Test the PyKBLib Sidecar and SidecarTransport classes."""
+
+import json
+import os
+import shlex
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from pykblib import Keybase
+from pykblib.api import KeybaseAPI, deadline
+from pykblib.exceptions import (
+    APIException,
+    SidecarException,
+    TeamException,
+    TimeoutException,
+)
+from pykblib.fake import FakeKeybase
+from pykblib.sidecar import Sidecar, SidecarTransport, default_socket_path
+
+
+class SidecarTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "pykblib.sock")
+        self.fake = FakeKeybase("test_user", users=["alice", "bob"])
+        self.sidecar = Sidecar(self.path, self.fake, workers=4)
+        self.sidecar.start()
+        self.transport = SidecarTransport(self.path, fallback=self.fake)
+        self.keybase = Keybase(transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.sidecar.stop()
+        self.fake.close()
+        shutil.rmtree(self.directory)
+
+    def test_sidecar_calls(self):
+        self.assertEqual(self.keybase.username, "test_user")
+        team = self.keybase.create_team("team_one")
+        team.add_members(["alice"], "writer")
+        self.assertEqual(
+            self.fake._state["teams"]["team_one"]["members"],
+            {"test_user": "owner", "alice": "writer"},
+        )
+        # Errors are passed on to the client.
+        with self.assertRaises(TeamException):
+            team.add_members(["nobody"])
+        with self.assertRaises(APIException):
+            self.transport.run_command("unknown command")
+        self.keybase.delete_team("team_one")
+        self.assertNotIn("team_one", self.fake._state["teams"])
+        # Streams and processes work as they do without the sidecar.
+        self.assertEqual(
+            list(self.transport.stream_lines("status"))[0],
+            self.fake.run_command("status").splitlines()[0],
+        )
+        self.assertGreaterEqual(self.transport.stats()["errors"], 1)
+
+    def test_sidecar_cache(self):
+        self.keybase.create_team("team_one")
+        clients = [
+            Keybase(transport=SidecarTransport(self.path)) for _ in range(3)
+        ]
+        for keybase in clients:
+            keybase.team("team_one").update()
+        stats = self.transport.stats()
+        self.assertGreaterEqual(stats["cache_hits"], 2)
+        # Changes to a team make the cached team data stale.
+        self.keybase.team("team_one").add_members(["alice"])
+        team = clients[0].team("team_one")
+        team.update()
+        self.assertIn("alice", team.members())
+        for keybase in clients:
+            keybase._api.transport.close()
+
+    def test_sidecar_uncached_status(self):
+        self.transport.run_command("status")
+        self.fake.username = "other_user"
+        # Logging in as someone else is noticed at once.
+        self.assertIn("other_user", self.transport.run_command("status"))
+
+    def test_sidecar_unexpected_errors(self):
+        with mock.patch.object(
+            self.fake, "run_command", side_effect=RuntimeError("broken")
+        ):
+            with self.assertRaises(APIException):
+                self.transport.run_command("id alice")
+        with mock.patch.object(
+            self.fake, "stream_lines", side_effect=RuntimeError("broken")
+        ):
+            with self.assertRaises(APIException):
+                list(self.transport.stream_lines("chat api-listen"))
+        # The connection is still usable.
+        self.assertIn("test_user", self.transport.run_command("status"))
+
+    def test_sidecar_deadline(self):
+        self.fake.latency = 0.2
+        with deadline(0.05):
+            with self.assertRaises(TimeoutException):
+                self.transport.run_command("id alice")
+
+    def test_sidecar_socket(self):
+        # A second sidecar can't serve on the same socket.
+        with self.assertRaises(SidecarException):
+            Sidecar(self.path, self.fake).start()
+        self.sidecar.stop()
+        self.assertFalse(os.path.exists(self.path))
+        self.transport.close()
+        with self.assertRaises(APIException):
+            self.transport.run_command("status")
+        # A socket left behind by a dead sidecar is replaced.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.sidecar = Sidecar(self.path, self.fake)
+        self.sidecar.start()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertIn("test_user", self.transport.run_command("status"))
+
+    def test_sidecar_permissions(self):
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": ""}):
+            path = default_socket_path()
+        self.assertEqual(
+            os.path.basename(os.path.dirname(path)),
+            "pykblib-{}".format(os.getuid()),
+        )
+        # Sockets in directories that others can write to are refused.
+        shared = os.path.join(self.directory, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        with self.assertRaises(SidecarException):
+            Sidecar(os.path.join(shared, "pykblib.sock"), self.fake).start()
+        # So are paths that aren't sockets.
+        other = os.path.join(self.directory, "other")
+        open(other, "w").close()
+        with self.assertRaises(SidecarException):
+            Sidecar(other, self.fake).start()
+        self.assertTrue(os.path.exists(other))
+        # Neither end trusts a connection from another user.
+        other_uid = os.getuid() + 1
+        with mock.patch("pykblib.sidecar._peer_uid", return_value=other_uid):
+            self.transport.close()
+            with self.assertRaises(SidecarException):
+                self.transport.run_command("status")
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.assertFalse(
+                self.sidecar._server.verify_request(connection, None)
+            )
+            connection.close()
+        self.assertIn("test_user", self.transport.run_command("status"))
+
+    def test_sidecar_concurrency(self):
+        self.keybase.create_team("team_one")
+        self.fake.latency = 0.05
+        results = list()
+
+        def update():
+            transport = SidecarTransport(self.path)
+            api = KeybaseAPI(transport)
+            query = {
+                "method": "list-team-memberships",
+                "params": {"options": {"team": "team_one"}},
+            }
+            results.append(api.call_api("team", query))
+            transport.close()
+
+        self.sidecar._cache.clear()
+        before = self.transport.stats()
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result == results[0] for result in results))
+        stats = {
+            name: count - before[name]
+            for name, count in self.transport.stats().items()
+        }
+        self.assertEqual(stats["cache_misses"], 1)
+        self.assertEqual(stats["coalesced"] + stats["cache_hits"], 3)
+
+    def test_sidecar_stale_reads(self):
+        def command(method):
+            return "team api -m {}".format(
+                shlex.quote(json.dumps({"method": method}))
+            )
+
+        entered, release = threading.Event(), threading.Event()
+        outputs = ["old", "new"]
+
+        def run_command(command):
+            if "add-members" in command:
+                return "{}"
+            output = outputs.pop(0)
+            if output == "old":
+                entered.set()
+                release.wait(5)
+            return output
+
+        backend = FakeKeybase("test_user")
+        backend.run_command = run_command
+        sidecar = Sidecar(self.path + ".2", backend)
+        read = {"op": "run", "command": command("list-team-memberships")}
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(sidecar.handle(dict(read)))
+        )
+        thread.start()
+        entered.wait(5)
+        # A team changes while the read is running.
+        sidecar.handle({"op": "run", "command": command("add-members")})
+        # Later reads don't join the earlier one.
+        self.assertEqual(sidecar.handle(dict(read)), {"output": "new"})
+        release.set()
+        thread.join()
+        self.assertEqual(results, [{"output": "old"}])
+        # Nor is its result cached.
+        self.assertEqual(sidecar.handle(dict(read)), {"output": "new"})
+        backend.close()
+
+    def test_sidecar_persistent_clients(self):
+        def command(method, **options):
+            query = {"method": method, "params": {"options": options}}
+            return "team api -m {}".format(shlex.quote(json.dumps(query)))
+
+        backend = KeybaseAPI(executable=self.fake.executable())
+        sidecar = Sidecar(self.path + ".2", backend, workers=1, cache_ttl=0)
+        self.assertTrue(sidecar.persistent)
+        with mock.patch.object(
+            backend, "open_process", wraps=backend.open_process
+        ) as open_process:
+            sidecar.handle(
+                {"op": "run", "command": command("create-team", team="t")}
+            )
+            response = sidecar.handle(
+                {
+                    "op": "run",
+                    "command": command("list-team-memberships", team="t"),
+                }
+            )
+            error = sidecar.handle(
+                {"op": "run", "command": command("unknown-method")}
+            )
+        # Every query was answered by the same client.
+        self.assertEqual(open_process.call_count, 1)
+        result = json.loads(response["output"])["result"]
+        self.assertEqual(
+            result["members"]["owners"][0]["username"], "test_user"
+        )
+        self.assertIn("error", json.loads(error["output"]))
+        client = sidecar._processes["team"][0]
+        sidecar.stop()
+        self.assertFalse(client.alive)
+
+        # A client that times out is killed, and isn't reused.
+        self.fake.latency = 0.5
+        backend = KeybaseAPI(executable=self.fake.executable())
+        sidecar = Sidecar(self.path + ".3", backend, workers=1)
+        with self.assertRaises(TimeoutException):
+            sidecar._query("team", '{"method":"list-self-memberships"}', 0.1)
+        self.assertEqual(sidecar._processes["team"], [])
+        sidecar.stop()
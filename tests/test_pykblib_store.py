@@ -0,0 +1,93 @@
+"""Test the PyKBLib MessageStore class."""
+
+from unittest import TestCase
+
+from steffentools import dict_to_ntuple
+
+from pykblib.exceptions import StoreException
+from pykblib.store import MessageStore
+
+
+def chat_message(message_id, body, sender="test_user", topic="general"):
+    """Build a simulated chat message."""
+    return dict_to_ntuple(
+        {
+            "id": message_id,
+            "conversation_id": "conv_{}".format(topic),
+            "channel": {
+                "name": "team_one",
+                "members_type": "team",
+                "topic_name": topic,
+            },
+            "sender": {"username": sender},
+            "sent_at": 1000 + message_id,
+            "content": {"type": "text", "text": {"body": body}},
+        }
+    )
+
+
+class MessageStoreTest(TestCase):
+    def setUp(self):
+        self.store = MessageStore()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_store_add(self):
+        messages = [
+            chat_message(1, "hello world"),
+            chat_message(2, "goodbye world", sender="other_user"),
+        ]
+        self.assertEqual(self.store.add(messages), 2)
+        # Messages that are already stored are ignored.
+        self.assertEqual(self.store.add(messages), 0)
+        # Non-text messages are not stored.
+        reaction = dict_to_ntuple(
+            {
+                "id": 3,
+                "conversation_id": "conv_general",
+                "channel": {"name": "team_one"},
+                "sender": {"username": "test_user"},
+                "sent_at": 1003,
+                "content": {"type": "reaction"},
+            }
+        )
+        self.assertEqual(self.store.add([reaction]), 0)
+
+    def test_store_search(self):
+        self.store.add(
+            [
+                chat_message(1, "deploy the release"),
+                chat_message(2, "release notes", sender="other_user"),
+                chat_message(3, "unrelated", topic="random"),
+                chat_message(4, "release day", topic="random"),
+            ]
+        )
+        results = self.store.search(text="release")
+        self.assertEqual([result.message_id for result in results], [4, 2, 1])
+        results = self.store.search(text="release", sender="other_user")
+        self.assertEqual(
+            [result.body for result in results], ["release notes"]
+        )
+        results = self.store.search(channel="team_one#random")
+        self.assertEqual([result.message_id for result in results], [4, 3])
+        results = self.store.search(since=1002, until=1003)
+        self.assertEqual([result.message_id for result in results], [3, 2])
+        self.assertEqual(len(self.store.search(limit=1)), 1)
+        with self.assertRaises(StoreException):
+            self.store.search(text='"unbalanced')
+
+    def test_store_high_water(self):
+        self.assertEqual(self.store.high_water("conv_general"), 0)
+        # Without an existing mark, unsynced messages don't create one.
+        self.store.add([chat_message(5, "five")])
+        self.assertEqual(self.store.high_water("conv_general"), 0)
+        self.store.mark_synced("conv_general", 5)
+        self.assertEqual(self.store.high_water("conv_general"), 5)
+        # Contiguous messages advance the mark, but gaps stop it.
+        self.store.add([chat_message(7, "seven"), chat_message(6, "six")])
+        self.assertEqual(self.store.high_water("conv_general"), 7)
+        self.store.add([chat_message(9, "nine")])
+        self.assertEqual(self.store.high_water("conv_general"), 7)
+        self.store.add([chat_message(10, "ten")], synced=True)
+        self.assertEqual(self.store.high_water("conv_general"), 10)
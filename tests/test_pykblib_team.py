@@ -180,6 +180,30 @@ class TeamTest(TestCase):
         self.assertFalse(any([name not in roles[role] for name in usernames]))
         self.team._api.call_api.assert_called_with("team", query)
 
+    def test_team_add_members_check(self):
+        self.team._keybase.lookup_users.return_value = {
+            "valid_one": mock.MagicMock(valid=True),
+            "invalid": mock.MagicMock(valid=False),
+            "valid_two": mock.MagicMock(valid=True),
+        }
+        invalid = self.team.add_members(
+            ["valid_one", "invalid", "valid_two"], check=True
+        )
+        self.assertEqual(invalid, ["invalid"])
+        usernames = self.team._api.call_api.call_args[0][1]["params"][
+            "options"
+        ]["usernames"]
+        self.assertEqual(
+            [entry["username"] for entry in usernames],
+            ["valid_one", "valid_two"],
+        )
+        # Nothing is added if none of the users are valid.
+        self.team._api.call_api.reset_mock()
+        self.assertEqual(
+            self.team.add_members(["invalid"], check=True), ["invalid"]
+        )
+        self.team._api.call_api.assert_not_called()
+
     def test_team_change_member_role(self):
         # Create a random user and add them to a random role.
         old_role = random_role()
@@ -334,6 +358,32 @@ class TeamTest(TestCase):
             self.team.purge_reset()
         mock_remove_member.assert_called_with(username)
 
+    def test_team_purge_many(self):
+        # Team.remove_member removes each user from the set being purged.
+        member_dict = self.team.members_by_role._asdict()
+        member_dict["deleted"] = {"deleted_one", "deleted_two"}
+        member_dict["reset"] = {"reset_one", "reset_two", "reset_three"}
+        self.team.members_by_role = dict_to_ntuple(member_dict)
+        self.team._api.call_api.side_effect = None
+        self.team.purge_deleted()
+        self.team.purge_reset()
+        self.assertEqual(self.team.members_by_role.deleted, set())
+        self.assertEqual(self.team.members_by_role.reset, set())
+        removed = {
+            call[0][1]["params"]["options"]["username"]
+            for call in self.team._api.call_api.call_args_list
+        }
+        self.assertEqual(
+            removed,
+            {
+                "deleted_one",
+                "deleted_two",
+                "reset_one",
+                "reset_two",
+                "reset_three",
+            },
+        )
+
     def test_team_remove_member(self):
         # Test a failure first.
         self.team._api.call_api.side_effect = APIException("ANY ERROR")
@@ -0,0 +1,167 @@
+"""Test the PyKBLib Wallet class."""
+
+from unittest import TestCase, mock
+
+from steffentools import dict_to_ntuple
+
+from pykblib.exceptions import (
+    APIException,
+    TimeoutException,
+    WalletException,
+)
+from pykblib.wallet import PaymentResult, Wallet
+
+
+def balances_response(amount):
+    """Build a simulated response to the balances method."""
+    return dict_to_ntuple(
+        {
+            "result": [
+                {
+                    "accountID": "GACCOUNT",
+                    "isPrimary": True,
+                    "balance": [
+                        {"amount": amount, "asset": {"type": "native"}}
+                    ],
+                }
+            ]
+        }
+    )
+
+
+class WalletTest(TestCase):
+    def setUp(self):
+        self.keybase = mock.MagicMock()
+        self.api = self.keybase._api
+        self.wallet = Wallet(self.keybase)
+
+    def test_wallet_balances(self):
+        self.api.call_api.return_value = balances_response("10.0")
+        self.assertEqual(self.wallet.balances()[0].balance[0].amount, "10.0")
+        self.api.call_api.assert_called_with("wallet", {"method": "balances"})
+        self.api.call_api.return_value = balances_response("9.0")
+        # The balances are cached until a payment is sent.
+        self.assertEqual(self.wallet.balances()[0].balance[0].amount, "10.0")
+        self.assertEqual(
+            self.wallet.balances(fresh=True)[0].balance[0].amount, "9.0"
+        )
+        self.api.call_api.return_value = balances_response("8.0")
+        self.wallet.balances()
+        self.assertEqual(self.api.call_api.call_count, 2)
+        self.api.call_api.return_value = dict_to_ntuple(
+            {"result": {"txID": "tx_one"}}
+        )
+        self.assertEqual(self.wallet.send("user_one", 1, "USD"), "tx_one")
+        self.api.call_api.assert_called_with(
+            "wallet",
+            {
+                "method": "send",
+                "params": {
+                    "options": {
+                        "recipient": "user_one",
+                        "amount": "1",
+                        "currency": "USD",
+                    }
+                },
+            },
+        )
+        self.api.call_api.return_value = balances_response("8.0")
+        self.assertEqual(self.wallet.balances()[0].balance[0].amount, "8.0")
+        self.api.call_api.side_effect = APIException("No wallet.")
+        with self.assertRaises(WalletException):
+            self.wallet.balances(fresh=True)
+        with self.assertRaises(WalletException):
+            self.wallet.send("user_one", 1)
+
+    def test_wallet_batch(self):
+        def call_api(service, query):
+            payments = query["params"]["options"]["payments"]
+            if payments[0]["recipient"] == "user_4":
+                raise APIException("Batch rejected.")
+            if payments[0]["recipient"] == "user_6":
+                raise TimeoutException("Timed out.")
+            return dict_to_ntuple(
+                {
+                    "result": {
+                        "payments": [
+                            (
+                                {
+                                    "txID": "tx_" + payment["recipient"],
+                                    "status": "success",
+                                    "errMsg": "",
+                                }
+                                if payment["recipient"] != "user_1"
+                                else {
+                                    "status": "error",
+                                    "errMsg": "No account.",
+                                }
+                            )
+                            for payment in payments
+                        ]
+                    }
+                }
+            )
+
+        self.wallet._balances[None] = (None, ["cached"])
+        self.api.call_api.side_effect = call_api
+        payments = [
+            {"recipient": "user_{}".format(index), "amount": 1}
+            for index in range(8)
+        ]
+        results = self.wallet.batch(payments, chunk_size=2, batch_id="payout")
+        self.assertEqual(self.api.call_api.call_count, 4)
+        batch_ids = sorted(
+            call[0][1]["params"]["options"]["batch_id"]
+            for call in self.api.call_api.call_args_list
+        )
+        self.assertEqual(
+            batch_ids, ["payout-0", "payout-1", "payout-2", "payout-3"]
+        )
+        self.assertEqual(
+            results[:3],
+            [
+                PaymentResult("user_0", "1", True, "tx_user_0", None),
+                PaymentResult("user_1", "1", False, None, "No account."),
+                PaymentResult("user_2", "1", True, "tx_user_2", None),
+            ],
+        )
+        self.assertEqual(
+            [result.error for result in results[4:6]],
+            ["Batch rejected."] * 2,
+        )
+        # A batch that timed out doesn't lose the others' results.
+        self.assertEqual(
+            [result.error for result in results[6:]],
+            ["Timed out; status unknown."] * 2,
+        )
+        self.assertEqual(self.wallet._balances, dict())
+
+    def test_wallet_history(self):
+        pages = [
+            dict_to_ntuple(
+                {
+                    "result": {
+                        "payments": [
+                            {"payment": {"id": 1}},
+                            {"payment": {"id": 2}},
+                        ],
+                        "cursor": "next",
+                    }
+                }
+            ),
+            dict_to_ntuple({"result": {"payments": [{"payment": {"id": 3}}]}}),
+        ]
+        self.api.call_api.side_effect = [balances_response("1.0")] + pages
+        history = self.wallet.iter_history()
+        self.assertEqual(next(history).id, 1)
+        self.assertEqual(self.api.call_api.call_count, 2)
+        self.assertEqual([payment.id for payment in history], [2, 3])
+        self.api.call_api.assert_called_with(
+            "wallet",
+            {
+                "method": "history",
+                "params": {
+                    "options": {"account-id": "GACCOUNT", "cursor": "next"}
+                },
+            },
+        )